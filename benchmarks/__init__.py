@@ -0,0 +1,4 @@
+"""Throughput and latency benchmarks for the tsellm UDFs.
+
+Run with ``python -m benchmarks.run --help``.
+"""
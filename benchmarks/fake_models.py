@@ -0,0 +1,108 @@
+"""Deterministic fake llm models with configurable latency, jitter and output size.
+
+Responses, vectors and latencies are all derived from the input text and
+a seed, so two runs of a benchmark do exactly the same work.
+"""
+
+import random
+import time
+
+import llm
+
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu".split()
+
+
+def _rng(seed, text) -> random.Random:
+    return random.Random(f"{seed}:{text}")
+
+
+def _sleep(rng, latency, jitter):
+    delay = latency + (rng.gauss(0, jitter) if jitter else 0)
+    if delay > 0:
+        time.sleep(delay)
+
+
+class FakeModel(llm.Model):
+    """Answers each prompt with ``output_size`` characters of deterministic text,
+    after ``latency`` seconds (plus Gaussian ``jitter``)."""
+
+    can_stream = False
+
+    def __init__(
+        self, model_id="fake", latency=0.0, jitter=0.0, output_size=64, seed=0
+    ):
+        self.model_id = model_id
+        self.latency = latency
+        self.jitter = jitter
+        self.output_size = output_size
+        self.seed = seed
+
+    def execute(self, prompt, stream, response, conversation=None):
+        rng = _rng(self.seed, prompt.prompt)
+        _sleep(rng, self.latency, self.jitter)
+        words = []
+        length = 0
+        while length < self.output_size:
+            words.append(rng.choice(WORDS))
+            length += len(words[-1]) + 1
+        text = " ".join(words)[: self.output_size]
+        response.set_usage(input=len(prompt.prompt.split()), output=len(words))
+        yield text
+
+
+class FakeEmbeddingModel(llm.EmbeddingModel):
+    """Embeds each item as a deterministic ``dim``-dimensional vector.
+
+    Each batch of up to ``batch_size`` items takes ``latency`` seconds
+    (plus Gaussian ``jitter``), like a remote embedding API would.
+    """
+
+    def __init__(
+        self,
+        model_id="fake-embed",
+        latency=0.0,
+        jitter=0.0,
+        dim=384,
+        batch_size=100,
+        seed=0,
+    ):
+        self.model_id = model_id
+        self.latency = latency
+        self.jitter = jitter
+        self.dim = dim
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def embed_batch(self, items):
+        items = list(items)
+        seed_text = items[0] if items else ""
+        _sleep(_rng(self.seed, seed_text), self.latency, self.jitter)
+        for item in items:
+            rng = _rng(self.seed, item)
+            yield [rng.uniform(-1, 1) for _ in range(self.dim)]
+
+
+class FakeModelsPlugin:
+    """An llm plugin registering the given fake models."""
+
+    def __init__(self, *models):
+        self.models = models
+
+    @llm.hookimpl
+    def register_models(self, register):
+        for model in self.models:
+            if isinstance(model, llm.Model):
+                register(model)
+
+    @llm.hookimpl
+    def register_embedding_models(self, register):
+        for model in self.models:
+            if isinstance(model, llm.EmbeddingModel):
+                register(model)
+
+
+def register(*models, name="tsellm-fake-models"):
+    """Make ``models`` resolvable by ``llm.get_model``/``get_embedding_model``."""
+    if llm.plugins.pm.has_plugin(name):
+        llm.plugins.pm.unregister(name=name)
+    llm.plugins.pm.register(FakeModelsPlugin(*models), name=name)
@@ -0,0 +1,306 @@
+"""Measure the throughput, per-row latency and peak memory of each UDF.
+
+Every (backend, UDF, row count) case runs in a fresh interpreter against
+an in-memory database, with the deterministic models of ``fake_models``:
+
+    python -m benchmarks.run --rows 1000 100000 --latency 0.001 --jitter 0.0005
+    python -m benchmarks.run --compare before.json after.json
+
+A row's latency is the time between it and the previous row reaching the cursor,
+so for DuckDB it shows up once per vectorized chunk rather than spread over rows.
+"""
+
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROW_SOURCES = {
+    "sqlite": (
+        "WITH RECURSIVE r(i) AS "
+        "(SELECT 0 UNION ALL SELECT i + 1 FROM r WHERE i + 1 < {n}) SELECT i FROM r"
+    ),
+    "duckdb": "SELECT i FROM range({n}) t(i)",
+}
+
+# The text and JSON columns of the ``bench`` table, built from row number ``i``.
+COLUMNS = (
+    "'row ' || i",
+    """'{"name": "row ' || i || '", "tags": ["a ' || i || '", "b ' || i || '"]}'""",
+)
+
+QUERIES = {
+    "prompt": "SELECT prompt(t, 'fake') FROM bench",
+    "embed": "SELECT embed(t, 'fake-embed') FROM bench",
+    "embed_blob": "SELECT embed_blob(t, 'fake-embed') FROM bench",
+    "json_embed": "SELECT json_embed(d, 'fake-embed') FROM bench",
+}
+
+DEFAULT_ROWS = (1_000, 100_000, 1_000_000)
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the kernel's resident-set high-water mark, where Linux allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> int:
+    """Peak resident set size in bytes since the last ``_reset_peak_rss``."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is the peak over the whole process, in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def run_case(backend, udf, rows, models, prefetch=False) -> dict:
+    """Time ``QUERIES[udf]`` over ``rows`` rows of a fresh ``backend`` console."""
+    from tsellm.cli import DuckDBConsole, SQLiteConsole
+    from tsellm.models import registry
+
+    from .fake_models import FakeEmbeddingModel, FakeModel, register
+
+    register(FakeModel(**models["prompt"]), FakeEmbeddingModel(**models["embed"]))
+    # Resolve the models up front: loading llm is a one-off cost, not per-row work.
+    registry.get_model("fake")
+    registry.get_embedding_model("fake-embed")
+    console = {"sqlite": SQLiteConsole, "duckdb": DuckDBConsole}[backend](":memory:")
+    con = console.connection
+    con.execute("CREATE TABLE bench (t TEXT, d TEXT)")
+    con.execute(
+        f"INSERT INTO bench SELECT {', '.join(COLUMNS)} "
+        f"FROM ({ROW_SOURCES[backend].format(n=rows)})"
+    )
+    sql = QUERIES[udf]
+
+    _reset_peak_rss()
+    latencies = []
+    start = last = time.perf_counter()
+    if prefetch and backend == "sqlite":
+        console.prefetch_calls(sql)
+    cursor = con.execute(sql)
+    while cursor.fetchone() is not None:
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+    console.flush_cache()
+    elapsed = time.perf_counter() - start
+    peak = _peak_rss()
+    con.close()
+
+    latencies.sort()
+    return {
+        "backend": backend,
+        "udf": udf,
+        "rows": rows,
+        "prefetch": prefetch and backend == "sqlite",
+        "seconds": elapsed,
+        "rows_per_sec": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": 1000 * _percentile(latencies, 0.50) if latencies else None,
+        "p99_ms": 1000 * _percentile(latencies, 0.99) if latencies else None,
+        "peak_rss_mb": peak / (1024 * 1024),
+    }
+
+
+def run_isolated(case: dict) -> dict:
+    """Run one case in a fresh interpreter, so its peak RSS is its own.
+
+    Installed llm plugins are not loaded (unless ``LLM_LOAD_PLUGINS`` says so),
+    so the models they pull in do not inflate the measured memory.
+    """
+    out = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", "--case", json.dumps(case)],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(__file__).resolve().parent.parent,
+        env={"LLM_LOAD_PLUGINS": "", **os.environ},
+    ).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def environment() -> dict:
+    from importlib.metadata import version
+
+    import duckdb
+
+    from tsellm.__version__ import __version__
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit or None,
+        "tsellm": __version__,
+        "llm": version("llm"),
+        "sqlite": sqlite3.sqlite_version,
+        "duckdb": duckdb.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def print_results(results, stream=sys.stdout):
+    print(
+        f"{'backend':<8}{'udf':<12}{'rows':>9}{'rows/s':>12}"
+        f"{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}",
+        file=stream,
+    )
+    for r in results:
+        print(
+            f"{r['backend']:<8}{r['udf']:<12}{r['rows']:>9}{r['rows_per_sec']:>12.1f}"
+            f"{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['peak_rss_mb']:>10.1f}",
+            file=stream,
+        )
+
+
+def compare(before, after, stream=sys.stdout):
+    """Print the change in throughput and p99 latency between two result files."""
+
+    def key(r):
+        return r["backend"], r["udf"], r["rows"], r.get("prefetch", False)
+
+    old = {key(r): r for r in before["results"]}
+    print(
+        f"{'backend':<8}{'udf':<12}{'rows':>9}{'rows/s':>12}"
+        f"{'change':>9}{'p99 change':>12}",
+        file=stream,
+    )
+    for r in after["results"]:
+        if key(r) not in old:
+            continue
+        o = old[key(r)]
+        print(
+            f"{r['backend']:<8}{r['udf']:<12}{r['rows']:>9}{r['rows_per_sec']:>12.1f}"
+            f"{r['rows_per_sec'] / o['rows_per_sec'] - 1:>+9.1%}"
+            f"{r['p99_ms'] / o['p99_ms'] - 1 if o['p99_ms'] else 0:>+12.1%}",
+            file=stream,
+        )
+
+
+def make_parser():
+    parser = ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Benchmark the tsellm UDFs with deterministic fake models",
+    )
+    parser.add_argument(
+        "--backend",
+        nargs="+",
+        choices=sorted(ROW_SOURCES),
+        default=sorted(ROW_SOURCES),
+    )
+    parser.add_argument(
+        "--udf", nargs="+", choices=list(QUERIES), default=list(QUERIES)
+    )
+    parser.add_argument("--rows", nargs="+", type=int, default=list(DEFAULT_ROWS))
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per model call"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Standard deviation of --latency"
+    )
+    parser.add_argument(
+        "--output-size", type=int, default=64, help="Characters per prompt response"
+    )
+    parser.add_argument("--dim", type=int, default=384, help="Embedding dimensions")
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="Texts per embedding call"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--prefetch", action="store_true", help="SQLite: prefetch the model calls"
+    )
+    parser.add_argument("--output", metavar="PATH", help="Where to save the results")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--case", help="Run one JSON-encoded case; used internally")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if args.case:
+        case = json.loads(args.case)
+        print(json.dumps(run_case(**case)))
+        return
+    if args.compare:
+        before, after = (json.loads(Path(p).read_text()) for p in args.compare)
+        compare(before, after)
+        return
+
+    models = {
+        "prompt": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "output_size": args.output_size,
+            "seed": args.seed,
+        },
+        "embed": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "dim": args.dim,
+            "batch_size": args.batch_size,
+            "seed": args.seed,
+        },
+    }
+    results = []
+    for rows in args.rows:
+        for backend in args.backend:
+            for udf in args.udf:
+                print(f"{backend} {udf} {rows} rows ...", file=sys.stderr)
+                results.append(
+                    run_isolated(
+                        {
+                            "backend": backend,
+                            "udf": udf,
+                            "rows": rows,
+                            "models": models,
+                            "prefetch": args.prefetch,
+                        }
+                    )
+                )
+    print_results(results)
+
+    report = {"environment": environment(), "models": models, "results": results}
+    output = Path(
+        args.output
+        or Path(__file__).resolve().parent
+        / "results"
+        / f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Saved {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
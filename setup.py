@@ -68,7 +68,7 @@ setup(
     license="BSD License",
     version=__version__.__version__,
     packages=["tsellm"],
-    install_requires=["llm", "setuptools", "pip", "duckdb"],
+    install_requires=["llm", "setuptools", "pip", "duckdb", "pyarrow", "numpy"],
     extras_require={
         "test": [
             "pytest",
@@ -78,7 +78,8 @@ setup(
             "sqlite_utils",
             "llm-markov",
             "llm-embed-hazo==0.2.1",
-        ]
+        ],
+        "tokens": ["tiktoken"],
     },
     python_requires=">=3.11",
 )
@@ -1,15 +1,70 @@
+import asyncio
+import io
+import json
+import os
+import re
 import sqlite3
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
 from pathlib import Path
 from test.support import captured_stdout, captured_stderr, captured_stdin
+from unittest import mock
 
 import duckdb
 import llm.cli
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from llm import cli as llm_cli
 
+from tsellm.cache import TSELLM_CACHE_SQL, PromptCache
+from tsellm.chunking import chunks
+from tsellm.core import (
+    read_config,
+    _tsellm_init,
+    _embed_chunks_many,
+    _embed_unique,
+    _json_embed_many,
+    _pack,
+    _prompt_many,
+    _prompt_model,
+    _prompt_reduce,
+)
+from tsellm.similarity import as_vector, cosine_similarity, dot_product, l2_distance
+from tsellm.vectorized import _cosine_similarity_arrow, _embed_model_arrow
+from tsellm.engine import Engine
+from tsellm.enrich import Enrichment
+from tsellm.functions import SQLITE_AGGREGATES, SQLITE_FUNCTIONS
+from tsellm.ivf import VectorIndex, benchmark
+from tsellm.join import block_rows, top_k
+from tsellm.quantize import (
+    Reducer,
+    benchmark as quantize_benchmark,
+    binary_blobs,
+    hamming_distance,
+    int8_blobs,
+    int8_dot,
+)
+from tsellm.models import ModelRegistry
+from tsellm.scheduler import Scheduler, TokenBucket
+from tsellm.server import ConsolePool, TsellmServer, query, running_server
+from tsellm.stats import UDFStats
+from tsellm.workers import WorkerPool
+
 from tsellm.__version__ import __version__
-from tsellm.cli import cli, TsellmConsole, SQLiteConsole, DuckDBConsole, DBSniffer
+from tsellm.cli import (
+    cli,
+    TsellmConsole,
+    SQLiteConsole,
+    DuckDBConsole,
+    DBSniffer,
+    DatabaseType,
+    open_console,
+)
 
 
 def new_tempfile():
@@ -45,6 +100,966 @@ class TestDBSniffer(unittest.TestCase):
         self.assertFalse(duckdb_sni.is_sqlite)
         self.assertTrue(duckdb_sni.is_duckdb)
 
+    def test_sniff_once_without_connecting(self):
+        with mock.patch("duckdb.connect") as connect:
+            sniffer = DBSniffer(self.duckdb_fp)
+            with mock.patch("builtins.open", wraps=open) as opened:
+                self.assertTrue(sniffer.is_duckdb)
+                self.assertFalse(sniffer.is_sqlite)
+                self.assertFalse(sniffer.is_data_file)
+            self.assertEqual(opened.call_count, 1)
+            connect.assert_not_called()
+
+    def test_sniff_data_files(self):
+        parquet_fp = new_tempfile()
+        pq.write_table(pa.table({"x": [1]}), parquet_fp)
+        self.assertEqual(DBSniffer(parquet_fp).sniff(), DatabaseType.PARQUET)
+        self.assertEqual(DBSniffer("missing.csv").sniff(), DatabaseType.CSV)
+        self.assertEqual(DBSniffer("missing.jsonl").sniff(), DatabaseType.JSONL)
+        self.assertTrue(DBSniffer("missing.jsonl").is_data_file)
+
+    def test_sniff_new_files(self):
+        self.assertEqual(DBSniffer("missing.duckdb").sniff(), DatabaseType.DUCKDB)
+        self.assertEqual(DBSniffer("missing").sniff(), DatabaseType.UNKNOWN)
+
+
+class TestPromptCache(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+        self.con.execute(
+            "CREATE TABLE __tsellm_cache (model text, key text, response text, created real)"
+        )
+
+    def test_hit_and_miss(self):
+        cache = PromptCache()
+        calls = []
+        compute = lambda: calls.append(1) or "response"
+        self.assertEqual(cache.prompt("m", "p", compute), "response")
+        self.assertEqual(cache.prompt("m", "p", compute), "response")
+        cache.prompt("other", "p", compute)
+        self.assertEqual((cache.hits, cache.misses, len(calls)), (1, 2, 2))
+
+    def test_flush_and_evict(self):
+        cache = PromptCache(max_entries=2)
+        for p in ("a", "b", "c"):
+            cache.prompt("m", p, lambda: p.upper())
+        cache.flush(self.con)
+        self.assertEqual(len(cache.entries), 2)
+        rows = self.con.execute("select count(*) from __tsellm_cache").fetchall()
+        self.assertEqual(rows, [(2,)])
+
+        reloaded = PromptCache(max_age=0)
+        reloaded.load(self.con)
+        self.assertEqual(reloaded.entries, {})
+
+    def test_flush_in_transaction(self):
+        self.con.execute("CREATE TABLE t (x int)")
+        self.con.execute("BEGIN TRANSACTION")
+        self.con.execute("INSERT INTO t VALUES (1)")
+        cache = PromptCache()
+        cache.prompt("m", "p", lambda: "P")
+        cache.flush(self.con)
+        self.con.execute("COMMIT")
+        for table in ("t", "__tsellm_cache"):
+            rows = self.con.execute(f"select count(*) from {table}").fetchall()
+            self.assertEqual(rows, [(1,)])
+
+    def test_flush_failure(self):
+        cache = PromptCache()
+        cache.prompt("m", "p", lambda: "P")
+        self.con.execute("ALTER TABLE __tsellm_cache RENAME TO moved")
+        with captured_stderr() as err:
+            cache.flush(self.con)
+        self.assertIn("Could not write the prompt cache", err.getvalue())
+        self.assertEqual(list(cache.pending), [("m", cache.key("p"))])
+
+        self.con.execute("ALTER TABLE moved RENAME TO __tsellm_cache")
+        cache.flush(self.con)
+        self.assertEqual(cache.pending, {})
+        rows = self.con.execute("select count(*) from __tsellm_cache").fetchall()
+        self.assertEqual(rows, [(1,)])
+
+    def test_flush_and_evict_duckdb(self):
+        self.con = duckdb.connect()
+        self.con.execute(TSELLM_CACHE_SQL)
+        self.test_flush_and_evict()
+
+    def test_flush_in_transaction_duckdb(self):
+        self.con = duckdb.connect()
+        self.con.execute(TSELLM_CACHE_SQL)
+        self.test_flush_in_transaction()
+
+    def test_flush_failure_duckdb(self):
+        self.con = duckdb.connect()
+        self.con.execute(TSELLM_CACHE_SQL)
+        self.test_flush_failure()
+
+
+class TestVectorized(unittest.TestCase):
+    def test_embed_unique(self):
+        class Model:
+            batches = []
+
+            def embed_multi(self, items):
+                self.batches.append(items)
+                return [[float(len(item))] for item in items]
+
+        model = Model()
+        self.assertEqual(
+            _embed_unique(model, ["a", "bb", "a", "a"]),
+            [[1.0], [2.0], [1.0], [1.0]],
+        )
+        self.assertEqual(model.batches, [["a", "bb"]])
+
+    @mock.patch("tsellm.chunking._encoding", return_value=None)
+    def test_chunks(self, _):
+        text = "one two three four five six seven"
+        self.assertEqual(
+            list(chunks(text, 3)), ["one two", "three", "four", "five six", "seven"]
+        )
+        self.assertEqual(
+            list(chunks(text, 4, 2)),
+            ["one two three", "three four", "four five", "five six", "six seven"],
+        )
+        long = "x" * 10 + " y"
+        self.assertEqual(list(chunks(long, 2)), ["xxxxxxx", "xxx y"])
+        self.assertEqual(list(chunks("", 8)), [])
+        with self.assertRaises(ValueError):
+            list(chunks(text, 2, 2))
+
+    def test_chunks_tokenizer(self):
+        class Encoding:
+            # Like BPE, tokens of up to three characters take the space before them.
+            def encode_ordinary(self, text):
+                return re.findall(r" ?\S{1,3}|\s+", text)
+
+            def decode_with_offsets(self, tokens):
+                offsets = [0]
+                for token in tokens[:-1]:
+                    offsets.append(offsets[-1] + len(token))
+                return "".join(tokens), offsets
+
+        with mock.patch("tsellm.chunking._encoding", return_value=Encoding()):
+            text = "one three four  seventeen"
+            self.assertEqual(list(chunks(text, 3)), ["one three", "four", "seventeen"])
+            self.assertEqual(
+                list(chunks(text, 2)), ["one", "three", "four", "sevent", "een"]
+            )
+            self.assertEqual(
+                list(chunks(text, 4, 2)), ["one three", "three four", "seventeen"]
+            )
+
+    @mock.patch("tsellm.chunking._encoding", return_value=None)
+    def test_embed_chunks_many(self, _):
+        class Model:
+            model_id = "m"
+            batches = []
+
+            def embed_multi(self, items):
+                self.batches.append(items)
+                return [[float(len(item)), 1.0] for item in items]
+
+        model = Model()
+        scheduler = Scheduler({"m": {"context": 3}})
+        self.assertEqual(
+            _embed_chunks_many(
+                ["one two three", "four"], model, ["mean", "max"], scheduler
+            ),
+            [[6.0, 1.0], [4.0, 1.0]],
+        )
+        self.assertEqual(model.batches, [["one two", "three", "four"]])
+
+    def test_prompt_many(self):
+        in_flight, peak = [0], [0]
+        lock = threading.Lock()
+
+        def fake_prompt(prompt, model):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            return prompt.upper()
+
+        prompts = [f"p{i % 10}" for i in range(40)]
+        with mock.patch("tsellm.core._prompt_model", fake_prompt):
+            responses = _prompt_many(prompts, "m", max_in_flight=3)
+        self.assertEqual(responses, [p.upper() for p in prompts])
+        self.assertLessEqual(peak[0], 3)
+        self.assertGreater(peak[0], 1)
+
+    def test_pack(self):
+        runs = _pack(["a" * 40] * 7, budget=24)
+        self.assertEqual([len(r) for r in runs], [2, 2, 2, 1])
+        self.assertTrue(all(len(t) <= 44 for r in runs for t in r))
+        self.assertEqual(_pack(["a" * 1000, "b"], budget=24), [["a" * 44, "b"]])
+
+    def test_prompt_reduce(self):
+        prompts = []
+
+        def fake_prompt(prompt, model):
+            prompts.append(prompt)
+            return f"<{prompt.count('row')}>row"
+
+        scheduler = Scheduler({"m": {"context": 20}})
+        groups = [("sum", [f"row {i} " * 5 for i in range(6)]), ("sum", ["row"])]
+        with mock.patch("tsellm.core._prompt_model", fake_prompt):
+            first, second = _prompt_reduce(
+                groups + [("sum", [None])], "m", scheduler=scheduler
+            )[:2]
+        # Six rows in three map prompts, then one reduce prompt; one for "row".
+        self.assertEqual(len(prompts), 5)
+        self.assertTrue(all(p.startswith("sum\n\n---\n\n") for p in prompts))
+        self.assertEqual(first, "<3>row")
+        self.assertEqual(second, "<1>row")
+        with mock.patch("tsellm.core._prompt_model", fake_prompt):
+            self.assertEqual(_prompt_reduce([("sum", [None])], "m"), [None])
+
+    def test_json_embed_many(self):
+        class Model:
+            batches = []
+
+            def embed_multi(self, items):
+                self.batches.append(items)
+                return [[float(len(item))] for item in items]
+
+        model = Model()
+        docs = [
+            {"name": "John", "hobbies": ["reading", "biking"], "age": 30},
+            {"name": "Jane", "hobbies": ["reading", "reading"]},
+        ]
+        self.assertEqual(
+            _json_embed_many(docs, model),
+            [
+                {"name": [4.0], "hobbies": [[7.0], [6.0]], "age": 30},
+                {"name": [4.0], "hobbies": [[7.0], [7.0]]},
+            ],
+        )
+        self.assertEqual(model.batches, [["John", "reading", "biking", "Jane"]])
+
+    def test_embed_model_arrow(self):
+        result = _embed_model_arrow(
+            pa.array(["a", None, "a"]), pa.array(["hazo", "hazo", "hazo"])
+        )
+        self.assertEqual(result.type, pa.list_(pa.float32()))
+        self.assertIsNone(result[1].as_py())
+        self.assertEqual(result[0].as_py()[0], 1.0)
+
+
+class TestSimilarity(unittest.TestCase):
+    def test_kernels(self):
+        a = np.array([[1, 0], [3, 4]], dtype=np.float32)
+        b = np.array([[0, 1], [6, 8]], dtype=np.float32)
+        np.testing.assert_allclose(cosine_similarity(a, b), [0.0, 1.0])
+        np.testing.assert_allclose(dot_product(a, b), [0.0, 50.0])
+        np.testing.assert_allclose(l2_distance(a, b), [np.sqrt(2), 5.0])
+
+    def test_as_vector(self):
+        for v in ("[1.5, 2]", llm.encode([1.5, 2]), [1.5, 2]):
+            np.testing.assert_array_equal(as_vector(v), [1.5, 2.0])
+
+    def test_arrow_nulls(self):
+        vectors = pa.array([[1.0, 0.0], None, [0.0, 0.0]], type=pa.list_(pa.float32()))
+        result = _cosine_similarity_arrow(vectors, vectors).to_pylist()
+        self.assertEqual(result, [1.0, None, None])
+
+
+class TestQuantize(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # 200 vectors of 32 dimensions, spanning 8
+        self.vectors = (rng.normal(size=(200, 8)) @ rng.normal(size=(8, 32))).astype(
+            np.float32
+        )
+
+    def test_int8(self):
+        blobs = int8_blobs(self.vectors)
+        self.assertEqual(blobs.shape, (200, 36))
+        exact = np.einsum("ij,ij->i", self.vectors, self.vectors[::-1])
+        norms = np.linalg.norm(self.vectors, axis=1)
+        error = np.abs(int8_dot(blobs, blobs[::-1]) - exact) / (norms * norms[::-1])
+        self.assertLess(error.max(), 0.01)
+        self.assertEqual(int8_dot(int8_blobs(np.zeros((1, 4))), blobs[:1, :8]), [0])
+
+    def test_binary(self):
+        blobs = binary_blobs(self.vectors)
+        self.assertEqual(blobs.shape, (200, 4))
+        self.assertEqual(hamming_distance(blobs, binary_blobs(-self.vectors))[0], 32)
+        self.assertEqual(hamming_distance(blobs, blobs[:1])[0], 0)
+        with self.assertRaises(ValueError):
+            hamming_distance(blobs, blobs[:, :2])
+
+    def test_reducer(self):
+        pca = Reducer.fit(self.vectors, 8)
+        reduced = pca.apply(self.vectors)
+        self.assertEqual(reduced.shape, (200, 8))
+        # The vectors span 8 dimensions, so 8 components keep their dot products.
+        np.testing.assert_allclose(
+            reduced @ reduced[0], self.vectors @ self.vectors[0], rtol=1e-3, atol=1e-2
+        )
+        restored = Reducer.from_config(json.loads(json.dumps(pca.to_config())))
+        np.testing.assert_allclose(restored.apply(self.vectors), reduced, atol=1e-4)
+        self.assertEqual(Reducer.fit(self.vectors, 4, "random").dim, 4)
+        with self.assertRaises(ValueError):
+            Reducer.fit(self.vectors, 64)
+
+    def test_benchmark(self):
+        results = {
+            name: (size, recall)
+            for name, size, recall, _ in quantize_benchmark(
+                self.vectors, {"pca": Reducer.fit(self.vectors, 8)}, k=5, queries=20
+            )
+        }
+        self.assertEqual(results["float32"], (128, 1.0))
+        self.assertEqual(results["binary"][0], 4)
+        self.assertGreater(results["int8"][1], 0.9)
+        self.assertGreater(results["pca"][1], 0.9)
+
+
+class TestVectorIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(500, 8)).astype(np.float32)
+        self.path = new_tempfile()
+
+    def test_search(self):
+        index = VectorIndex.build(self.path, range(1, 501), self.vectors, nlist=10)
+        self.assertEqual(index.metadata()["count"], 500)
+        self.assertEqual(index.search(self.vectors[41], 1)[0][0], 42)
+        query = self.vectors[0]
+        self.assertEqual(index.search(query, 5, nprobe=10), index.exact(query, 5))
+
+    def test_add(self):
+        index = VectorIndex.build(self.path, range(1, 401), self.vectors[:400])
+        index = index.add(range(401, 501), self.vectors[400:])
+        self.assertEqual(index.max_rowid, 500)
+        reopened = VectorIndex.open(self.path, index.nprobe)
+        self.assertEqual(reopened.exact(self.vectors[450], 1)[0][0], 451)
+
+    def test_benchmark(self):
+        index = VectorIndex.build(self.path, range(500), self.vectors, nlist=10)
+        results = benchmark(index, k=5, queries=20)
+        self.assertEqual(results[-1][:2], (10, 1.0))
+
+    def assertKnn(self, console, sql):
+        console.execute("create table docs(v text)")
+        console.connection.executemany(
+            "insert into docs values (?)",
+            [(json.dumps(v.tolist()),) for v in self.vectors],
+        )
+        console.runsource(".index create docs v")
+        query = json.dumps(self.vectors[41].tolist())
+        with captured_stdout() as out:
+            console.execute(sql.format(query=query))
+        console.connection.close()
+        return out.getvalue().splitlines()
+
+    def test_knn_sqlite(self):
+        rows = self.assertKnn(
+            SQLiteConsole(str(self.path)),
+            "select json_extract(value, '$.rowid') from json_each(knn('{query}', 2))",
+        )
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0], "(42,)")
+
+    def test_knn_duckdb(self):
+        rows = self.assertKnn(
+            DuckDBConsole(str(self.path)),
+            "select r.rowid from (select unnest(knn('{query}', 2)) r)",
+        )
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0], "(41,)")
+
+
+class TestSemanticJoin(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.left = rng.normal(size=(50, 8)).astype(np.float32)
+        self.right = rng.normal(size=(30, 8)).astype(np.float32)
+        norms = np.linalg.norm(self.right, axis=1)
+        self.best = int(np.argmax(self.right @ self.left[0] / norms))
+
+    def test_top_k(self):
+        left, right, scores = top_k(self.left, self.right, 3, rows=7)
+        self.assertEqual(len(scores), 150)
+        expected = (self.left / np.linalg.norm(self.left, axis=1, keepdims=True)) @ (
+            self.right / np.linalg.norm(self.right, axis=1, keepdims=True)
+        ).T
+        best = np.argsort(-expected, axis=1)[:, :3]
+        np.testing.assert_array_equal(left, np.repeat(np.arange(50), 3))
+        np.testing.assert_array_equal(right, best.ravel())
+        np.testing.assert_allclose(
+            scores, np.take_along_axis(expected, best, axis=1).ravel(), rtol=1e-5
+        )
+
+    def test_block_rows(self):
+        self.assertEqual(block_rows(1000, memory=4 * 1000 * 40), 10)
+        self.assertEqual(block_rows(10**9, memory=1024), 1)
+
+    def assertSemanticJoin(self, console, expected_first):
+        for table, vectors in (("l", self.left), ("r", self.right)):
+            console.execute(f"create table {table}(v text)")
+            console.connection.executemany(
+                f"insert into {table} values (?)",
+                [(json.dumps(v.tolist()),) for v in vectors],
+            )
+        with captured_stdout() as out:
+            console.runsource(".semantic_join l v r v 2")
+        header, *rows = out.getvalue().splitlines()
+        self.assertEqual(header, "left_rowid,right_rowid,score")
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[0].split(",")[:2], expected_first)
+
+    def test_sqlite(self):
+        console = SQLiteConsole(":memory:")
+        console.output_format = "csv"
+        self.assertSemanticJoin(console, ["1", str(self.best + 1)])
+
+    def test_duckdb(self):
+        console = DuckDBConsole(":memory:")
+        console.output_format = "csv"
+        self.assertSemanticJoin(console, ["0", str(self.best)])
+        rows = console.connection.execute(
+            "select count(*) from semantic_join('l', 'v', 'r', 'v', k := 5)"
+        ).fetchall()
+        self.assertEqual(rows, [(250,)])
+
+
+class TestModelRegistry(unittest.TestCase):
+    def test_resolves_once(self):
+        registry = ModelRegistry()
+        self.assertIs(
+            registry.get_embedding_model("hazo"), registry.get_embedding_model("hazo")
+        )
+        self.assertIs(registry.get_model("markov"), registry.get_model("markov"))
+
+    def test_lru_eviction(self):
+        registry = ModelRegistry(max_models=1)
+        registry.get_embedding_model("hazo")
+        registry.get_model("markov")
+        self.assertNotIn("hazo", registry)
+        self.assertIn("markov", registry)
+
+    def test_preload(self):
+        registry = ModelRegistry()
+        registry.preload("hazo").join()
+        registry.preload("markov").join()
+        self.assertIn("hazo", registry)
+        self.assertIn("markov", registry)
+
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.console = SQLiteConsole(":memory:")
+        self.console.prefetch = True
+        self.console.execute("create table t(x text, y text)")
+        self.console.execute(
+            "insert into t(x) values ('hello world'), ('a b'), ('hello world')"
+        )
+
+    def test_prefetch_prompts_once(self):
+        calls = []
+
+        def fake_prompt(prompt, model):
+            calls.append(prompt)
+            return prompt.upper()
+
+        with mock.patch("tsellm.core._prompt_model", fake_prompt):
+            with captured_stdout() as out:
+                self.console.execute("select prompt(x, 'markov') from t")
+        self.assertEqual(sorted(calls), ["a b", "hello world"])
+        self.assertEqual(
+            out.getvalue(), "('HELLO WORLD',)\n('A B',)\n('HELLO WORLD',)\n"
+        )
+
+    def test_prefetch_update(self):
+        self.console.execute("update t set y = embed(x, 'hazo')")
+        rows = self.console.connection.execute("select x, y from t").fetchall()
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(y.startswith("[") for _, y in rows))
+
+    def test_stream_records_prompts_only(self):
+        self.console.prefetch = False
+        self.console.stream = True
+        with mock.patch.object(self.console, "prefetch_calls") as prefetch_calls:
+            for sql in (
+                "select cosine_similarity(json_to_embedding('[1]'), "
+                "json_to_embedding('[1]'))",
+                "select embed(x, 'hazo') from t",
+                "select 'prompt(x)' from t -- prompt(x)",
+            ):
+                self.console.run(sql, stream=io.StringIO())
+            prefetch_calls.assert_not_called()
+            self.console.run("select PROMPT (x, 'markov') from t", stream=io.StringIO())
+            prefetch_calls.assert_called_once()
+
+    def test_prefetch_json_embed(self):
+        self.console.prefetch = False
+        with captured_stdout() as expected:
+            self.console.execute("select json_embed(json_array(x, x), 'hazo') from t")
+        self.console.prefetch = True
+        with captured_stdout() as out:
+            self.console.execute("select json_embed(json_array(x, x), 'hazo') from t")
+        self.assertEqual(expected.getvalue(), out.getvalue())
+
+
+class TestFunctions(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+        _tsellm_init(self.con)
+        self.con.execute("create table t(x text)")
+
+    def test_tsellm_init_registers_every_function(self):
+        registered = {
+            (name, n_args)
+            for name, n_args in self.con.execute(
+                "select name, narg from pragma_function_list"
+            )
+        }
+        for udf in SQLITE_FUNCTIONS + SQLITE_AGGREGATES:
+            self.assertIn((udf.name, udf.n_args), registered)
+
+    def test_deterministic(self):
+        self.con.execute("create index t_vector on t(json_to_embedding(x))")
+        self.con.execute("create index t_embedding on t(embed(x, 'hazo'))")
+        # The same prompt may get another response.
+        with self.assertRaises(sqlite3.OperationalError):
+            self.con.execute("create index t_prompt on t(prompt(x, 'markov'))")
+
+    def test_cached_prompt_not_deterministic(self):
+        # An index would go stale once the cache is cleared or turned off.
+        console = SQLiteConsole(":memory:")
+        self.assertTrue(console.cache.enabled)
+        console.connection.execute("create table t(x text)")
+        with self.assertRaises(sqlite3.OperationalError):
+            console.connection.execute(
+                "create index t_prompt on t(prompt(x, 'markov'))"
+            )
+
+    def test_strict(self):
+        with mock.patch("tsellm.core._embed") as embed:
+            rows = self.con.execute(
+                "select embed(null, 'hazo'), embed('a', null), embedding_to_json(null)"
+            ).fetchall()
+        self.assertEqual(rows, [(None, None, None)])
+        embed.assert_not_called()
+
+
+class TestUDFStats(unittest.TestCase):
+    def test_wrap_counts_calls_and_errors(self):
+        stats = UDFStats()
+
+        def prompt(text, model):
+            if text is None:
+                raise ValueError
+            return text.upper()
+
+        udf = stats.wrap("__tsellm_prompt", prompt, prompt)
+        self.assertEqual(udf("abc", "m1"), "ABC")
+        udf("de", "m1")
+        with self.assertRaises(ValueError):
+            udf(None, "m2")
+        m1, m2 = stats.rows()
+        self.assertEqual((m1["function"], m1["model"]), ("prompt", "m1"))
+        self.assertEqual((m1["calls"], m1["rows"], m1["errors"]), (2, 2, 0))
+        self.assertEqual((m1["input_size"], m1["output_size"]), (5, 5))
+        self.assertEqual((m2["model"], m2["calls"], m2["errors"]), ("m2", 1, 1))
+        self.assertEqual(m1["p50_ms"], 0.1)
+
+        stats.reset()
+        self.assertEqual(stats.rows(), [])
+        udf("abc", "m1")
+        self.assertEqual([r["calls"] for r in stats.rows()], [1])
+
+    def test_merge(self):
+        stats = UDFStats()
+        udf = stats.wrap("f", lambda x: x, lambda x: x)
+        udf("a")
+        totals = UDFStats()
+        totals.merge(stats.snapshot())
+        totals.merge(stats.snapshot())
+        (row,) = totals.rows()
+        self.assertEqual(
+            (row["model"], row["calls"], sum(row["histogram"])), (None, 2, 2)
+        )
+
+
+class Throttled(Exception):
+    status_code = 429
+
+
+def _raising(chunks):
+    yield from chunks
+    raise Throttled()
+
+
+class TestScheduler(unittest.TestCase):
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = TokenBucket(60, clock=lambda: now[0])
+        self.assertEqual(bucket.reserve(1), 0.0)
+        self.assertEqual(bucket.reserve(1), 1.0)
+        self.assertEqual(bucket.reserve(1), 2.0)
+        now[0] = 10.0
+        self.assertEqual(bucket.reserve(1), 0.0)
+
+    @mock.patch("tsellm.scheduler.BACKOFF", 0)
+    def test_retry_throttled(self):
+        scheduler = Scheduler(concurrency={"m": 8})
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise Throttled("slow down")
+            return "ok"
+
+        self.assertEqual(scheduler.call("m", flaky), "ok")
+        limiter = scheduler.limiter("m")
+        self.assertEqual((limiter.throttled, limiter.retried), (2, 2))
+        self.assertEqual(limiter.limit, 2.5)
+
+    @mock.patch("tsellm.scheduler.BACKOFF", 0)
+    def test_retry_streams_once(self):
+        attempts = []
+
+        def prompt(text):
+            attempts.append(1)
+            if len(attempts) == 1:
+                # Throttled mid-stream, after the first chunk.
+                response = mock.MagicMock()
+                response.__iter__.side_effect = lambda: _raising(["Hel"])
+                return response
+            response = mock.MagicMock()
+            response.__iter__.side_effect = lambda: iter(["Hel", "lo"])
+            response.text.return_value = "Hello"
+            return response
+
+        stream = io.StringIO()
+        with mock.patch("tsellm.core.registry.get_model") as get_model:
+            get_model.return_value.prompt.side_effect = prompt
+            response = _prompt_model("hi", "m", scheduler=Scheduler(), stream=stream)
+        self.assertEqual(response, "Hello")
+        self.assertEqual(stream.getvalue(), "Hello\n")
+        self.assertEqual(len(attempts), 2)
+
+    @mock.patch("tsellm.scheduler.BACKOFF", 0)
+    def test_retries_exhausted_and_permanent_errors(self):
+        scheduler = Scheduler({"m": {"retries": 1}})
+        calls = []
+
+        def throttled():
+            calls.append(1)
+            raise Throttled()
+
+        with self.assertRaises(Throttled):
+            scheduler.call("m", throttled)
+        self.assertEqual(len(calls), 2)
+
+        def broken():
+            calls.append(1)
+            raise ValueError("bad prompt")
+
+        with self.assertRaises(ValueError):
+            scheduler.call("m", broken)
+        self.assertEqual(len(calls), 3)
+
+    def test_concurrency_limit(self):
+        scheduler = Scheduler(concurrency={"m": 2})
+        in_flight, peak = [0], [0]
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+
+        threads = [
+            threading.Thread(target=scheduler.call, args=("m", call)) for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(peak[0], 2)
+
+
+class FakeAsyncModel:
+    model_id = "fake"
+
+    def __init__(self, fail=0):
+        self.in_flight = self.peak = 0
+        self.fail = fail
+
+    def prompt(self, prompt):
+        model = self
+
+        class Response:
+            input_tokens, output_tokens = 3, 5
+
+            async def text(self):
+                model.in_flight += 1
+                model.peak = max(model.peak, model.in_flight)
+                await asyncio.sleep(0.05)
+                model.in_flight -= 1
+                if model.fail:
+                    model.fail -= 1
+                    raise Throttled()
+                return prompt.upper()
+
+        return Response()
+
+
+class TestEngine(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine()
+        self.addCleanup(self.engine.close)
+
+    def test_async_model(self):
+        model = FakeAsyncModel()
+        prompts = [f"prompt {i}" for i in range(40)]
+        stats = UDFStats()
+        started = time.perf_counter()
+        with mock.patch("tsellm.engine.registry.get_async_model", return_value=model):
+            responses = self.engine.prompt_many("fake", prompts, 20, stats)
+        # Two rounds of 20 concurrent prompts, on the loop's single thread.
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertEqual(responses, [p.upper() for p in prompts])
+        self.assertEqual(model.peak, 20)
+        ((_, counters),) = stats.counters.items()
+        self.assertEqual((counters.input_tokens, counters.output_tokens), (120, 200))
+
+    @mock.patch("tsellm.scheduler.BACKOFF", 0)
+    def test_async_model_retries(self):
+        model = FakeAsyncModel(fail=2)
+        scheduler = Scheduler(concurrency={"fake": 4}, engine=self.engine)
+        with mock.patch("tsellm.engine.registry.get_async_model", return_value=model):
+            responses = _prompt_many(["a", "b"], "fake", scheduler=scheduler)
+        self.assertEqual(responses, ["A", "B"])
+        self.assertEqual(scheduler.limiter("fake").retried, 2)
+
+    def test_thread_fallback(self):
+        def fake_prompt(prompt, model):
+            time.sleep(0.05)
+            return f"{model}: {prompt}"
+
+        with mock.patch("tsellm.core._prompt_model", fake_prompt):
+            responses = self.engine.prompt_many("markov", ["a", "b", "c"] * 10, 30)
+        self.assertEqual(responses, [f"markov: {p}" for p in ["a", "b", "c"] * 10])
+        self.assertIsNone(ModelRegistry().get_async_model("markov"))
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_shards_are_contiguous(self):
+        pool = WorkerPool(3, {"m": {"rpm": 100, "retries": 2}})
+        self.assertEqual(pool._shards(list(range(7))), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(pool._shards([1]), [[1]])
+        self.assertEqual(pool.limits, {"m": {"rpm": 33, "retries": 2}})
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.path = new_sqlite_file()
+        con = sqlite3.connect(self.path)
+        con.execute("create table t(x text)")
+        con.executemany("insert into t values (?)", [("hello world",), ("a b",)])
+        con.commit()
+        con.close()
+
+    def start(self, path, size=2):
+        pool = ConsolePool(lambda: open_console(path), size)
+        server = TsellmServer(("127.0.0.1", 0), pool, quiet=True)
+        server.serve_in_thread()
+        self.addCleanup(pool.close)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_query(self):
+        server = self.start(self.path)
+        out = io.StringIO()
+        query(server.url, "select x, embed(x, 'hazo') is not null e from t", stream=out)
+        self.assertEqual(
+            out.getvalue(),
+            '{"x": "hello world", "e": 1}\n{"x": "a b", "e": 1}\n',
+        )
+        with self.assertRaisesRegex(RuntimeError, "no such column: y"):
+            query(server.url, "select y from t", stream=io.StringIO())
+
+    def test_pool(self):
+        server = self.start(self.path, size=3)
+        pool = server.pool
+        self.assertEqual(len(pool.consoles), 3)
+        self.assertTrue(all(c.scheduler is pool.scheduler for c in pool.consoles))
+        self.assertTrue(all(c.cache is pool.consoles[0].cache for c in pool.consoles))
+        results = []
+
+        def run():
+            out = io.StringIO()
+            query(server.url, "select count(*) from t", "csv", out)
+            results.append(out.getvalue())
+
+        threads = [threading.Thread(target=run) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["count(*)\n2\n"] * 6)
+
+    def test_duckdb(self):
+        path = new_duckdb_file()
+        con = duckdb.connect(str(path))
+        con.execute("create table t as select 'hello world' as x")
+        con.close()
+        server = self.start(path)
+        self.assertEqual(len(server.pool.consoles), 1)
+        out = io.BytesIO()
+        query(server.url, "select x, embed(x, 'hazo') as e from t", "arrow", out)
+        table = pa.ipc.open_stream(out.getvalue()).read_all()
+        self.assertEqual(table.column("x").to_pylist(), ["hello world"])
+        self.assertEqual(len(table.column("e")[0]), 16)
+
+    def test_cli_client(self):
+        server = self.start(":memory:")
+        self.assertEqual(len(server.pool.consoles), 1)
+        with captured_stdout() as out, self.assertRaises(SystemExit) as cm:
+            cli(["--server", server.url, "select 1 + 1"])
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(out.getvalue(), "(2,)\n")
+
+    def test_cli_forwards(self):
+        server = self.start(self.path)
+        server.advertise()
+        self.assertEqual(running_server(self.path), server.url)
+        for args, forwarded in (
+            ([], True),
+            (["--no-server"], False),
+            (["--prefetch"], False),
+            (["--limit", "markov", "rpm", "60"], False),
+        ):
+            with (
+                mock.patch("tsellm.server.query", wraps=query) as forward,
+                captured_stdout() as out,
+                self.assertRaises(SystemExit),
+            ):
+                cli([*args, str(self.path), "select count(*) from t"])
+            self.assertEqual(out.getvalue(), "(2,)\n")
+            self.assertEqual(forward.called, forwarded)
+        server.shutdown()
+        server.server_close()
+        self.assertIsNone(running_server(self.path))
+
+    def test_cli_client_rejects_local_options(self):
+        with self.assertRaisesRegex(ValueError, "--prefetch"):
+            cli(["--server", "http://127.0.0.1:1", "--prefetch", "select 1"])
+
+    def test_new_database(self):
+        server = self.start(new_tempfile())
+        out = io.StringIO()
+        query(server.url, "select 1 as x", stream=out)
+        self.assertEqual(out.getvalue(), '{"x": 1}\n')
+
+    def test_database_named_serve(self):
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+        self.addCleanup(os.chdir, cwd)
+        con = sqlite3.connect("serve")
+        con.execute("create table t(x)")
+        con.close()
+        with captured_stdout() as out, self.assertRaises(SystemExit):
+            cli(["serve", "select count(*) from t"])
+        self.assertEqual(out.getvalue(), "(0,)\n")
+
+
+class TestStartup(unittest.TestCase):
+    HEAVY = ("duckdb", "llm", "numpy", "pyarrow", "torch", "transformers")
+
+    def imported_by(self, code):
+        """Heavy packages imported by running ``code`` in a fresh interpreter."""
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"{code}\nimport sys\n"
+                f"print(sorted(m for m in {self.HEAVY!r} if m in sys.modules))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return out.splitlines()[-1]
+
+    def test_import_is_lazy(self):
+        self.assertEqual(self.imported_by("import tsellm.cli"), "[]")
+
+    def test_sqlite_query_is_lazy(self):
+        code = (
+            "from tsellm.cli import cli\n"
+            "try:\n"
+            "    cli([':memory:', 'select json_to_embedding(\\'[1]\\') is null'])\n"
+            "except SystemExit:\n"
+            "    pass"
+        )
+        self.assertEqual(self.imported_by(code), "[]")
+
+    def test_duckdb_console_imports_backend(self):
+        code = "from tsellm.cli import DuckDBConsole\nDuckDBConsole(':memory:')"
+        self.assertEqual(
+            self.imported_by(code), str(sorted(["duckdb", "numpy", "pyarrow"]))
+        )
+
+    def test_version_is_lazy(self):
+        # Importing DuckDB and the llm plugins eagerly makes cold starts
+        # several times slower; a wall-clock budget would be flaky instead.
+        code = (
+            "from tsellm.cli import cli\n"
+            "try:\n"
+            "    cli(['--version'])\n"
+            "except SystemExit:\n"
+            "    pass"
+        )
+        self.assertEqual(self.imported_by(code), "[]")
+
+
+class TestBenchmarks(unittest.TestCase):
+    def run_benchmarks(self, *args):
+        return subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", *args],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent.parent,
+        ).stdout
+
+    def test_run_and_compare(self):
+        results = Path(tempfile.mkdtemp()) / "results.json"
+        self.run_benchmarks(
+            "--rows", "20", "--udf", "prompt", "embed", "--output", str(results)
+        )
+        report = json.loads(results.read_text())
+        self.assertIn("duckdb", report["environment"])
+        self.assertEqual(
+            sorted((r["backend"], r["udf"]) for r in report["results"]),
+            [
+                ("duckdb", "embed"),
+                ("duckdb", "prompt"),
+                ("sqlite", "embed"),
+                ("sqlite", "prompt"),
+            ],
+        )
+        for r in report["results"]:
+            self.assertEqual(r["rows"], 20)
+            self.assertGreater(r["rows_per_sec"], 0)
+            self.assertLessEqual(r["p50_ms"], r["p99_ms"])
+            self.assertGreater(r["peak_rss_mb"], 0)
+
+        out = self.run_benchmarks("--compare", str(results), str(results))
+        self.assertEqual(out.count("+0.0%"), 8)
+
 
 class TsellmConsoleTest(unittest.TestCase):
     def setUp(self):
@@ -89,6 +1104,25 @@ class TsellmConsoleTest(unittest.TestCase):
         obj = TsellmConsole.create_console(d)
         self.assertIsInstance(obj, DuckDBConsole)
 
+    def test_console_factory_data_file(self):
+        fp = Path(tempfile.mkdtemp()) / "docs.parquet"
+        pq.write_table(pa.table({"t": ["hello world"]}), fp)
+        obj = TsellmConsole.create_console(fp)
+        self.assertIsInstance(obj, DuckDBConsole)
+        self.assertTrue(obj.is_in_memory)
+
+    def test_cli_data_files(self):
+        tmp = Path(tempfile.mkdtemp())
+        pq.write_table(pa.table({"t": ["hello world"]}), tmp / "my-docs.parquet")
+        (tmp / "extra.jsonl").write_text('{"n": 1}\n{"n": 2}\n')
+        out = self.expect_success(
+            "--view",
+            str(tmp / "extra.jsonl"),
+            str(tmp / "my-docs.parquet"),
+            "select t, sum(n) from my_docs, extra group by t",
+        )
+        self.assertEqual("('hello world', 3)\n", out)
+
     def test_cli_help(self):
         out = self.expect_success("-h")
         self.assertIn("usage: python -m tsellm", out)
@@ -97,6 +1131,13 @@ class TsellmConsoleTest(unittest.TestCase):
         out = self.expect_success("-v")
         self.assertIn(__version__, out)
 
+    def test_cli_startup_profile(self):
+        with captured_stderr() as err, self.assertRaises(SystemExit):
+            with captured_stdout():
+                cli(["--startup-profile", ":memory:", "select 1"])
+        for phase in ("parse arguments", "open database", "execute", "total"):
+            self.assertIn(phase, err.getvalue())
+
     def test_choose_db(self):
         self.expect_failure("--sqlite", "--duckdb")
 
@@ -229,6 +1270,218 @@ class InMemorySQLiteTest(TsellmConsoleTest):
             out,
         )
 
+    GROUPS = (
+        "(select 1 as g, 'hello world' as t union all select 1, 'good morning' "
+        "union all select 2, 'bye now') as v"
+    )
+
+    def test_prompt_agg(self):
+        out = self.expect_success(
+            *self.path_args,
+            f"select g, prompt_agg(t, 'Summarize', 'markov') from {self.GROUPS} "
+            "group by g order by g",
+        )
+        first, second = out.splitlines()
+        self.assertMarkovResult("hello world good morning", first)
+        self.assertMarkovResult("bye now", second)
+
+    def test_embed_mean(self):
+        out = self.expect_success(
+            *self.path_args,
+            f"select embed_mean(t, 'hazo') from {self.GROUPS} group by g order by g",
+        )
+        self.assertEqual(
+            "('[4.5, 6.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]',)\n"
+            "('[3.0, 3.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]',)\n",
+            out,
+        )
+
+    def test_chunk(self):
+        # One token a word, whether tiktoken counts them or not.
+        out = self.expect_success(
+            *self.path_args,
+            "select value from json_each(chunk('one two six ten', 3, 1))",
+        )
+        self.assertEqual("('one two six',)\n('six ten',)\n", out)
+
+    def test_embed_chunks(self):
+        out = self.expect_success(
+            *self.path_args,
+            "select count(*) from (select 'hello world' as t) "
+            "where embed_chunks(t, 'hazo') = embed(t, 'hazo') "
+            "and embed_chunks(t, 'hazo', 'max') = embed(t, 'hazo')",
+        )
+        self.assertEqual("(1,)\n", out)
+
+    def test_stream(self):
+        out, err = self.run_cli(
+            *self.path_args,
+            commands=(
+                ".stream on",
+                "select prompt('hello world', 'markov');",
+                ".stream",
+            ),
+        )
+        (response,) = re.findall(r"\('(.*)',\)", out)
+        self.assertIn(response + "\n", err)
+        self.assertIn("tsellm> on\n", out)
+
+    def streamed_responses(self):
+        """Responses of a two-row query with ``.stream on``, and those streamed."""
+        out, err = self.run_cli(
+            *self.path_args,
+            commands=(
+                ".stream on",
+                "select prompt(x, 'markov') from "
+                "(select 'hello' as x union all select 'world');",
+            ),
+        )
+        responses = re.findall(r"\('(.*)',\)", out)
+        return responses, [r for r in responses if r in err]
+
+    def test_stream_many_rows(self):
+        responses, streamed = self.streamed_responses()
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(streamed, [])
+
+    def test_stats(self):
+        out, _ = self.run_cli(
+            *self.path_args,
+            commands=(
+                "select embed('hello world', 'hazo');",
+                "select embed('hello', 'hazo');",
+                ".stats",
+                "select function, model, calls from tsellm_stats;",
+                ".stats reset",
+                "select count(*) from tsellm_stats;",
+            ),
+        )
+        self.assertIn("function\tmodel\tcalls\trows\t", out)
+        self.assertIn("embed\thazo\t2\t2\t0\t", out)
+        self.assertIn("('embed', 'hazo', 2)", out)
+        self.assertIn("(0,)", out)
+
+    def test_embed_blob(self):
+        out = self.expect_success(
+            *self.path_args,
+            "select embedding_to_json(embed_blob('hello world', 'hazo'))",
+        )
+        self.assertEqual(
+            "('[5.0, 5.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]',)\n",
+            out,
+        )
+
+    def test_embedding_json_roundtrip(self):
+        out = self.expect_success(
+            *self.path_args, "select embedding_to_json(json_to_embedding('[1.5, 2]'))"
+        )
+        self.assertEqual("('[1.5, 2.0]',)\n", out)
+
+    def test_embed_blob_is_float32(self):
+        out = self.expect_success(
+            *self.path_args, "select length(embed_blob('hello world', 'hazo'))"
+        )
+        self.assertEqual("(64,)\n", out)
+
+    def test_similarity_functions(self):
+        out = self.expect_success(
+            *self.path_args,
+            "select dot_product('[1,2]', '[3,4]'), l2_distance('[0,0]', '[3,4]'), "
+            "cosine_similarity('[3,4]', '[6,8]'), cosine_similarity('[0,0]', '[1,1]')",
+        )
+        self.assertEqual("(11.0, 5.0, 1.0, None)\n", out)
+
+    def test_quantize(self):
+        out = self.expect_success(
+            *self.path_args,
+            "select hex(quantize_binary('[1, -1, 1, -1, 1, -1, 1, -1, 1]')), "
+            "hamming_distance(quantize_binary('[1, -1]'), quantize_binary('[-1, 1]')), "
+            "round(int8_dot(quantize_int8('[1, 2]'), quantize_int8('[3, 4]')), 1)",
+        )
+        self.assertEqual("('AA80', 2, 11.0)\n", out)
+
+    def test_reduce(self):
+        out, err = self.run_cli(
+            *self.path_args,
+            commands=(
+                "create table t(v text);",
+                "insert into t values ('[1, 0, 0]'), ('[0, 2, 0]'), ('[1, 1, 3]');",
+                ".reduce create r t v 2",
+                ".reduce create rp t v 2 random",
+                ".reduce drop rp",
+                ".reduce",
+                ".reduce bench t v 1",
+                "select count(embed_reduce(v, 'r')) from t;",
+            ),
+        )
+        self.assertIn("r\tpca\t3->2\n", out)
+        self.assertNotIn("rp\t", out)
+        self.assertIn("int8\t7\t1.000\t", out)
+        self.assertIn("(3,)\n", out)
+
+    def test_similarity_ranking(self):
+        out = self.expect_success(
+            *self.path_args,
+            "select x from (select 'a' as x union all select 'hello world' "
+            "union all select 'hello') "
+            "order by cosine_similarity(embed('hello world', 'hazo'), embed(x, 'hazo')) desc "
+            "limit 1",
+        )
+        self.assertEqual("('hello world',)\n", out)
+
+    def test_output_csv(self):
+        out = self.expect_success(
+            "--output", "csv", *self.path_args, "select 1 as a, 'x,y' as b"
+        )
+        self.assertEqual('a,b\n1,"x,y"\n', out)
+
+    def test_output_jsonl(self):
+        out = self.expect_success(
+            "--output", "jsonl", *self.path_args, "select 1 as a, 'x' as b"
+        )
+        self.assertEqual('{"a": 1, "b": "x"}\n', out)
+
+    def test_output_parquet_file(self):
+        fp = new_tempfile()
+        out = self.expect_success(
+            "--output",
+            "parquet",
+            "--output-file",
+            str(fp),
+            *self.path_args,
+            "with recursive n(i) as (select 1 union all select i + 1 from n where i < 5000) "
+            "select i from n",
+        )
+        self.assertEqual("", out)
+        table = pq.read_table(fp)
+        self.assertEqual(table.num_rows, 5000)
+        self.assertEqual(table.column("i").to_pylist()[-1], 5000)
+
+    def test_output_parquet_late_types(self):
+        fp = new_tempfile()
+        self.expect_success(
+            "--output", "parquet", "--output-file", str(fp), *self.path_args,
+            "with recursive n(i) as (select 1 union all select i + 1 from n where i < 3000) "
+            "select case when i > 2000 then 'x' end as s, "
+            "case when i > 2000 then i / 2.0 else i end as v from n",
+        )  # fmt: skip
+        table = pq.read_table(fp)
+        self.assertEqual(str(table.schema.field("s").type), "string")
+        self.assertEqual(str(table.schema.field("v").type), "double")
+        self.assertEqual(table.column("v").to_pylist()[-1], 1500.0)
+
+    def test_prefetch(self):
+        out = self.expect_success(
+            "--prefetch", *self.path_args, "select embed('hello world', 'hazo')"
+        )
+        self.assertIn("5.0, 5.0", out)
+
+    def test_preload(self):
+        out = self.expect_success(
+            "--preload", "hazo", *self.path_args, "select embed('hello world', 'hazo')"
+        )
+        self.assertIn("5.0, 5.0", out)
+
     def test_embed_hazo_binary(self):
         self.assertTrue(llm.get_embedding_model("hazo").supports_binary)
         self.expect_success(*self.path_args, "select embed(randomblob(16), 'hazo')")
@@ -294,6 +1547,131 @@ class DiskSQLiteTest(InMemorySQLiteTest):
         super().test_embed_default_hazo()
         self.assertTrue(DBSniffer(self.db_fp).is_sqlite)
 
+    def assertPromptCached(self, connect):
+        sql = "select prompt('hello world how are you', 'markov')"
+        first = self.expect_success(*self.path_args, sql)
+        for _ in range(3):
+            self.assertEqual(first, self.expect_success(*self.path_args, sql))
+        con = connect(self.db_fp)
+        self.assertEqual(
+            con.execute("select model from __tsellm_cache").fetchall(), [("markov",)]
+        )
+        con.close()
+
+    def test_prompt_cache(self):
+        self.assertPromptCached(sqlite3.connect)
+
+    def test_save_stats(self):
+        sql = "select prompt('hello world', 'markov')"
+        for _ in range(2):
+            self.expect_success("--save-stats", *self.path_args, sql)
+        con = sqlite3.connect(self.db_fp)
+        (row,) = read_config(con)["stats"]
+        con.close()
+        self.assertEqual(
+            (row["function"], row["model"], row["calls"]), ("prompt", "markov", 2)
+        )
+
+    def assertWorkersMatch(self, sql):
+        # Workers are spawned: only load the plugin the test needs.
+        with mock.patch.dict(os.environ, {"LLM_LOAD_PLUGINS": "llm-embed-hazo"}):
+            self.assertEqual(
+                self.expect_success(*self.path_args, sql),
+                self.expect_success("--workers", "2", *self.path_args, sql),
+            )
+
+    def test_workers(self):
+        self.expect_success(
+            *self.path_args,
+            "insert into my with recursive r(i) as "
+            "(select 1 union all select i + 1 from r where i < 50) "
+            "select 'row ' || i from r",
+        )
+        self.assertWorkersMatch("select x, embed(x, 'hazo') from my")
+
+    def assertEnrichResumes(self, connect):
+        self.expect_success(
+            *self.path_args,
+            "insert into my with recursive r(i) as "
+            "(select 1 union all select i + 1 from r where i < 10) "
+            "select 'row ' || i from r",
+        )
+        write = Enrichment._write
+        batches = []
+
+        def killed_after_two_batches(enrichment, rows, values):
+            if len(batches) == 2:
+                raise KeyboardInterrupt
+            batches.append(rows)
+            return write(enrichment, rows, values)
+
+        console = TsellmConsole.create_console(self.db_fp)
+        enrichment = Enrichment(console, "my", "x", "e", "embed", "hazo", 3)
+        with (
+            mock.patch.object(Enrichment, "_write", killed_after_two_batches),
+            self.assertRaises(KeyboardInterrupt),
+        ):
+            enrichment.run(progress=sys.stdout)
+        console.connection.close()
+
+        con = connect(self.db_fp)
+        self.assertEqual(con.execute("select count(e) from my").fetchall(), [(6,)])
+        self.assertEqual(read_config(con)["enrich"]["my.e"]["rows"], 6)
+        con.close()
+
+        self.expect_success(
+            "enrich", self.db_fp, "my", "--input", "x", "--output", "e",
+            "--fn", "embed", "--model", "hazo", "--batch-size", "3",
+        )  # fmt: skip
+        con = connect(self.db_fp)
+        self.assertNotIn("enrich", read_config(con))
+        con.close()
+        filled = "select count(*) from my where e = embed(x, 'hazo')"
+        self.assertEqual(self.expect_success(*self.path_args, filled), "(10,)\n")
+
+        # A finished job leaves no checkpoint behind to skip cleared rows.
+        self.expect_success(*self.path_args, "update my set e = null")
+        self.expect_success(
+            "enrich", self.db_fp, "my", "--input", "x", "--output", "e",
+            "--fn", "embed", "--model", "hazo", "--batch-size", "3",
+        )  # fmt: skip
+        self.assertEqual(self.expect_success(*self.path_args, filled), "(10,)\n")
+
+    def test_enrich(self):
+        self.assertEnrichResumes(sqlite3.connect)
+
+    def test_limit_dot_command(self):
+        out, _ = self.run_cli(
+            *self.path_args,
+            commands=(".limit markov rpm 600", ".limit markov retries 2", ".limit"),
+        )
+        self.assertIn("markov\t600\t\t2\t", out)
+        out, _ = self.run_cli(
+            "--limit", "hazo", "tpm", "1000", *self.path_args, commands=(".limit",)
+        )
+        self.assertIn("markov\t600\t\t2\t", out)
+        self.assertIn("hazo\t\t1000\t5\t", out)
+        con = sqlite3.connect(self.db_fp)
+        self.assertEqual(
+            read_config(con)["limits"], {"markov": {"rpm": 600, "retries": 2}}
+        )
+        con.close()
+        out = self.expect_success(
+            *self.path_args, "select prompt('hello world', 'markov') is not null"
+        )
+        self.assertEqual("(1,)\n", out)
+
+    def test_cache_dot_command(self):
+        self.expect_success(*self.path_args, "select prompt('hello world', 'markov')")
+        out, _ = self.run_cli(
+            *self.path_args,
+            commands=(".cache", ".cache max_entries 5", ".cache clear", ".cache"),
+        )
+        self.assertIn("markov\t1\n", out)
+        self.assertIn("entries=1 ", out)
+        self.assertIn("entries=0 ", out)
+        self.assertIn("max_entries=5 ", out)
+
 
 class InMemoryDuckDBTest(InMemorySQLiteTest):
     def setUp(self):
@@ -303,6 +1681,67 @@ class InMemoryDuckDBTest(InMemorySQLiteTest):
             ":memory:",
         )
 
+    def test_stream_many_rows(self):
+        # Each row is a chunk of its own here, and only the first may stream.
+        responses, streamed = self.streamed_responses()
+        self.assertEqual(len(responses), 2)
+        self.assertLessEqual(len(streamed), 1)
+
+    def test_embed_hazo(self):
+        out = self.expect_success(
+            *self.path_args, "select embed('hello world', 'hazo')"
+        )
+        self.assertEqual(
+            "([5.0, 5.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],)\n",
+            out,
+        )
+
+    def test_embed_mean(self):
+        out = self.expect_success(
+            *self.path_args,
+            f"select embed_mean(t, 'hazo') from {self.GROUPS} group by g order by g",
+        )
+        self.assertEqual(
+            "([4.5, 6.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],)\n"
+            "([3.0, 3.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],)\n",
+            out,
+        )
+
+    def test_embed_blob_is_float32(self):
+        out = self.expect_success(
+            *self.path_args,
+            "select embed_blob('hello world', 'hazo')::FLOAT[16] is not null",
+        )
+        self.assertEqual("(True,)\n", out)
+
+    def test_chunk(self):
+        # One token a word, whether tiktoken counts them or not.
+        out = self.expect_success(
+            *self.path_args, "select unnest(chunk('one two six ten', 3, 1))"
+        )
+        self.assertEqual("('one two six',)\n('six ten',)\n", out)
+
+    def test_side_effects(self):
+        out, _ = self.run_cli(
+            *self.path_args,
+            commands=(
+                "select count(embed('a', 'hazo')) from range(100);",
+                ".cache off",
+                "select count(prompt('a b', 'markov')) from range(3);",
+                "select function, rows from tsellm_stats;",
+            ),
+        )
+        # Embeddings are folded into a single call; uncached prompts are not.
+        self.assertIn("('embed', 1)", out)
+        self.assertIn("('prompt', 3)", out)
+
+    def test_embed_is_float_list(self):
+        out = self.expect_success(
+            *self.path_args,
+            "select typeof(embed(x, 'hazo')) from (values ('a'), ('a'), (null)) t(x)",
+        )
+        self.assertEqual("('FLOAT[]',)\n" * 3, out)
+
     def test_duckdb_execute(self):
         out = self.expect_success(*self.path_args, "select 'Hello World!'")
         self.assertIn("('Hello World!',)", out)
@@ -366,6 +1805,43 @@ class DiskDuckDBTest(InMemoryDuckDBTest):
         # https://github.com/Florents-Tselai/tsellm/issues/28
         super().test_cli_execute_sql()
 
+    def test_prompt_cache(self):
+        DiskSQLiteTest.assertPromptCached(self, lambda fp: duckdb.connect(fp))
+
+    assertWorkersMatch = DiskSQLiteTest.assertWorkersMatch
+
+    def test_workers(self):
+        self.assertWorkersMatch(
+            "select i, embed('row ' || i, 'hazo') from range(3000) t(i) order by i"
+        )
+
+    def test_enrich(self):
+        DiskSQLiteTest.assertEnrichResumes(self, lambda fp: duckdb.connect(fp))
+
+    def test_enrich_stalled_batch(self):
+        self.expect_success(*self.path_args, "insert into my values ('a')")
+        console = TsellmConsole.create_console(self.db_fp)
+        self.addCleanup(console.connection.close)
+        enrichment = Enrichment(console, "my", "x", "e", "embed", "hazo")
+        with (
+            mock.patch.object(Enrichment, "_write", return_value=0),
+            self.assertRaisesRegex(RuntimeError, "a batch updated no rows"),
+        ):
+            enrichment.run(progress=sys.stdout)
+
+    def test_concurrency_dot_command(self):
+        out, _ = self.run_cli(
+            *self.path_args, commands=(".concurrency markov 2", ".concurrency")
+        )
+        self.assertIn("markov\t2\n", out)
+        out, _ = self.run_cli(*self.path_args, commands=(".concurrency",))
+        self.assertIn("markov\t2\n", out)
+        out = self.expect_success(
+            *self.path_args,
+            "select count(prompt(x::varchar, 'markov')) from range(4) t(x)",
+        )
+        self.assertEqual("(4,)\n", out)
+
 
 if __name__ == "__main__":
     unittest.main()
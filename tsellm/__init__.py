@@ -0,0 +1,6 @@
+import sys
+import time
+
+# Read by ``tsellm --startup-profile`` to time the import of the CLI.
+_IMPORT_STARTED = time.perf_counter()
+_MODULES_BEFORE_IMPORT = frozenset(sys.modules)
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import sys
+import threading
+import time
+
+TSELLM_CACHE_SQL = """
+-- tsellm prompt-response cache
+-- entries are keyed by model id and a hash of the prompt.
+
+CREATE TABLE IF NOT EXISTS __tsellm_cache (
+model text,
+key text,
+response text,
+created double,
+PRIMARY KEY (model, key)
+);
+
+"""
+
+# Unbounded unless configured: a re-run hits every response it cached.
+DEFAULT_MAX_ENTRIES = None
+
+
+class PromptCache:
+    """Prompt responses persisted in ``__tsellm_cache``.
+
+    The whole table is read into memory when the console loads,
+    so a cached call costs a dictionary lookup.
+    New responses are buffered and written back by ``flush``,
+    which runs after each statement, because DuckDB
+    cannot be queried from within one of its own UDFs.
+    Consoles on other threads may share one cache.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_age=None, enabled=True):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.enabled = enabled
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt) -> str:
+        # Empty options keep the keys of caches written when prompts had them.
+        payload = json.dumps(
+            {"prompt": prompt, "options": {}}, sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, model: str, prompt):
+        """Return the cached response for ``prompt``, or None on a miss."""
+        if not self.enabled:
+            return None
+        k = (model, self.key(prompt))
+        with self._lock:
+            entry = self.entries.get(k)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def store(self, model: str, prompt, response):
+        if not self.enabled:
+            return
+        k = (model, self.key(prompt))
+        with self._lock:
+            self.entries[k] = self.pending[k] = (response, time.time())
+
+    def prompt(self, model: str, prompt, compute):
+        """Return the cached response for ``prompt``, calling ``compute`` on a miss."""
+        response = self.lookup(model, prompt)
+        if response is None:
+            response = compute()
+            self.store(model, prompt, response)
+        return response
+
+    def _expired_before(self):
+        return None if self.max_age is None else time.time() - self.max_age
+
+    def load(self, con):
+        for model, key, response, created in con.execute(
+            "SELECT model, key, response, created FROM __tsellm_cache"
+        ).fetchall():
+            self.entries[(model, key)] = (response, created)
+        self.evict(con)
+
+    def evict(self, con):
+        """Drop entries older than ``max_age``, then the oldest beyond ``max_entries``."""
+        expired = self._expired_before()
+        stale = (
+            [k for k, (_, created) in self.entries.items() if created < expired]
+            if expired is not None
+            else []
+        )
+        overflow = (
+            0
+            if self.max_entries is None
+            else len(self.entries) - len(stale) - self.max_entries
+        )
+        if overflow > 0:
+            fresh = sorted(
+                (created, k)
+                for k, (_, created) in self.entries.items()
+                if expired is None or created >= expired
+            )
+            stale.extend(k for _, k in fresh[:overflow])
+        if not stale:
+            return
+        for k in stale:
+            del self.entries[k]
+            self.pending.pop(k, None)
+        _executemany(
+            con,
+            "DELETE FROM __tsellm_cache WHERE model = ? AND key = ?",
+            "DELETE FROM __tsellm_cache "
+            "WHERE (model, key) IN (SELECT model, key FROM __tsellm_rows)",
+            ("model", "key"),
+            stale,
+        )
+
+    def flush(self, con):
+        """Persist buffered responses and apply eviction.
+
+        The writes join the transaction open on ``con``, if any, or run in
+        their own. If they fail, they are rolled back and retried after the
+        next statement: a cache write never fails the statement itself.
+        """
+        with self._lock:
+            if self.pending:
+                self._write(con)
+
+    def _write(self, con):
+        pending, self.pending = self.pending, {}
+        own_transaction = False
+        try:
+            own_transaction = not _in_transaction(con)
+            if own_transaction:
+                con.execute("BEGIN TRANSACTION")
+            _executemany(
+                con,
+                "INSERT OR REPLACE INTO __tsellm_cache (model, key, response, created) "
+                "VALUES (?, ?, ?, ?)",
+                "INSERT OR REPLACE INTO __tsellm_cache (model, key, response, created) "
+                "SELECT model, key, response, created FROM __tsellm_rows",
+                ("model", "key", "response", "created"),
+                [
+                    (model, key, r, created)
+                    for (model, key), (r, created) in pending.items()
+                ],
+            )
+            self.evict(con)
+            if own_transaction:
+                con.execute("COMMIT")
+        except Exception as e:
+            if own_transaction:
+                _rollback(con)
+            self.pending = {
+                **{k: v for k, v in pending.items() if k in self.entries},
+                **self.pending,
+            }
+            print(f"Could not write the prompt cache: {e}", file=sys.stderr)
+
+    def clear(self, con, model=None):
+        if model is None:
+            con.execute("DELETE FROM __tsellm_cache")
+            self.entries.clear()
+            self.pending.clear()
+        else:
+            con.execute("DELETE FROM __tsellm_cache WHERE model = ?", [model])
+            for store in (self.entries, self.pending):
+                for k in [k for k in store if k[0] == model]:
+                    del store[k]
+
+    def stats(self) -> dict:
+        """Number of cached entries per model."""
+        counts = {}
+        for model, _ in self.entries:
+            counts[model] = counts.get(model, 0) + 1
+        return counts
+
+
+def _in_transaction(con) -> bool:
+    """Whether a transaction is open on ``con``.
+
+    DuckDB does not say, but outside a transaction each statement
+    runs in one of its own, so two in a row get different ids.
+    """
+    if hasattr(con, "in_transaction"):
+        return con.in_transaction
+    sql = "SELECT current_transaction_id()"
+    return con.execute(sql).fetchone() == con.execute(sql).fetchone()
+
+
+def _rollback(con):
+    try:
+        con.execute("ROLLBACK")
+    except Exception:
+        pass
+
+
+def _executemany(con, sql, bulk_sql, columns, rows):
+    """Run ``sql`` for each of ``rows``.
+
+    DuckDB executes ``executemany`` one statement at a time,
+    so there ``rows`` are exposed as the Arrow view ``__tsellm_rows``
+    and ``bulk_sql`` processes them in one set-based statement instead.
+    """
+    if not hasattr(con, "register"):
+        con.executemany(sql, rows)
+        return
+    import pyarrow as pa
+
+    con.register(
+        "__tsellm_rows",
+        pa.table({c: list(values) for c, values in zip(columns, zip(*rows))}),
+    )
+    try:
+        con.execute(bulk_sql)
+    finally:
+        con.unregister("__tsellm_rows")
@@ -0,0 +1,80 @@
+"""Splitting long texts into pieces that fit a model's context.
+
+Sizes are in tokens, counted with tiktoken's ``cl100k_base`` encoding where
+tiktoken is installed and its vocabulary can be loaded, and otherwise
+estimated like the scheduler's budgets, at four characters each. Texts are
+split between words where possible, and words too long for one piece are cut.
+"""
+
+import json
+import re
+from bisect import bisect_right
+from collections import deque
+from functools import lru_cache
+
+# Tokens per piece ``embed_chunks`` embeds, unless ``.limit MODEL context N`` says so.
+DEFAULT_CHUNK_SIZE = 256
+
+
+def chunks(text: str, size: int, overlap: int = 0):
+    """Yield pieces of ``text`` of at most ``size`` tokens, in order.
+
+    Each piece repeats up to ``overlap`` tokens from the end of the one
+    before it. Words are found by scanning ``text``, and each piece is
+    sliced from it once, so long texts are not copied word by word.
+    """
+    if size < 1 or not 0 <= overlap < size:
+        raise ValueError("chunk size must be positive and overlap in [0, size)")
+    window = deque()  # (start, end, tokens) of the words of the current piece
+    used = 0
+    for start, end, tokens in _words(text, size):
+        if window and used + tokens > size:
+            yield text[window[0][0] : window[-1][1]]
+            while window and (used > overlap or used + tokens > size):
+                used -= window.popleft()[2]
+        window.append((start, end, tokens))
+        used += tokens
+    if window:
+        yield text[window[0][0] : window[-1][1]]
+
+
+@lru_cache(maxsize=None)
+def _encoding():
+    """tiktoken's ``cl100k_base`` encoding, or None to estimate token counts."""
+    try:
+        import tiktoken
+
+        # The vocabulary is downloaded on first use, which may fail offline.
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def _words(text: str, size: int):
+    """Yield ``(start, end, tokens)`` for the words of ``text``, cut to ``size`` tokens."""
+    encoding = _encoding()
+    if encoding is None:
+        # A word of n characters counts n // 4 + 1 tokens, like ``estimate_tokens``.
+        for match in re.finditer(r"\S{1,%d}" % (4 * size - 1), text):
+            yield match.start(), match.end(), (match.end() - match.start()) // 4 + 1
+        return
+    # The text is encoded once; a word counts the tokens that end within it,
+    # including the space most of its first tokens start with.
+    _, offsets = encoding.decode_with_offsets(encoding.encode_ordinary(text))
+    ends = offsets[1:] + [len(text)]
+    for match in re.finditer(r"\S+", text):
+        start, first = match.start(), bisect_right(ends, match.start())
+        last = bisect_right(ends, match.end())
+        for cut in range(first + size, last, size):
+            if ends[cut - 1] > start:
+                yield start, ends[cut - 1], cut - first
+                start, first = ends[cut - 1], cut
+        yield start, match.end(), max(1, last - first)
+
+
+def _chunk(text: str, size: int, overlap: int = 0) -> str:
+    return json.dumps(list(chunks(text, size, overlap)))
+
+
+def _chunk_list(text: str, size: int, overlap: int) -> list:
+    return list(chunks(text, size, overlap))
@@ -1,32 +1,87 @@
+from __future__ import annotations
+
+import json
+import re
 import sqlite3
 import sys
+import tempfile
 from abc import ABC, abstractmethod
 from argparse import ArgumentParser
 from code import InteractiveConsole
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from enum import Enum, auto
+from functools import cached_property
 from pathlib import Path
 from textwrap import dedent
-from typing import Union
+from typing import TYPE_CHECKING, ClassVar, Union
 
-import duckdb
+import tsellm
 
 from . import __version__
+from .cache import TSELLM_CACHE_SQL, PromptCache
+from .engine import Engine
+from .functions import (
+    DUCKDB_FUNCTIONS,
+    SQLITE_AGGREGATES,
+    SQLITE_FUNCTIONS,
+    register_duckdb,
+    register_sqlite,
+)
+from .index import IndexCatalog
+from .models import registry
+from .output import FORMATS, write_result, write_rows
+from .prefetch import BATCHED, Prefetch
+from .reducers import ReducerCatalog
+from .scheduler import LIMITS, Scheduler
+from .startup import StartupProfile
+from .stats import COLUMNS as STATS_COLUMNS, SQLITE_STATS_VIEW, UDFStats
 from .core import (
-    _prompt_model,
-    _prompt_model_default,
-    _embed_model,
-    _json_embed_model,
-    _embed_model_default,
+    DEFAULT_CONCURRENCY,
+    FirstCallStream,
+    read_config,
+    write_config,
+    _bind,
 )
 
+# DuckDB, PyArrow, NumPy and llm (with its plugins) are imported on first use:
+# a DuckDB console imports tsellm.vectorized when it opens,
+# and the SQLite UDFs import what they need when first called.
+if TYPE_CHECKING:
+    import duckdb
+
 
 class DatabaseType(Enum):
     SQLITE = auto()
     DUCKDB = auto()
     IN_MEMORY = auto()
     UNKNOWN = auto()
+    PARQUET = auto()
+    CSV = auto()
+    JSONL = auto()
+
 
+# DuckDB table functions that expose a data file as a view.
+DATA_FILE_READERS = {
+    DatabaseType.PARQUET: "read_parquet",
+    DatabaseType.CSV: "read_csv_auto",
+    DatabaseType.JSONL: "read_json_auto",
+}
+
+
+# SQLite functions the prefetch records, and those of them whose calls stream.
+PREFETCHED = [udf for udf in SQLITE_FUNCTIONS if udf.sqlite in BATCHED]
+STREAMED = [udf for udf in PREFETCHED if udf.name == "prompt"]
+
+# String literals, quoted identifiers and comments, which call no function.
+_SQL_LITERALS = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/", re.S
+)
+
+REDUCE_USAGE = (
+    ".reduce [create NAME TABLE COLUMN DIM [pca | random] "
+    "| drop NAME | bench TABLE COLUMN [K]]"
+)
 
 sys.ps1 = "tsellm> "
 sys.ps2 = "    ... "
@@ -34,22 +89,39 @@ sys.ps2 = "    ... "
 
 @dataclass
 class DBSniffer:
+    """Detects the type of a database or data file from its first bytes.
+
+    Detection never opens a database connection and runs once per sniffer.
+    Further file types can be added with ``DBSniffer.register``.
+    """
+
     fp: Union[str, Path]
 
-    def sniff(self) -> DatabaseType:
+    # (type, predicate) pairs, tried in order; each predicate
+    # receives the file's path and its first 16 bytes.
+    detectors: ClassVar[list] = []
+
+    @classmethod
+    def register(cls, db_type: DatabaseType, matches):
+        cls.detectors.append((db_type, matches))
+
+    @cached_property
+    def db_type(self) -> DatabaseType:
         if self.is_in_memory:
             return DatabaseType.IN_MEMORY
-        with open(self.fp, "rb") as f:
-            header = f.read(16)
-            if header.startswith(b"SQLite format 3"):
-                return DatabaseType.SQLITE
+        path = Path(self.fp)
+        try:
+            with open(path, "rb") as f:
+                header = f.read(16)
+        except OSError:
+            header = b""
+        for db_type, matches in self.detectors:
+            if matches(path, header):
+                return db_type
+        return DatabaseType.UNKNOWN
 
-            try:
-                con = duckdb.connect(str(self.fp))
-                con.sql("SELECT 1")
-                return DatabaseType.DUCKDB
-            except:
-                return DatabaseType.UNKNOWN
+    def sniff(self) -> DatabaseType:
+        return self.db_type
 
     @property
     def is_duckdb(self) -> bool:
@@ -59,11 +131,43 @@ class DBSniffer:
     def is_sqlite(self) -> bool:
         return self.sniff() == DatabaseType.SQLITE
 
+    @property
+    def is_data_file(self) -> bool:
+        return self.sniff() in DATA_FILE_READERS
+
     @property
     def is_in_memory(self) -> bool:
         return self.fp == ":memory:"
 
 
+DBSniffer.register(
+    DatabaseType.SQLITE, lambda path, header: header.startswith(b"SQLite format 3\0")
+)
+DBSniffer.register(
+    DatabaseType.DUCKDB,
+    lambda path, header: header[8:12] == b"DUCK"
+    or (not header and path.suffix in (".duckdb", ".ddb")),
+)
+DBSniffer.register(
+    DatabaseType.PARQUET, lambda path, header: header.startswith(b"PAR1")
+)
+DBSniffer.register(
+    DatabaseType.CSV, lambda path, header: path.suffix in (".csv", ".tsv")
+)
+DBSniffer.register(
+    DatabaseType.JSONL,
+    lambda path, header: path.suffix in (".jsonl", ".ndjson", ".json"),
+)
+
+
+def _format_stat(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
 class TsellmConsole(InteractiveConsole, ABC):
     _TSELLM_CONFIG_SQL = """
 -- tsellm configuration table
@@ -75,15 +179,18 @@ x text
 
 """
 
-    _functions = [
-        ("prompt", 2, _prompt_model, False),
-        ("prompt", 1, _prompt_model_default, False),
-        ("embed", 2, _embed_model, False),
-        ("embed", 1, _embed_model_default, False),
-        ("json_embed", 2, _json_embed_model, False),
-    ]
-
     error_class = None
+    cache: PromptCache = None
+    concurrency: dict = None
+    scheduler: Scheduler = None
+    prefetch: bool = False
+    stream: bool = False
+    indexes: IndexCatalog = None
+    reducers: ReducerCatalog = None
+    stats: UDFStats = None
+    output_format: str = "tuple"
+    output_stream = None
+    _index_dir: Path = None
     db_type: str = field(init=False)
     connection: Union[sqlite3.Connection, duckdb.DuckDBPyConnection] = field(init=False)
 
@@ -93,9 +200,9 @@ x text
     ):
         sniffer = DBSniffer(fp)
         if sniffer.is_in_memory:
-            if sniffer.is_duckdb:
+            if in_memory_type == DatabaseType.DUCKDB:
                 return DuckDBConsole(fp)
-            elif sniffer.is_sqlite:
+            elif in_memory_type == DatabaseType.SQLITE:
                 return SQLiteConsole(fp)
             else:
                 raise ValueError(
@@ -104,6 +211,8 @@ x text
 
         if sniffer.is_duckdb:
             return DuckDBConsole(fp)
+        elif sniffer.is_data_file:
+            return DuckDBConsole(":memory:", views=[fp])
         elif sniffer.is_sqlite:
             return SQLiteConsole(fp)
         else:
@@ -169,15 +278,318 @@ x text
             ]
         )
 
-    def load(self):
+    def load_config(self):
         self.execute(self._TSELLM_CONFIG_SQL)
-        for func_name, n_args, py_func, deterministic in self._functions:
-            self.connection.create_function(func_name, n_args, py_func)
+        self.execute(TSELLM_CACHE_SQL)
+        config = read_config(self.connection)
+        self.concurrency = config.get("concurrency", {})
+        self.scheduler = Scheduler(
+            config.get("limits", {}), self.concurrency, engine=Engine()
+        )
+        self.indexes = IndexCatalog(config)
+        self.reducers = ReducerCatalog(config)
+        self.cache = PromptCache(**config.get("cache", {}))
+        self.cache.load(self.connection)
+        self.stats = UDFStats()
+
+    def flush_cache(self):
+        if self.cache is not None:
+            self.cache.flush(self.connection)
+
+    def load(self):
+        self.load_config()
+        self.register_functions()
+
+    def register_functions(self, wrap=lambda py_func, bound: bound, measure=True):
+        """(Re-)register ``_functions``, optionally wrapping each bound UDF.
+
+        Unless ``measure`` is False, each call is counted in ``stats``.
+        """
+        for udf in SQLITE_FUNCTIONS:
+            func = wrap(
+                udf.sqlite,
+                _bind(
+                    udf.sqlite,
+                    cache=self.cache,
+                    indexes=self.indexes,
+                    reducers=self.reducers,
+                    stats=self.stats,
+                    scheduler=self.scheduler,
+                ),
+            )
+            if measure:
+                func = self.stats.wrap(udf.name, udf.sqlite, func)
+            register_sqlite(self.connection, udf, func)
+        self.connection.create_function("tsellm_stats", 0, self.stats.to_json)
+
+    def cache_command(self, args):
+        """Handle ``.cache [clear [MODEL] | on | off | max_entries N | max_age SECONDS]``."""
+        match args:
+            case []:
+                for model, n in sorted(self.cache.stats().items()):
+                    print(f"{model}\t{n}")
+                print(
+                    f"entries={len(self.cache.entries)} hits={self.cache.hits} "
+                    f"misses={self.cache.misses} enabled={self.cache.enabled} "
+                    f"max_entries={self.cache.max_entries} max_age={self.cache.max_age}"
+                )
+            case ["clear"]:
+                self.cache.clear(self.connection)
+            case ["clear", model]:
+                self.cache.clear(self.connection, model)
+            case ["on" | "off" as state]:
+                self.cache.enabled = state == "on"
+                self.save_cache_settings()
+            case ["max_entries", n]:
+                self.cache.max_entries = None if n == "none" else int(n)
+                self.save_cache_settings()
+            case ["max_age", seconds]:
+                self.cache.max_age = None if seconds == "none" else float(seconds)
+                self.save_cache_settings()
+            case _:
+                print(
+                    "Usage: .cache [clear [MODEL] | on | off | max_entries N | max_age SECONDS]",
+                    file=sys.stderr,
+                )
+
+    def concurrency_command(self, args):
+        """Handle ``.concurrency [MODEL N]``."""
+        match args:
+            case []:
+                for model, n in sorted(self.concurrency.items()):
+                    print(f"{model}\t{n}")
+                print(f"default\t{DEFAULT_CONCURRENCY}")
+            case [model, n]:
+                self.concurrency[model] = int(n)
+                write_config(self.connection, "concurrency", self.concurrency)
+            case _:
+                print("Usage: .concurrency [MODEL N]", file=sys.stderr)
+
+    def limit_command(self, args):
+        """Handle ``.limit [MODEL rpm|tpm|retries|context N|off]``."""
+        match args:
+            case []:
+                print(
+                    "model\trpm\ttpm\tretries\tcontext\tconcurrency\tthrottled\tretried"
+                )
+                for row in self.scheduler.rows():
+                    print("\t".join("" if v is None else str(v) for v in row))
+            case [model, name, value] if name in LIMITS and (
+                value == "off" or value.isdigit()
+            ):
+                value = None if value == "off" else int(value)
+                self.scheduler.configure(model, **{name: value})
+                # Only what was set here is stored, not the --limit flags.
+                limits = read_config(self.connection).get("limits", {})
+                settings = limits.setdefault(model, {})
+                settings[name] = value
+                limits[model] = {k: v for k, v in settings.items() if v is not None}
+                write_config(
+                    self.connection, "limits", {m: s for m, s in limits.items() if s}
+                )
+            case _:
+                print(
+                    "Usage: .limit [MODEL rpm|tpm|retries|context N|off]",
+                    file=sys.stderr,
+                )
+
+    def stats_command(self, args):
+        """Handle ``.stats [reset | save]``."""
+        match args:
+            case []:
+                print("\t".join(STATS_COLUMNS))
+                for row in self.stats.rows():
+                    print("\t".join(_format_stat(row[c]) for c in STATS_COLUMNS))
+            case ["reset"]:
+                self.stats.reset()
+            case ["save"]:
+                self.save_stats()
+            case _:
+                print("Usage: .stats [reset | save]", file=sys.stderr)
+
+    def save_stats(self):
+        """Add the counters to the totals kept in ``__tsellm``, then reset them."""
+        totals = UDFStats()
+        totals.merge(read_config(self.connection).get("stats"))
+        totals.merge(self.stats.snapshot())
+        write_config(self.connection, "stats", totals.snapshot())
+        self.stats.reset()
+
+    def prefetch_command(self, args):
+        """Handle ``.prefetch [on | off]``."""
+        match args:
+            case []:
+                print("on" if self.prefetch else "off")
+            case ["on" | "off" as state]:
+                self.prefetch = state == "on"
+            case _:
+                print("Usage: .prefetch [on | off]", file=sys.stderr)
+
+    @property
+    def stream_output(self):
+        """Where prompt responses are streamed to as they are generated, if anywhere."""
+        return sys.stderr if self.stream else None
+
+    def stream_command(self, args):
+        """Handle ``.stream [on | off]``."""
+        match args:
+            case []:
+                print("on" if self.stream else "off")
+            case ["on" | "off" as state]:
+                self.stream = state == "on"
+                # DuckDB binds the stream into its batched prompt functions.
+                self.register_functions()
+            case _:
+                print("Usage: .stream [on | off]", file=sys.stderr)
+
+    @property
+    def index_dir(self) -> Path:
+        """Directory holding the index sidecar files of this database."""
+        if self.is_in_memory:
+            if self._index_dir is None:
+                self._index_dir = Path(tempfile.mkdtemp(prefix="tsellm-index-"))
+            return self._index_dir
+        return Path(f"{self.path}.tsellm-index").resolve()
+
+    def read_vectors(self, table, column, after_rowid=None):
+        """Rowids and vectors of the non-null values of ``table.column``."""
+        from .similarity import as_vector
+
+        sql = f'SELECT rowid, "{column}" FROM "{table}" WHERE "{column}" IS NOT NULL'
+        params = []
+        if after_rowid is not None:
+            sql += " AND rowid > ?"
+            params.append(after_rowid)
+        rows = self.connection.execute(sql + " ORDER BY rowid", params).fetchall()
+        return [r for r, _ in rows], [as_vector(v) for _, v in rows]
+
+    def index_command(self, args):
+        """Handle ``.index [create | add | drop | nprobe | bench] TABLE COLUMN [N]``."""
+        from .ivf import VectorIndex, benchmark
+
+        match args:
+            case []:
+                for name, meta in sorted(self.indexes.metadata.items()):
+                    print(f"{name}\t{json.dumps(meta)}")
+                return
+            case ["create", table, column, *nlist]:
+                rowids, vectors = self.read_vectors(table, column)
+                index = VectorIndex.build(
+                    self.index_dir / f"{table}.{column}",
+                    rowids,
+                    vectors,
+                    nlist=int(nlist[0]) if nlist else None,
+                )
+            case ["add", table, column]:
+                index = self.indexes.get(f"{table}.{column}")
+                index = index.add(*self.read_vectors(table, column, index.max_rowid))
+            case ["nprobe", table, column, n]:
+                index = self.indexes.get(f"{table}.{column}")
+                index.nprobe = int(n)
+            case ["drop", table, column]:
+                self.indexes.drop(f"{table}.{column}")
+                write_config(self.connection, f"index:{table}.{column}", None)
+                return
+            case ["bench", table, column, *k]:
+                index = self.indexes.get(f"{table}.{column}")
+                print("nprobe\trecall\tms/query")
+                for nprobe, recall, ms in benchmark(index, k=int(k[0]) if k else 10):
+                    print(f"{nprobe}\t{recall:.3f}\t{ms:.3f}")
+                return
+            case _:
+                print(
+                    "Usage: .index [create | add | drop | nprobe | bench] TABLE COLUMN [N]",
+                    file=sys.stderr,
+                )
+                return
+        write_config(
+            self.connection,
+            f"index:{table}.{column}",
+            self.indexes.put(f"{table}.{column}", index),
+        )
+
+    def reduce_command(self, args):
+        """Handle ``.reduce [create | drop | bench] ...``, see ``REDUCE_USAGE``."""
+        from .join import as_matrix
+        from .quantize import Reducer, benchmark
+
+        match args:
+            case []:
+                for name in sorted(self.reducers.config):
+                    reducer = self.reducers.get(name)
+                    dims = f"{reducer.input_dim}->{reducer.dim}"
+                    print(f"{name}\t{reducer.method}\t{dims}")
+                return
+            case ["create", name, table, column, dim, *method] if len(method) <= 1:
+                _, vectors = self.read_vectors(table, column)
+                reducer = Reducer.fit(as_matrix(vectors), int(dim), *method)
+                self.reducers.put(name, reducer)
+            case ["drop", name]:
+                self.reducers.drop(name)
+            case ["bench", table, column, *k] if len(k) <= 1:
+                _, vectors = self.read_vectors(table, column)
+                print("method\tbytes\trecall\tms/query")
+                for method, size, recall, ms in benchmark(
+                    as_matrix(vectors), self.reducers.all(), k=int(k[0]) if k else 10
+                ):
+                    print(f"{method}\t{size}\t{recall:.3f}\t{ms:.3f}")
+                return
+            case _:
+                print(f"Usage: {REDUCE_USAGE}", file=sys.stderr)
+                return
+        write_config(
+            self.connection,
+            f"{ReducerCatalog.PREFIX}{name}",
+            self.reducers.config.get(name),
+        )
+
+    def semantic_join(self, left_table, left_column, right_table, right_column, k):
+        """Write the ``k`` rows of the right column most similar to each left row."""
+        from .join import as_matrix, semantic_join
+
+        left_rowids, left = self.read_vectors(left_table, left_column)
+        right_rowids, right = self.read_vectors(right_table, right_column)
+        write_rows(
+            ("left_rowid", "right_rowid", "score"),
+            semantic_join(
+                left_rowids, as_matrix(left), right_rowids, as_matrix(right), k
+            ),
+            self.output_format,
+            self.output_stream,
+        )
+
+    def semantic_join_command(self, args):
+        """Handle ``.semantic_join TABLE COLUMN TABLE COLUMN [K]``."""
+        match args:
+            case [_, _, _, _] | [_, _, _, _, _]:
+                self.semantic_join(*args[:4], int(args[4]) if len(args) == 5 else 10)
+            case _:
+                print(
+                    "Usage: .semantic_join "
+                    "LEFT_TABLE LEFT_COLUMN RIGHT_TABLE RIGHT_COLUMN [K]",
+                    file=sys.stderr,
+                )
+
+    def save_cache_settings(self):
+        write_config(
+            self.connection,
+            "cache",
+            {
+                "enabled": self.cache.enabled,
+                "max_entries": self.cache.max_entries,
+                "max_age": self.cache.max_age,
+            },
+        )
+        self.cache.evict(self.connection)
 
     @abstractmethod
     def execute(self, sql, suppress_errors=True):
         pass
 
+    @abstractmethod
+    def run(self, sql, fmt="tuple", stream=None):
+        pass
+
     def runsource(self, source, filename="<input>", symbol="single"):
         """Override runsource, the core of the InteractiveConsole REPL.
 
@@ -189,8 +601,39 @@ x text
                 print(f"{self.version}")
             case ".help":
                 print("Enter SQL code and press enter.")
+                print(
+                    ".cache [clear [MODEL] | on | off | max_entries N | max_age SECONDS]"
+                )
+                print(".concurrency [MODEL N]")
+                print(".limit [MODEL rpm|tpm|retries|context N|off]")
+                print(".prefetch [on | off]")
+                print(".stream [on | off]")
+                print(".stats [reset | save]")
+                print(".index [create | add | drop | nprobe | bench] TABLE COLUMN [N]")
+                print(REDUCE_USAGE)
+                print(
+                    ".semantic_join LEFT_TABLE LEFT_COLUMN RIGHT_TABLE RIGHT_COLUMN [K]"
+                )
             case ".quit":
                 sys.exit(0)
+            case cmd if cmd.split()[:1] == [".cache"]:
+                self.cache_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".concurrency"]:
+                self.concurrency_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".limit"]:
+                self.limit_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".prefetch"]:
+                self.prefetch_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".stream"]:
+                self.stream_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".stats"]:
+                self.stats_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".index"]:
+                self.index_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".reduce"]:
+                self.reduce_command(cmd.split()[1:])
+            case cmd if cmd.split()[:1] == [".semantic_join"]:
+                self.semantic_join_command(cmd.split()[1:])
             case _:
                 if not self.complete_statement(source):
                     return True
@@ -217,7 +660,26 @@ class SQLiteConsole(TsellmConsole):
     db_type = "SQLite"
 
     def connect(self):
-        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        # A console may be used by one thread after another, as in a server's pool.
+        self.connection = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+
+    def load(self):
+        super().load()
+        for udf in SQLITE_AGGREGATES:
+            register_sqlite(
+                self.connection,
+                udf,
+                _bind(
+                    udf.sqlite,
+                    cache=self.cache,
+                    concurrency=self.concurrency,
+                    stats=self.stats,
+                    scheduler=self.scheduler,
+                ),
+            )
+        self.connection.execute(SQLITE_STATS_VIEW)
 
     path: Union[Path, str, sqlite3.Connection, duckdb.DuckDBPyConnection]
     error_class = sqlite3.Error
@@ -239,8 +701,7 @@ class SQLiteConsole(TsellmConsole):
         """
 
         try:
-            for row in self._cur.execute(sql):
-                print(row)
+            self.run(sql, self.output_format, self.output_stream)
         except self.error_class as e:
             tp = type(e).__name__
             try:
@@ -250,6 +711,51 @@ class SQLiteConsole(TsellmConsole):
             if not suppress_errors:
                 sys.exit(1)
 
+    def run(self, sql, fmt="tuple", stream=None):
+        """Execute ``sql`` and stream its result; errors are raised to the caller."""
+        # With .stream on, whether to stream is decided from the recorded calls.
+        # Only prompts stream, and only batched functions are recorded:
+        # any other function runs again in the recording pass.
+        recorded = (self.prefetch or self.stream) and self.calls_functions(
+            sql, PREFETCHED if self.prefetch else STREAMED
+        )
+        try:
+            if recorded:
+                self.prefetch_calls(sql)
+            write_result(self._cur.execute(sql), fmt, stream)
+        finally:
+            if recorded:
+                self.register_functions()
+            self.flush_cache()
+
+    def calls_functions(self, sql, functions) -> bool:
+        """Whether ``sql`` calls one of ``functions`` outside its literals and comments."""
+        code = _SQL_LITERALS.sub(" ", sql)
+        return any(
+            re.search(rf"\b{udf.name}\s*\(", code, re.IGNORECASE) for udf in functions
+        )
+
+    def prefetch_calls(self, sql):
+        """Run ``sql`` with recording stubs, then fetch every call it made at once.
+
+        The recording run happens inside a savepoint that is rolled back,
+        so statements that modify the database can be prefetched too.
+        With ``.stream on``, a statement that makes a single prompt call
+        has its response streamed.
+        """
+        prefetch = Prefetch()
+        self.register_functions(prefetch.recorder, measure=False)
+        self.connection.execute("SAVEPOINT tsellm_prefetch")
+        try:
+            for _ in self.connection.execute(sql):
+                pass
+        finally:
+            self.connection.execute("ROLLBACK TO tsellm_prefetch")
+            self.connection.execute("RELEASE tsellm_prefetch")
+        stream = self.stream_output if prefetch.prompt_calls() == 1 else None
+        prefetch.fetch(self.cache, self.concurrency, self.stats, self.scheduler, stream)
+        self.register_functions(prefetch.memoized)
+
     @property
     def db_version(self):
         return sqlite3.sqlite_version
@@ -263,6 +769,8 @@ class DuckDBConsole(TsellmConsole):
 
     db_type = "DuckDB"
     path: Union[Path, str, sqlite3.Connection, duckdb.DuckDBPyConnection]
+    views: list = field(default_factory=list)
+    first_call_stream: FirstCallStream = None
 
     def complete_statement(self, source) -> bool:
         return sqlite3.complete_statement(source)
@@ -273,22 +781,70 @@ class DuckDBConsole(TsellmConsole):
 
     error_class = sqlite3.Error
 
-    _functions = [
-        ("prompt", 2, _prompt_model, False),
-        ("embed", 2, _embed_model, False),
-        ("json_embed", 2, _json_embed_model, False),
-    ]
-
     def connect(self):
+        import duckdb
+
         self.connection = duckdb.connect(str(self.path))
 
+    def create_views(self):
+        """Expose each data file in ``views`` as a view named after the file."""
+        for fp in self.views:
+            reader = DATA_FILE_READERS[DBSniffer(fp).sniff()]
+            name = re.sub(r"\W", "_", Path(fp).stem)
+            source = str(fp).replace("'", "''")
+            self.connection.execute(
+                f"CREATE OR REPLACE VIEW \"{name}\" AS SELECT * FROM {reader}('{source}')"
+            )
+
     def load(self):
-        self.execute(self._TSELLM_CONFIG_SQL)
-        for func_name, _, py_func, _ in self._functions:
-            self.connection.create_function(func_name, py_func)
+        from .vectorized import DUCKDB_STATS_VIEW, MACROS, STATS_RESULT
+
+        self.load_config()
+        self.create_views()
+        self.register_functions()
+        for func_name, definitions in MACROS:
+            self.connection.execute(
+                f"CREATE OR REPLACE TEMP MACRO {func_name}{definitions}"
+            )
+        self.connection.create_function(
+            "tsellm_stats", self.stats.rows, [], STATS_RESULT, side_effects=True
+        )
+        self.connection.execute(DUCKDB_STATS_VIEW)
+
+    def register_functions(self):
+        from . import vectorized
+
+        self.first_call_stream = (
+            FirstCallStream(self.stream_output) if self.stream else None
+        )
+        for udf in DUCKDB_FUNCTIONS:
+            py_func = getattr(vectorized, udf.duckdb)
+            func = _bind(
+                py_func,
+                cache=self.cache,
+                concurrency=self.concurrency,
+                indexes=self.indexes,
+                reducers=self.reducers,
+                stats=self.stats,
+                scheduler=self.scheduler,
+                # Scalar functions run row by row, so they never stream.
+                stream=self.first_call_stream if udf.arrow else None,
+            )
+            func = self.stats.wrap(udf.name, py_func, func, vectorized=udf.arrow)
+            register_duckdb(self.connection, udf, func)
+
+    def semantic_join(self, left_table, left_column, right_table, right_column, k):
+        """Query the ``semantic_join`` table macro, which any SQL can use too."""
+        args = ", ".join(
+            "'" + arg.replace("'", "''") + "'"
+            for arg in (left_table, left_column, right_table, right_column)
+        )
+        self.execute(f"SELECT * FROM semantic_join({args}, k := {int(k)})")
 
     @property
     def db_version(self):
+        import duckdb
+
         return duckdb.__version__
 
     def execute(self, sql, suppress_errors=True):
@@ -301,8 +857,7 @@ class DuckDBConsole(TsellmConsole):
         """
 
         try:
-            for row in self.connection.execute(sql).fetchall():
-                print(row)
+            self.run(sql, self.output_format, self.output_stream)
         except self.error_class as e:
             tp = type(e).__name__
             try:
@@ -312,6 +867,15 @@ class DuckDBConsole(TsellmConsole):
             if not suppress_errors:
                 sys.exit(1)
 
+    def run(self, sql, fmt="tuple", stream=None):
+        """Execute ``sql`` and stream its result; errors are raised to the caller."""
+        if self.first_call_stream is not None:
+            self.first_call_stream.reset()
+        try:
+            write_result(self.connection.execute(sql), fmt, stream)
+        finally:
+            self.flush_cache()
+
 
 def make_parser():
     parser = ArgumentParser(
@@ -325,7 +889,9 @@ def make_parser():
         nargs="?",
         help=(
             "SQLite/DuckDB database to open (defaults to SQLite ':memory:'). "
-            "A new database is created if the file does not previously exist."
+            "A new database is created if the file does not previously exist. "
+            "Parquet, CSV and JSONL files are opened as views "
+            "in an in-memory DuckDB database."
         ),
     )
     parser.add_argument(
@@ -354,6 +920,107 @@ def make_parser():
         help="DuckDB mode",
     )
 
+    parser.add_argument(
+        "--view",
+        metavar="PATH",
+        action="append",
+        default=[],
+        help=(
+            "DuckDB: expose a Parquet, CSV or JSONL file as a view "
+            "named after the file (repeatable)"
+        ),
+    )
+    parser.add_argument(
+        "--output",
+        choices=FORMATS,
+        default="tuple",
+        help="Format of the rows printed by the SQL query (default: tuple)",
+    )
+    parser.add_argument(
+        "--output-file",
+        metavar="PATH",
+        help="Write query results to PATH instead of stdout",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=False,
+        help=(
+            "SQLite: record the model calls a query makes, "
+            "run them concurrently, then run the query against the results"
+        ),
+    )
+    parser.add_argument(
+        "--limit",
+        nargs=3,
+        metavar=("MODEL", "SETTING", "N"),
+        action="append",
+        default=[],
+        help=(
+            "Limit calls to MODEL for this session: SETTING is rpm (requests/min), "
+            "tpm (tokens/min), retries or context (tokens per aggregate call, "
+            "or per chunk embed_chunks embeds) (repeatable)"
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help=(
+            "Shard model calls across N worker processes, for CPU-bound local "
+            "models (implies --prefetch on SQLite)"
+        ),
+    )
+    parser.add_argument(
+        "--preload",
+        metavar="MODEL",
+        action="append",
+        default=[],
+        help="Load MODEL in the background while the database opens (repeatable)",
+    )
+    parser.add_argument(
+        "--max-models",
+        metavar="N",
+        type=int,
+        help="Keep at most N models loaded; least recently used ones are dropped",
+    )
+    parser.add_argument(
+        "--model-memory",
+        metavar="MB",
+        type=int,
+        help="Drop least recently used models once loaded models exceed MB megabytes",
+    )
+    parser.add_argument(
+        "--server",
+        metavar="URL",
+        help=(
+            "Send the SQL query to a running `tsellm serve` at URL instead of "
+            "opening a database; the only positional argument is then the query"
+        ),
+    )
+    parser.add_argument(
+        "--no-server",
+        action="store_true",
+        default=False,
+        help="Open the database even if a `tsellm serve` over it is running",
+    )
+    parser.add_argument(
+        "--save-stats",
+        action="store_true",
+        default=False,
+        help="At exit, add the UDF call counters to the totals kept in __tsellm",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        default=False,
+        help=(
+            "Print the time spent in each phase of startup, "
+            "and the packages each phase imported, to stderr"
+        ),
+    )
+
     parser.add_argument(
         "-v",
         "--version",
@@ -364,30 +1031,305 @@ def make_parser():
     return parser
 
 
-def cli(*args):
-    args = make_parser().parse_args(*args)
+def make_enrich_parser():
+    from .enrich import DEFAULT_BATCH_SIZE, FUNCTIONS
+
+    parser = ArgumentParser(
+        description=(
+            "Fill a column with model outputs, in resumable batches: "
+            "rows already filled are skipped, so a killed job picks up "
+            "where it stopped"
+        ),
+        prog="python -m tsellm enrich",
+    )
+    parser.add_argument("filename", help="SQLite/DuckDB database")
+    parser.add_argument("table", help="Table to enrich")
+    parser.add_argument(
+        "--input", required=True, metavar="COLUMN", help="Column to read"
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        metavar="COLUMN",
+        help="Column to fill (added if it does not exist)",
+    )
+    parser.add_argument(
+        "--fn", required=True, choices=FUNCTIONS, help="Function to apply"
+    )
+    parser.add_argument(
+        "--model",
+        help="Model to call (defaults to the default prompt or embedding model)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        metavar="N",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Rows computed and committed at a time (default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Shard model calls across N worker processes",
+    )
+    return parser
 
-    if args.sqlite and args.duckdb:
-        raise ValueError("Only one of --sqlite and --duckdb can be specified.")
 
-    sniffer = DBSniffer(args.filename)
-    console = (
-        DuckDBConsole(args.filename)
-        if (args.duckdb or sniffer.is_duckdb)
-        else SQLiteConsole(args.filename)
+def make_serve_parser():
+    from .server import DEFAULT_POOL, DEFAULT_PORT
+
+    parser = ArgumentParser(
+        description=(
+            'Answer SQL over HTTP: POST /query with {"sql": ..., "format": ...} '
+            "streams the result back, from a pool of consoles with models kept loaded"
+        ),
+        prog="python -m tsellm serve",
     )
+    parser.add_argument(
+        "filename",
+        help=(
+            "SQLite/DuckDB database, created as SQLite if it does not exist, "
+            "or a Parquet, CSV or JSONL file"
+        ),
+    )
+    parser.add_argument(
+        "--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help=f"Port to listen on (default: {DEFAULT_PORT})",
+    )
+    parser.add_argument(
+        "--pool",
+        metavar="N",
+        type=int,
+        default=DEFAULT_POOL,
+        help=f"Consoles, and so statements run at once (default: {DEFAULT_POOL})",
+    )
+    parser.add_argument(
+        "--limit",
+        nargs=3,
+        metavar=("MODEL", "SETTING", "N"),
+        action="append",
+        default=[],
+        help="Limit calls to MODEL, as in the shell's --limit (repeatable)",
+    )
+    parser.add_argument(
+        "--preload",
+        metavar="MODEL",
+        action="append",
+        default=[],
+        help="Load MODEL before serving (repeatable)",
+    )
+    parser.add_argument(
+        "--quiet", action="store_true", default=False, help="Do not log requests"
+    )
+    return parser
+
 
+def serve(*args):
+    from .server import ConsolePool, TsellmServer
+
+    args = make_serve_parser().parse_args(*args)
+    loading = [registry.preload(model) for model in args.preload]
+    pool = ConsolePool(lambda: open_console(args.filename), args.pool)
+    for model, setting, n in args.limit:
+        if setting not in LIMITS:
+            raise ValueError(f"--limit SETTING must be one of {', '.join(LIMITS)}.")
+        pool.scheduler.configure(model, **{setting: int(n)})
+    for thread in loading:
+        thread.join()
+    server = TsellmServer((args.host, args.port), pool, quiet=args.quiet)
+    server.advertise()
+    print(
+        f"Serving {args.filename} on {server.url} ({len(pool.consoles)} consoles)",
+        file=sys.stderr,
+    )
     try:
-        if args.sql:
-            # SQL statement provided on the command-line; execute it directly.
-            console.execute(args.sql, suppress_errors=False)
-        else:
-            try:
-                import readline
-            except ImportError:
-                pass
-            console.interact(console.banner, exitmsg="")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
     finally:
+        server.server_close()
+        pool.close()
+
+    sys.exit(0)
+
+
+def enrich(*args):
+    from .enrich import Enrichment
+
+    args = make_enrich_parser().parse_args(*args)
+    console = TsellmConsole.create_console(args.filename)
+    if args.workers > 1:
+        from .workers import WorkerPool
+
+        console.scheduler.workers = WorkerPool(args.workers, console.scheduler.limits)
+    try:
+        Enrichment(
+            console,
+            args.table,
+            args.input,
+            args.output,
+            args.fn,
+            model=args.model,
+            batch_size=args.batch_size,
+        ).run()
+    finally:
+        console.scheduler.close()
         console.connection.close()
 
     sys.exit(0)
+
+
+def open_console(filename, duckdb=False, views=()) -> TsellmConsole:
+    """A console over ``filename``, opened as the shell opens its database.
+
+    Data files become views in an in-memory DuckDB database; DuckDB files,
+    or any file with ``duckdb``, open in DuckDB; anything else, including a
+    file that does not exist yet, is an SQLite database.
+    """
+    sniffer = DBSniffer(filename)
+    if sniffer.is_data_file:
+        return DuckDBConsole(":memory:", views=[filename, *views])
+    if duckdb or sniffer.is_duckdb:
+        return DuckDBConsole(filename, views=list(views))
+    if views:
+        raise ValueError("--view requires a DuckDB database.")
+    return SQLiteConsole(filename)
+
+
+# Options a `tsellm serve` does not apply to the queries forwarded to it.
+LOCAL_OPTIONS = (
+    "sqlite",
+    "duckdb",
+    "view",
+    "prefetch",
+    "limit",
+    "workers",
+    "preload",
+    "max_models",
+    "model_memory",
+    "save_stats",
+    "startup_profile",
+)
+
+
+def local_options(args) -> list:
+    """The ``LOCAL_OPTIONS`` given in ``args``, as spelled on the command line."""
+    defaults = make_parser().parse_args([])
+    return [
+        f"--{dest.replace('_', '-')}"
+        for dest in LOCAL_OPTIONS
+        if getattr(args, dest) != getattr(defaults, dest)
+    ]
+
+
+def cli(*args):
+    argv = list(args[0]) if args else sys.argv[1:]
+    # A database file named like a subcommand is still opened as one.
+    if argv[:1] == ["enrich"] and not Path("enrich").exists():
+        enrich(argv[1:])
+    if argv[:1] == ["serve"] and not Path("serve").exists():
+        serve(argv[1:])
+
+    profile = StartupProfile(
+        started=tsellm._IMPORT_STARTED, modules=tsellm._MODULES_BEFORE_IMPORT
+    )
+    with profile.phase("parse arguments"):
+        args = make_parser().parse_args(argv)
+
+    if args.sqlite and args.duckdb:
+        raise ValueError("Only one of --sqlite and --duckdb can be specified.")
+
+    server, sql = args.server, args.sql
+    if server:
+        # The only positional argument is then the query.
+        sql = args.filename if sql is None else sql
+        if sql == ":memory:":
+            raise ValueError("--server requires an SQL query.")
+        ignored = local_options(args)
+        if ignored:
+            raise ValueError(f"--server cannot be combined with {ignored[0]}.")
+    elif (
+        sql
+        and not args.no_server
+        and not local_options(args)
+        and Path(f"{args.filename}.tsellm-server").exists()
+    ):
+        from .server import running_server
+
+        # A query over a database that is being served goes to the server,
+        # unless it asks for options only a local console applies.
+        server = running_server(args.filename)
+
+    if server:
+        from .server import query
+
+        binary = args.output in ("arrow", "parquet")
+        output_file = (
+            open(args.output_file, "wb" if binary else "w")
+            if args.output_file
+            else nullcontext()
+        )
+        with output_file as stream:
+            try:
+                query(server, sql, args.output, stream)
+            except (OSError, RuntimeError) as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+        sys.exit(0)
+
+    registry.max_models = args.max_models
+    registry.max_memory = args.model_memory and args.model_memory * 1024 * 1024
+    for model in args.preload:
+        registry.preload(model)
+
+    with profile.phase("open database"):
+        console = open_console(args.filename, args.duckdb, args.view)
+
+    console.prefetch = args.prefetch
+    for model, setting, n in args.limit:
+        if setting not in LIMITS:
+            raise ValueError(f"--limit SETTING must be one of {', '.join(LIMITS)}.")
+        console.scheduler.configure(model, **{setting: int(n)})
+    if args.workers > 1:
+        from .workers import WorkerPool
+
+        console.scheduler.workers = WorkerPool(args.workers, console.scheduler.limits)
+        # SQLite calls UDFs one row at a time; prefetching batches them for the workers.
+        console.prefetch = True
+    console.output_format = args.output
+    binary = args.output in ("arrow", "parquet")
+    output_file = (
+        open(args.output_file, "wb" if binary else "w", buffering=1 << 20)
+        if args.output_file
+        else nullcontext()
+    )
+
+    with output_file as console.output_stream:
+        try:
+            if args.sql:
+                # SQL statement provided on the command-line; execute it directly.
+                with profile.phase("execute"):
+                    console.execute(args.sql, suppress_errors=False)
+            else:
+                try:
+                    import readline
+                except ImportError:
+                    pass
+                with profile.phase("interactive session"):
+                    console.interact(console.banner, exitmsg="")
+        finally:
+            if args.save_stats:
+                console.save_stats()
+            console.scheduler.close()
+            console.connection.close()
+            if args.startup_profile:
+                profile.report()
+
+    sys.exit(0)
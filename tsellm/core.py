@@ -1,7 +1,14 @@
+import functools
+import importlib
+import inspect
 import json
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import llm
-from llm import cli as llm_cli
+from .chunking import DEFAULT_CHUNK_SIZE, chunks
+from .models import registry
+from .scheduler import DEFAULT_CONCURRENCY, DEFAULT_CONTEXT, estimate_tokens
 
 TSELLM_CONFIG_SQL = """
 -- tsellm configuration table
@@ -13,6 +20,88 @@ x text
 
 """
 
+DEFAULT_PROMPT_MODEL = "markov"
+
+
+def read_config(con) -> dict:
+    """Read the ``{"key": ..., "value": ...}`` records stored in ``__tsellm``."""
+    config = {}
+    for (x,) in con.execute("SELECT x FROM __tsellm").fetchall():
+        try:
+            entry = json.loads(x)
+            config[entry["key"]] = entry["value"]
+        except (TypeError, ValueError, KeyError):
+            continue
+    return config
+
+
+def write_config(con, key: str, value):
+    """Store ``value`` under ``key`` in ``__tsellm``, replacing any previous record."""
+    for (x,) in con.execute("SELECT x FROM __tsellm").fetchall():
+        try:
+            if json.loads(x)["key"] == key:
+                con.execute("DELETE FROM __tsellm WHERE x = ?", [x])
+        except (TypeError, ValueError, KeyError):
+            continue
+    if value is not None:
+        con.execute(
+            "INSERT INTO __tsellm (x) VALUES (?)",
+            [json.dumps({"key": key, "value": value})],
+        )
+
+
+def _bind(func, **state):
+    """Bind console state to the keyword arguments ``func`` accepts.
+
+    The returned callable keeps the SQL-visible signature of ``func``,
+    so DuckDB can still infer parameter types from its annotations.
+    """
+    sig = inspect.signature(func)
+    state = {k: v for k, v in state.items() if k in sig.parameters}
+    if not state:
+        return func
+    bound = functools.partial(func, **state)
+    bound.__signature__ = sig.replace(
+        parameters=[p for p in sig.parameters.values() if p.name not in state]
+    )
+    return bound
+
+
+def _deferred(module: str, name: str):
+    """A stand-in for ``module.name`` that imports ``module`` on its first call.
+
+    Lets consoles register UDFs backed by heavy modules (NumPy, PyArrow)
+    without paying for those imports in statements that never call them.
+    """
+    func = None
+
+    def call(*args):
+        nonlocal func
+        if func is None:
+            func = getattr(importlib.import_module(module, __package__), name)
+        return func(*args)
+
+    call.__name__ = name
+    return call
+
+
+def _encode(values) -> bytes:
+    """Pack a vector as little-endian float32, the format of ``llm.encode``."""
+    return struct.pack("<" + "f" * len(values), *values)
+
+
+def _decode(blob: bytes) -> tuple:
+    return struct.unpack("<" + "f" * (len(blob) // 4), blob)
+
+
+def _scheduled(scheduler, model, func, text="", requests=1):
+    """``func()``, a call to ``model``, through the console's ``scheduler`` if any."""
+    if scheduler is None:
+        return func()
+    return scheduler.call(
+        getattr(model, "model_id", model), func, requests, estimate_tokens(text)
+    )
+
 
 def json_recurse_apply(json_obj, f):
     if isinstance(json_obj, dict):
@@ -29,34 +118,367 @@ def json_recurse_apply(json_obj, f):
         return json_obj
 
 
-def _prompt_model(prompt: str, model: str) -> str:
-    return llm.get_model(model).prompt(prompt).text()
+def _embed_unique(embedding_model, items, scheduler=None) -> list:
+    """Embed ``items`` in one batched call, embedding each distinct item once."""
+    unique = list(dict.fromkeys(items))
+    if scheduler is not None and scheduler.workers is not None and unique:
+        vectors = dict(
+            zip(unique, scheduler.workers.embed(embedding_model.model_id, unique))
+        )
+        return [vectors[item] for item in items]
+    batch_size = getattr(embedding_model, "batch_size", None)
+    embedded = _scheduled(
+        scheduler,
+        embedding_model,
+        lambda: list(embedding_model.embed_multi(unique)),
+        unique,
+        requests=-(-len(unique) // batch_size) if batch_size else 1,
+    )
+    vectors = dict(zip(unique, embedded))
+    return [vectors[item] for item in items]
+
+
+def _json_strings(json_obj):
+    """Yield the string leaves of a JSON document, in ``json_recurse_apply`` order."""
+    if isinstance(json_obj, dict):
+        for v in json_obj.values():
+            yield from _json_strings(v)
+    elif isinstance(json_obj, list):
+        for item in json_obj:
+            yield from _json_strings(item)
+    elif isinstance(json_obj, str):
+        yield json_obj
+
+
+def _prompt_model(
+    prompt: str, model: str, cache=None, stats=None, scheduler=None, stream=None
+) -> str:
+    """The response of ``model`` to ``prompt``.
+
+    With a ``stream`` (a text file), the response is also written to it
+    chunk by chunk, as the model generates it. When the scheduler retries
+    the call, only text beyond what an earlier attempt wrote is streamed.
+    """
+    if cache is None:
+        written = 0
+
+        def execute():
+            nonlocal written
+            response = registry.get_model(model).prompt(prompt)
+            if stream is None:
+                response.text()
+                return response
+            position = 0
+            for chunk in response:
+                position += len(chunk)
+                if position > written:
+                    stream.write(chunk[len(chunk) - (position - written) :])
+                    stream.flush()
+                    written = position
+            stream.write("\n")
+            return response
+
+        response = _scheduled(scheduler, model, execute, prompt)
+        if stats is not None:
+            stats.usage("prompt", model, response)
+        return response.text()
+    return cache.prompt(
+        model,
+        prompt,
+        lambda: _prompt_model(
+            prompt, model, stats=stats, scheduler=scheduler, stream=stream
+        ),
+    )
+
+
+def _prompt_many(
+    prompts,
+    model: str,
+    cache=None,
+    max_in_flight=DEFAULT_CONCURRENCY,
+    stats=None,
+    scheduler=None,
+    stream=None,
+) -> list:
+    """Prompt ``model`` with each of ``prompts`` concurrently.
+
+    Distinct prompts that miss the cache are sharded across the scheduler's
+    worker processes, or run at most ``max_in_flight`` at a time on its
+    engine (or, without one, a pool of threads); responses come back
+    in input order. If only one prompt misses, as in a single-row query,
+    its response is written to ``stream`` as it is generated.
+    """
+    responses = {}
+    for prompt in dict.fromkeys(prompts):
+        responses[prompt] = None if cache is None else cache.lookup(model, prompt)
+    misses = [p for p, r in responses.items() if r is None]
+    computed = []
+    if stream is not None and len(misses) == 1:
+        prompt_model = _bind(
+            _prompt_model, stats=stats, scheduler=scheduler, stream=stream
+        )
+        computed = [prompt_model(misses[0], model)]
+    elif misses and scheduler is not None and scheduler.workers is not None:
+        computed = scheduler.workers.prompt(model, misses, stats)
+    elif misses and scheduler is not None and scheduler.engine is not None:
+        computed = scheduler.engine.prompt_many(
+            model, misses, max_in_flight, stats, scheduler
+        )
+    elif misses:
+        prompt_model = _bind(_prompt_model, stats=stats, scheduler=scheduler)
+        with ThreadPoolExecutor(max_workers=min(max_in_flight, len(misses))) as pool:
+            computed = list(pool.map(lambda p: prompt_model(p, model), misses))
+    for prompt, response in zip(misses, computed):
+        responses[prompt] = response
+        if cache is not None:
+            cache.store(model, prompt, response)
+    return [responses[p] for p in prompts]
+
+
+class FirstCallStream:
+    """Hands ``stream`` to the first call of a statement only, until ``reset``.
+
+    DuckDB calls a function once per chunk of rows, and how many chunks a
+    statement has is not known up front, so only its first call may stream:
+    responses of later calls are never written after it.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.claimed = False
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.claimed = False
+
+    def claim(self):
+        with self._lock:
+            claimed, self.claimed = self.claimed, True
+        return None if claimed else self.stream
+
 
+def _prompt_model_default(prompt: str, cache=None, stats=None, scheduler=None) -> str:
+    return _prompt_model(
+        prompt, DEFAULT_PROMPT_MODEL, cache=cache, stats=stats, scheduler=scheduler
+    )
+
+
+def _pack(texts, budget: int) -> list:
+    """Split ``texts`` into runs whose estimated tokens fit in ``budget``.
+
+    Each text is cut to half the budget, so every run but the last holds
+    at least two texts, and each map-reduce round has fewer than the one before.
+    """
+    limit = max(1, budget // 2 - 1) * 4
+    runs, run, used = [], [], 0
+    for text in texts:
+        text = text[:limit]
+        tokens = estimate_tokens(text)
+        if run and used + tokens > budget:
+            runs.append(run)
+            run, used = [], 0
+        run.append(text)
+        used += tokens
+    return runs + [run] if run else runs
+
+
+def _prompt_reduce(
+    groups,
+    model: str,
+    cache=None,
+    max_in_flight=DEFAULT_CONCURRENCY,
+    stats=None,
+    scheduler=None,
+) -> list:
+    """Reduce each ``(instruction, texts)`` group to one response of ``model``.
 
-def _prompt_model_default(prompt: str) -> str:
-    return llm.get_model("markov").prompt(prompt).text()
+    The texts of a group are packed into as few prompts as fit the model's
+    context; while a group needs more than one, their responses are packed
+    and prompted again (map-reduce). Each round sends the prompts of all
+    groups concurrently.
+    """
+    context = DEFAULT_CONTEXT if scheduler is None else scheduler.limiter(model).context
+    results = [None] * len(groups)
+    pending = {}
+    for i, (_, texts) in enumerate(groups):
+        texts = [t for t in texts if t is not None]
+        if texts:
+            pending[i] = texts
+    while pending:
+        prompts, owners = [], []
+        for i, texts in pending.items():
+            instruction = groups[i][0]
+            budget = max(8, context - estimate_tokens(instruction or ""))
+            for run in _pack(texts, budget):
+                parts = [instruction, *run] if instruction else run
+                prompts.append("\n\n---\n\n".join(parts))
+                owners.append(i)
+        responses = {}
+        for i, response in zip(
+            owners,
+            _prompt_many(prompts, model, cache, max_in_flight, stats, scheduler),
+        ):
+            responses.setdefault(i, []).append(response)
+        pending = {}
+        for i, texts in responses.items():
+            if len(texts) == 1:
+                results[i] = texts[0]
+            else:
+                pending[i] = texts
+    return results
 
 
-def _embed_model(text: str, model: str) -> str:
-    return json.dumps(llm.get_embedding_model(model).embed(text))
+def _pool(vectors, pooling: str) -> list:
+    """Pool ``vectors`` into one, by their element-wise ``mean`` or ``max``."""
+    if pooling == "mean":
+        return [sum(c) / len(vectors) for c in zip(*vectors)]
+    if pooling == "max":
+        return [max(c) for c in zip(*vectors)]
+    raise ValueError(f"Unknown pooling {pooling!r}: use 'mean' or 'max'")
 
 
-def _json_embed_model(js: str, model: str) -> str:
-    return json.dumps(
-        json_recurse_apply(json.loads(js), lambda v: json.loads(_embed_model(v, model)))
+def _embed_mean(groups, embedding_model, scheduler=None) -> list:
+    """The mean embedding of each group of texts, embedded in one batch."""
+    vectors = iter(
+        _embed_unique(
+            embedding_model,
+            [t for texts in groups for t in texts if t is not None],
+            scheduler,
+        )
     )
+    means = []
+    for texts in groups:
+        group = [next(vectors) for t in texts if t is not None]
+        means.append(_pool(group, "mean") if group else None)
+    return means
+
+
+def _chunk_size(model_id: str, scheduler=None) -> int:
+    limits = {} if scheduler is None else scheduler.limits.get(model_id, {})
+    return limits.get("context", DEFAULT_CHUNK_SIZE)
+
+
+def _embed_chunks_many(texts, embedding_model, poolings, scheduler=None) -> list:
+    """Embed each of ``texts`` as its chunks' embeddings, pooled as in ``poolings``.
+
+    The chunks of all texts are embedded in one batched call.
+    """
+    size = _chunk_size(embedding_model.model_id, scheduler)
+    pieces = [list(chunks(text, size)) or [""] for text in texts]
+    flat = [piece for ps in pieces for piece in ps]
+    vectors = iter(_embed_unique(embedding_model, flat, scheduler))
+    return [
+        _pool([next(vectors) for _ in ps], pooling)
+        for ps, pooling in zip(pieces, poolings)
+    ]
 
 
-def _embed_model_default(text: str) -> str:
-    return json.dumps(
-        llm.get_embedding_model(llm_cli.get_default_embedding_model()).embed(text)
+def _embed_chunks(text: str, model: str, pooling="mean", scheduler=None) -> str:
+    (pooled,) = _embed_chunks_many(
+        [text], registry.get_embedding_model(model), [pooling], scheduler
     )
+    return json.dumps(pooled)
+
+
+class _PromptAgg:
+    """SQLite aggregate ``prompt_agg(text, instruction[, model])``."""
+
+    def __init__(self, cache=None, concurrency=None, stats=None, scheduler=None):
+        self.state = dict(cache=cache, stats=stats, scheduler=scheduler)
+        self.concurrency = concurrency or {}
+        self.texts = []
+        self.instruction = None
+        self.model = None
+
+    def step(self, text, instruction, model=DEFAULT_PROMPT_MODEL):
+        self.texts.append(text)
+        self.instruction = self.instruction or instruction
+        self.model = self.model or model
+
+    def finalize(self):
+        max_in_flight = self.concurrency.get(self.model, DEFAULT_CONCURRENCY)
+        (response,) = _prompt_reduce(
+            [(self.instruction, self.texts)],
+            self.model,
+            max_in_flight=max_in_flight,
+            **self.state,
+        )
+        return response
+
+
+class _EmbedMean:
+    """SQLite aggregate ``embed_mean(text[, model])``, as JSON."""
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
+        self.texts = []
+        self.model = None
+
+    def step(self, text, model=None):
+        self.texts.append(text)
+        self.model = self.model or model
+
+    def finalize(self):
+        if self.model is None:
+            embedding_model = registry.default_embedding_model()
+        else:
+            embedding_model = registry.get_embedding_model(self.model)
+        (mean,) = _embed_mean([self.texts], embedding_model, self.scheduler)
+        return None if mean is None else json.dumps(mean)
+
+
+def _embed(embedding_model, text, scheduler=None) -> list:
+    return _scheduled(
+        scheduler, embedding_model, lambda: embedding_model.embed(text), text
+    )
+
+
+def _embed_model(text: str, model: str, scheduler=None) -> str:
+    return json.dumps(_embed(registry.get_embedding_model(model), text, scheduler))
+
+
+def _json_embed_many(docs, embedding_model, scheduler=None) -> list:
+    """Replace the string leaves of parsed JSON ``docs`` with their embeddings.
+
+    All leaves, across all documents, are embedded with one batched call,
+    and each distinct string is embedded once.
+    """
+    strings = [s for doc in docs for s in _json_strings(doc)]
+    vectors = iter(_embed_unique(embedding_model, strings, scheduler))
+    return [json_recurse_apply(doc, lambda _: next(vectors)) for doc in docs]
+
+
+def _json_embed_model(js: str, model: str, scheduler=None) -> str:
+    (doc,) = _json_embed_many(
+        [json.loads(js)], registry.get_embedding_model(model), scheduler
+    )
+    return json.dumps(doc)
+
+
+def _embed_model_default(text: str, scheduler=None) -> str:
+    return json.dumps(_embed(registry.default_embedding_model(), text, scheduler))
+
+
+def _embed_blob_model(text: str, model: str, scheduler=None) -> bytes:
+    return _encode(_embed(registry.get_embedding_model(model), text, scheduler))
+
+
+def _embed_blob_model_default(text: str, scheduler=None) -> bytes:
+    return _encode(_embed(registry.default_embedding_model(), text, scheduler))
+
+
+def _embedding_to_json(blob: bytes) -> str:
+    return json.dumps(_decode(blob))
+
+
+def _json_to_embedding(js: str) -> bytes:
+    return _encode(json.loads(js))
 
 
 def _tsellm_init(con):
     """Entry-point for tsellm initialization."""
+    from .functions import SQLITE_AGGREGATES, SQLITE_FUNCTIONS, register_sqlite
+
     con.execute(TSELLM_CONFIG_SQL)
-    con.create_function("prompt", 2, _prompt_model)
-    con.create_function("prompt", 1, _prompt_model_default)
-    con.create_function("embed", 2, _embed_model)
-    con.create_function("embed", 1, _embed_model_default)
+    for udf in SQLITE_FUNCTIONS + SQLITE_AGGREGATES:
+        register_sqlite(con, udf, udf.sqlite)
@@ -0,0 +1,120 @@
+"""An asyncio event loop that runs a console's batches of prompts.
+
+A batch of prompts (a DuckDB chunk, a SQLite prefetch, a round of
+``prompt_agg``) is sent as coroutines on one loop, started on first use and
+kept for the life of the console. Models whose plugin provides an llm async
+model are prompted natively, so hundreds of requests can be in flight on a
+single thread, and their clients can reuse connections. Other models are
+prompted from a thread pool that lives as long as the loop.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import core
+from .core import _bind
+from .models import registry
+from .scheduler import estimate_tokens
+
+# asyncio is imported on first use, like llm: every console creates an engine,
+# and most statements never prompt a model.
+
+# Threads of the fallback pool. Threads are only started as prompts need them;
+# how many prompts are in flight is bounded by each batch's ``max_in_flight``.
+MAX_THREADS = 256
+
+
+async def _prompt_async(async_model, prompt, stats=None, scheduler=None) -> str:
+    model = async_model.model_id
+
+    async def execute():
+        response = async_model.prompt(prompt)
+        await response.text()
+        return response
+
+    if scheduler is None:
+        response = await execute()
+    else:
+        response = await scheduler.call_async(
+            model, execute, tokens=estimate_tokens(prompt)
+        )
+    if stats is not None:
+        stats.usage("prompt", model, response)
+    return await response.text()
+
+
+class Engine:
+    """The event loop, in a daemon thread, and the fallback thread pool."""
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        import asyncio
+
+        with self._lock:
+            if self._loop is None:
+                self._executor = ThreadPoolExecutor(
+                    MAX_THREADS, thread_name_prefix="tsellm-prompt"
+                )
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(self._executor)
+                self._thread = threading.Thread(
+                    target=loop.run_forever, name="tsellm-engine", daemon=True
+                )
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coroutine):
+        """Run ``coroutine`` on the loop and wait for its result."""
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self._start()).result()
+
+    def prompt_many(
+        self, model: str, prompts: list, max_in_flight: int, stats=None, scheduler=None
+    ) -> list:
+        """The responses of ``model`` to ``prompts``, in order.
+
+        At most ``max_in_flight`` prompts of the batch are in flight at once.
+        """
+        # Resolved here rather than on the loop: the first lookup loads plugins.
+        async_model = registry.get_async_model(model)
+        if async_model is not None:
+
+            def prompt(p):
+                return _prompt_async(async_model, p, stats, scheduler)
+
+        else:
+            prompt_model = _bind(core._prompt_model, stats=stats, scheduler=scheduler)
+
+            def prompt(p):
+                return self._loop.run_in_executor(None, prompt_model, p, model)
+
+        return self.run(self._gather(prompts, max_in_flight, prompt))
+
+    @staticmethod
+    async def _gather(prompts, max_in_flight, prompt):
+        import asyncio
+
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def bounded(p):
+            async with semaphore:
+                return await prompt(p)
+
+        return await asyncio.gather(*(bounded(p) for p in prompts))
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._loop = self._thread = self._executor = None
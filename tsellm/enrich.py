@@ -0,0 +1,200 @@
+"""``tsellm enrich``: fill a column with model outputs, resumably.
+
+    tsellm enrich docs.db docs --input text --output embedding --fn embed
+
+Rows whose output is still NULL are read in batches, computed with the
+batched and concurrent model calls of a prefetch, and written back
+one transaction per batch, together with a checkpoint in ``__tsellm``,
+so a job that is killed resumes after its last committed batch.
+"""
+
+import functools
+import sys
+import time
+
+from .core import DEFAULT_PROMPT_MODEL, _bind, read_config, write_config
+from .models import registry
+from .prefetch import (
+    _fetch_blob_embeddings,
+    _fetch_embeddings,
+    _fetch_json_embeddings,
+    _fetch_prompts,
+)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# What each function computes a batch of ``(input, model)`` calls with,
+# and the type of the column it fills, on SQLite and on DuckDB.
+FUNCTIONS = {
+    "prompt": (_fetch_prompts, _fetch_prompts, "TEXT", "VARCHAR"),
+    "embed": (
+        _fetch_embeddings,
+        functools.partial(_fetch_embeddings, encode=list),
+        "TEXT",
+        "FLOAT[]",
+    ),
+    "embed_blob": (
+        _fetch_blob_embeddings,
+        functools.partial(_fetch_embeddings, encode=list),
+        "BLOB",
+        "FLOAT[]",
+    ),
+    "json_embed": (
+        _fetch_json_embeddings,
+        _fetch_json_embeddings,
+        "TEXT",
+        "VARCHAR",
+    ),
+}
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _columns(con, table: str) -> list:
+    rows = con.execute(f"PRAGMA table_info({_quote(table)})").fetchall()
+    return [row[1] for row in rows]
+
+
+class Enrichment:
+    """Fills ``table.output`` with ``fn(input, model)``, a batch at a time.
+
+    On SQLite, rows are read in ``rowid`` order and the checkpoint is the
+    last ``rowid`` written. DuckDB gives updated rows new rowids, so there
+    rows are matched by their input value instead, and a resumed job
+    starts from whatever rows are still NULL.
+    """
+
+    def __init__(self, console, table, input, output, fn, model=None, batch_size=None):
+        self.console = console
+        self.con = console.connection
+        self.duckdb = console.db_type == "DuckDB"
+        self.table, self.input, self.output, self.fn = table, input, output, fn
+        if model is None:
+            model = (
+                DEFAULT_PROMPT_MODEL
+                if fn == "prompt"
+                else registry.default_embedding_model_id()
+            )
+        self.model = model
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        sqlite_fetch, duckdb_fetch, sqlite_type, duckdb_type = FUNCTIONS[fn]
+        self.fetch = _bind(
+            duckdb_fetch if self.duckdb else sqlite_fetch,
+            stats=console.stats,
+            scheduler=console.scheduler,
+        )
+        self.column_type = duckdb_type if self.duckdb else sqlite_type
+        self.key = f"{table}.{output}"
+        self.rowid = 0
+        self.rows = 0
+
+    def _load_checkpoint(self):
+        checkpoint = read_config(self.con).get("enrich", {}).get(self.key)
+        job = {"input": self.input, "fn": self.fn, "model": self.model}
+        if checkpoint and all(checkpoint.get(k) == v for k, v in job.items()):
+            self.rows = checkpoint["rows"]
+            if not self.duckdb:
+                self.rowid = checkpoint["rowid"]
+
+    def _save_checkpoint(self):
+        checkpoints = read_config(self.con).get("enrich", {})
+        checkpoints[self.key] = {
+            "input": self.input,
+            "fn": self.fn,
+            "model": self.model,
+            "rowid": self.rowid,
+            "rows": self.rows,
+        }
+        write_config(self.con, "enrich", checkpoints)
+
+    def _clear_checkpoint(self):
+        """Forget a finished job, so a later run rechecks every row."""
+        checkpoints = read_config(self.con).get("enrich", {})
+        if checkpoints.pop(self.key, None) is not None:
+            write_config(self.con, "enrich", checkpoints or None)
+
+    def _read(self) -> list:
+        """The next ``(rowid, input)`` rows to compute (distinct inputs on DuckDB)."""
+        table, input, output = map(_quote, (self.table, self.input, self.output))
+        pending = f"{input} IS NOT NULL AND {output} IS NULL"
+        if self.duckdb:
+            sql = f"SELECT DISTINCT NULL, {input} FROM {table} WHERE {pending} LIMIT ?"
+            return self.con.execute(sql, [self.batch_size]).fetchall()
+        sql = (
+            f"SELECT rowid, {input} FROM {table} "
+            f"WHERE rowid > ? AND {pending} ORDER BY rowid LIMIT ?"
+        )
+        return self.con.execute(sql, [self.rowid, self.batch_size]).fetchall()
+
+    def _write(self, rows, values) -> int:
+        """Fill in ``values`` for ``rows``, returning the number of rows updated."""
+        table, input, output = map(_quote, (self.table, self.input, self.output))
+        if self.duckdb:
+            import pyarrow as pa
+
+            self.con.register(
+                "__tsellm_rows",
+                pa.table({"input": [i for _, i in rows], "value": values}),
+            )
+            try:
+                (updated,) = self.con.execute(
+                    f"UPDATE {table} SET {output} = r.value::{self.column_type} "
+                    f"FROM __tsellm_rows r "
+                    f"WHERE {table}.{input} = r.input AND {table}.{output} IS NULL"
+                ).fetchone()
+            finally:
+                self.con.unregister("__tsellm_rows")
+            return updated
+        return self.con.executemany(
+            f"UPDATE {table} SET {output} = ? WHERE rowid = ?",
+            [(value, rowid) for (rowid, _), value in zip(rows, values)],
+        ).rowcount
+
+    def run(self, progress=sys.stderr) -> int:
+        """Fill the column, returning the number of rows filled."""
+        if self.output not in _columns(self.con, self.table):
+            self.con.execute(
+                f"ALTER TABLE {_quote(self.table)} "
+                f"ADD COLUMN {_quote(self.output)} {self.column_type}"
+            )
+        self._load_checkpoint()
+        started, done = time.perf_counter(), 0
+        while rows := self._read():
+            calls = [(value, self.model) for _, value in rows]
+            results = self.fetch(
+                list(dict.fromkeys(calls)),
+                self.console.cache,
+                self.console.concurrency,
+            )
+            # The cache commits on its own: a BEGIN within the batch's transaction
+            # would abort it on DuckDB. If we die before the batch commits,
+            # the resumed job finds these responses cached.
+            self.console.flush_cache()
+            self.con.execute("BEGIN TRANSACTION")
+            try:
+                updated = self._write(rows, [results[call] for call in calls])
+                # DuckDB reads whatever is still NULL: a batch that fills
+                # nothing would be read again, forever.
+                if self.duckdb and not updated:
+                    raise RuntimeError(
+                        f"{self.key}: a batch updated no rows; its {self.input} "
+                        f"values did not match after their round trip through Arrow"
+                    )
+                if not self.duckdb:
+                    self.rowid = rows[-1][0]
+                self.rows += updated
+                self._save_checkpoint()
+                self.con.execute("COMMIT")
+            except BaseException:
+                self.con.execute("ROLLBACK")
+                raise
+            done += updated
+            elapsed = time.perf_counter() - started
+            print(
+                f"{self.key}: {self.rows} rows ({done / elapsed:.1f} rows/s)",
+                file=progress,
+            )
+        self._clear_checkpoint()
+        return done
@@ -0,0 +1,324 @@
+"""The SQL functions tsellm registers, declared once for both backends.
+
+Each ``UDF`` declares a function's SQL signature and how it may be
+evaluated: whether a NULL argument makes the result NULL without a call,
+and whether the same arguments always give the same result. SQLite marks
+deterministic functions ``deterministic``, so it may evaluate a repeated
+call once, and short-circuits strict ones on NULL. DuckDB gets the
+declared types, ``FunctionNullHandling.DEFAULT`` for strict functions
+that never return NULL otherwise (NULL rows never reach them) and, for
+functions that are not deterministic, ``side_effects`` so it calls them
+for every row.
+"""
+
+from dataclasses import dataclass
+from typing import Callable
+
+from .chunking import _chunk
+from .core import (
+    _EmbedMean,
+    _PromptAgg,
+    _deferred,
+    _embed_blob_model,
+    _embed_blob_model_default,
+    _embed_chunks,
+    _embed_model,
+    _embed_model_default,
+    _embedding_to_json,
+    _json_embed_model,
+    _json_to_embedding,
+    _prompt_model,
+    _prompt_model_default,
+)
+from .index import _knn_json
+from .reducers import _embed_reduce
+
+EMBEDDING = "FLOAT[]"
+
+
+@dataclass(frozen=True)
+class UDF:
+    """One SQL function (or one arity of it).
+
+    ``parameters`` and ``returns`` are DuckDB types; on SQLite embeddings
+    are JSON text or float32 BLOBs. ``sqlite`` is the implementation
+    SQLite calls row by row (an aggregate class if ``aggregate``), and
+    ``duckdb`` names the implementation in ``tsellm.vectorized``, which
+    takes Arrow arrays unless ``arrow`` is False; either may be None where
+    a backend does not have the function. (That module is only imported
+    once a DuckDB console opens, so SQLite sessions never load PyArrow.)
+    ``nullable`` functions may return NULL for arguments that are not.
+    """
+
+    name: str
+    parameters: tuple
+    returns: str
+    sqlite: Callable = None
+    duckdb: str = None
+    arrow: bool = True
+    deterministic: bool = False
+    strict: bool = True
+    nullable: bool = False
+    aggregate: bool = False
+
+    @property
+    def n_args(self) -> int:
+        return len(self.parameters)
+
+
+UDFS = [
+    UDF(
+        "prompt",
+        ("VARCHAR", "VARCHAR"),
+        "VARCHAR",
+        _prompt_model,
+        "_prompt_model_arrow",
+    ),
+    UDF("prompt", ("VARCHAR",), "VARCHAR", _prompt_model_default),
+    UDF(
+        "embed",
+        ("VARCHAR", "VARCHAR"),
+        EMBEDDING,
+        _embed_model,
+        "_embed_model_arrow",
+        deterministic=True,
+    ),
+    UDF("embed", ("VARCHAR",), EMBEDDING, _embed_model_default, deterministic=True),
+    UDF(
+        "json_embed",
+        ("VARCHAR", "VARCHAR"),
+        "VARCHAR",
+        _json_embed_model,
+        "_json_embed_model_arrow",
+        deterministic=True,
+    ),
+    UDF(
+        "embed_blob",
+        ("VARCHAR", "VARCHAR"),
+        EMBEDDING,
+        _embed_blob_model,
+        "_embed_model_arrow",
+        deterministic=True,
+    ),
+    UDF(
+        "embed_blob",
+        ("VARCHAR",),
+        EMBEDDING,
+        _embed_blob_model_default,
+        deterministic=True,
+    ),
+    UDF(
+        "embedding_to_json",
+        (EMBEDDING,),
+        "VARCHAR",
+        _embedding_to_json,
+        "_embedding_to_json_arrow",
+        deterministic=True,
+    ),
+    UDF(
+        "json_to_embedding",
+        ("VARCHAR",),
+        EMBEDDING,
+        _json_to_embedding,
+        "_json_to_embedding_arrow",
+        deterministic=True,
+        nullable=True,
+    ),
+    # DuckDB reaches these functions, the similarity kernels, quantization,
+    # embed_reduce, knn and the aggregates through the macros in
+    # ``tsellm.vectorized``.
+    UDF("chunk", ("VARCHAR", "BIGINT"), "VARCHAR", _chunk, deterministic=True),
+    UDF(
+        "chunk",
+        ("VARCHAR", "BIGINT", "BIGINT"),
+        "VARCHAR",
+        _chunk,
+        deterministic=True,
+    ),
+    UDF(
+        "__tsellm_chunk",
+        ("VARCHAR", "BIGINT", "BIGINT"),
+        "VARCHAR[]",
+        duckdb="_chunk_list",
+        arrow=False,
+        deterministic=True,
+    ),
+    UDF(
+        "embed_chunks",
+        ("VARCHAR", "VARCHAR"),
+        EMBEDDING,
+        _embed_chunks,
+        deterministic=True,
+    ),
+    UDF(
+        "embed_chunks",
+        ("VARCHAR", "VARCHAR", "VARCHAR"),
+        EMBEDDING,
+        _embed_chunks,
+        deterministic=True,
+    ),
+    UDF(
+        "__tsellm_embed_chunks",
+        ("VARCHAR", "VARCHAR", "VARCHAR"),
+        EMBEDDING,
+        duckdb="_embed_chunks_arrow",
+        deterministic=True,
+    ),
+    *(
+        UDF(
+            name,
+            (EMBEDDING, EMBEDDING),
+            "DOUBLE",
+            _deferred(".similarity", f"_{name}"),
+            deterministic=True,
+            nullable=True,
+        )
+        for name in ("cosine_similarity", "dot_product", "l2_distance")
+    ),
+    *(
+        UDF(
+            f"__tsellm_{name}",
+            (EMBEDDING, EMBEDDING),
+            "DOUBLE",
+            duckdb=f"_{name}_arrow",
+            deterministic=True,
+            nullable=True,
+        )
+        for name in ("cosine_similarity", "dot_product", "l2_distance")
+    ),
+    *(
+        UDF(
+            name,
+            (EMBEDDING,),
+            "BLOB",
+            _deferred(".quantize", f"_{name}"),
+            deterministic=True,
+        )
+        for name in ("quantize_int8", "quantize_binary")
+    ),
+    *(
+        UDF(
+            f"__tsellm_{name}",
+            (EMBEDDING,),
+            "BLOB",
+            duckdb=f"_{name}_arrow",
+            deterministic=True,
+        )
+        for name in ("quantize_int8", "quantize_binary")
+    ),
+    UDF(
+        "int8_dot",
+        ("BLOB", "BLOB"),
+        "DOUBLE",
+        _deferred(".quantize", "_int8_dot"),
+        "_int8_dot_arrow",
+        deterministic=True,
+    ),
+    UDF(
+        "hamming_distance",
+        ("BLOB", "BLOB"),
+        "BIGINT",
+        _deferred(".quantize", "_hamming_distance"),
+        "_hamming_distance_arrow",
+        deterministic=True,
+    ),
+    # Like an index, a reducer of the same name may be fitted again.
+    UDF("embed_reduce", (EMBEDDING, "VARCHAR"), EMBEDDING, _embed_reduce),
+    UDF(
+        "__tsellm_embed_reduce",
+        (EMBEDDING, "VARCHAR"),
+        EMBEDDING,
+        duckdb="_embed_reduce_arrow",
+    ),
+    # An index changes as rows are added, and a NULL name is the default index.
+    UDF("knn", (EMBEDDING, "BIGINT"), "VARCHAR", _knn_json, strict=False),
+    UDF("knn", (EMBEDDING, "BIGINT", "VARCHAR"), "VARCHAR", _knn_json, strict=False),
+    UDF(
+        "__tsellm_knn",
+        (EMBEDDING, "BIGINT", "VARCHAR"),
+        "STRUCT(rowid BIGINT, distance DOUBLE)[]",
+        duckdb="_knn",
+        arrow=False,
+        strict=False,
+    ),
+    # The ``semantic_join`` table macro passes each side as one list of vectors.
+    UDF(
+        "__tsellm_semantic_join",
+        ("BIGINT[]", "FLOAT[][]", "BIGINT[]", "FLOAT[][]", "BIGINT"),
+        "STRUCT(left_rowid BIGINT, right_rowid BIGINT, score DOUBLE)[]",
+        duckdb="_semantic_join_arrow",
+        deterministic=True,
+    ),
+    UDF(
+        "prompt_agg",
+        ("VARCHAR", "VARCHAR", "VARCHAR"),
+        "VARCHAR",
+        _PromptAgg,
+        aggregate=True,
+    ),
+    UDF("prompt_agg", ("VARCHAR", "VARCHAR"), "VARCHAR", _PromptAgg, aggregate=True),
+    UDF("embed_mean", ("VARCHAR", "VARCHAR"), EMBEDDING, _EmbedMean, aggregate=True),
+    UDF("embed_mean", ("VARCHAR",), EMBEDDING, _EmbedMean, aggregate=True),
+    UDF(
+        "__tsellm_prompt_agg",
+        ("VARCHAR[]", "VARCHAR", "VARCHAR"),
+        "VARCHAR",
+        duckdb="_prompt_agg_arrow",
+        strict=False,
+    ),
+    # A NULL model is the default embedding model.
+    UDF(
+        "__tsellm_embed_mean",
+        ("VARCHAR[]", "VARCHAR"),
+        EMBEDDING,
+        duckdb="_embed_mean_arrow",
+        deterministic=True,
+        strict=False,
+    ),
+]
+
+SQLITE_FUNCTIONS = [udf for udf in UDFS if udf.sqlite and not udf.aggregate]
+SQLITE_AGGREGATES = [udf for udf in UDFS if udf.sqlite and udf.aggregate]
+DUCKDB_FUNCTIONS = [udf for udf in UDFS if udf.duckdb]
+
+
+def _strict(func):
+    def call(*args):
+        return None if None in args else func(*args)
+
+    return call
+
+
+def register_sqlite(con, udf: UDF, func):
+    """Register ``func``, ``udf``'s SQLite implementation, on ``con``."""
+    if udf.aggregate:
+        con.create_aggregate(udf.name, udf.n_args, func)
+    else:
+        con.create_function(
+            udf.name,
+            udf.n_args,
+            _strict(func) if udf.strict else func,
+            deterministic=udf.deterministic,
+        )
+
+
+def register_duckdb(con, udf: UDF, func):
+    """Register ``func``, ``udf``'s DuckDB implementation, on ``con``.
+
+    A function registered before, with other options, is replaced.
+    """
+    import duckdb
+
+    try:
+        con.remove_function(udf.name)
+    except duckdb.InvalidInputException:
+        pass
+    con.create_function(
+        udf.name,
+        func,
+        [duckdb.sqltype(t) for t in udf.parameters],
+        duckdb.sqltype(udf.returns),
+        type="arrow" if udf.arrow else "native",
+        null_handling="default" if udf.strict and not udf.nullable else "special",
+        side_effects=not udf.deterministic,
+    )
@@ -0,0 +1,71 @@
+"""Nearest-neighbour indexes of a database and the ``knn`` UDF that searches them.
+
+The indexes themselves live in ``tsellm.ivf``, which is only imported
+(along with NumPy) once an index is opened or built.
+"""
+
+import json
+import shutil
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .ivf import VectorIndex
+
+
+class IndexCatalog:
+    """The indexes of one database, keyed by ``"table.column"``.
+
+    Metadata is kept in ``__tsellm`` under ``index:<table>.<column>``
+    and read when the console loads, as DuckDB UDFs cannot query the database.
+    """
+
+    PREFIX = "index:"
+
+    def __init__(self, config: dict):
+        self.metadata = {
+            key[len(self.PREFIX) :]: value
+            for key, value in config.items()
+            if key.startswith(self.PREFIX)
+        }
+        self._open = {}
+
+    def get(self, name=None) -> "VectorIndex":
+        if name is None:
+            if len(self.metadata) != 1:
+                raise ValueError(
+                    "Specify the index to search, one of: "
+                    + ", ".join(sorted(self.metadata))
+                )
+            (name,) = self.metadata
+        if name not in self.metadata:
+            raise ValueError(f"No index on {name}")
+        if name not in self._open:
+            from .ivf import VectorIndex
+
+            meta = self.metadata[name]
+            self._open[name] = VectorIndex.open(meta["path"], meta["nprobe"])
+        return self._open[name]
+
+    def put(self, name, index: "VectorIndex") -> dict:
+        self._open[name] = index
+        self.metadata[name] = index.metadata()
+        return self.metadata[name]
+
+    def drop(self, name):
+        meta = self.metadata.pop(name)
+        self._open.pop(name, None)
+        shutil.rmtree(meta["path"], ignore_errors=True)
+
+
+def _knn(query, k: int, name=None, indexes=None) -> list:
+    if query is None or k is None:
+        return None
+    return [
+        {"rowid": rowid, "distance": distance}
+        for rowid, distance in indexes.get(name).search(query, k)
+    ]
+
+
+def _knn_json(query, k: int, name=None, indexes=None) -> str:
+    result = _knn(query, k, name, indexes=indexes)
+    return None if result is None else json.dumps(result)
@@ -0,0 +1,182 @@
+"""Approximate nearest-neighbour search over embedding columns.
+
+An IVF (inverted file) index: vectors are clustered with spherical k-means,
+and a query only scans the vectors in the ``nprobe`` clusters
+whose centroids are closest to it.
+Arrays are stored as ``.npy`` files in a sidecar directory next to the database
+and memory-mapped, so opening an index does not read it into memory.
+Distances are cosine distances, ``1 - cosine_similarity``.
+"""
+
+import math
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .similarity import as_vector
+
+_ASSIGN_BLOCK = 65536
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Nearest centroid of each vector, computed in blocks to bound memory."""
+    return np.concatenate(
+        [
+            np.argmax(vectors[i : i + _ASSIGN_BLOCK] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), _ASSIGN_BLOCK)
+        ]
+        or [np.empty(0, dtype=np.int64)]
+    ).astype(np.int32)
+
+
+def _kmeans(vectors: np.ndarray, nlist: int, iterations=10, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * 256)
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.bincount(assignment, minlength=nlist) == 0
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class VectorIndex:
+    def __init__(self, path, centroids, vectors, rowids, lists, nprobe):
+        self.path = Path(path)
+        self.centroids = centroids
+        self.vectors = vectors
+        self.rowids = rowids
+        self.lists = lists
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    @property
+    def max_rowid(self):
+        return int(self.rowids.max()) if len(self.rowids) else None
+
+    @classmethod
+    def build(cls, path, rowids, vectors, nlist=None, nprobe=None, seed=0):
+        if not len(vectors):
+            raise ValueError("Cannot build an index over an empty column")
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        nlist = nlist or min(max(int(math.sqrt(len(vectors))), 1), 4096)
+        nlist = min(nlist, len(vectors))
+        centroids = _kmeans(vectors, nlist, seed=seed)
+        index = cls(
+            path,
+            centroids,
+            vectors,
+            np.asarray(rowids, dtype=np.int64),
+            _assign(vectors, centroids),
+            nprobe or max(1, math.ceil(nlist / 10)),
+        )
+        index.save()
+        return cls.open(path, index.nprobe)
+
+    @classmethod
+    def open(cls, path, nprobe):
+        path = Path(path)
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r")
+            for name in ("centroids", "vectors", "rowids", "lists")
+        }
+        return cls(path, nprobe=nprobe, **arrays)
+
+    def save(self):
+        # Files are replaced rather than overwritten in place,
+        # as other instances may still have the old ones memory-mapped.
+        self.path.mkdir(parents=True, exist_ok=True)
+        for name in ("centroids", "vectors", "rowids", "lists"):
+            tmp = self.path / f"{name}.npy.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, np.asarray(getattr(self, name)))
+            os.replace(tmp, self.path / f"{name}.npy")
+
+    def add(self, rowids, vectors) -> "VectorIndex":
+        """Append new rows, assigning them to the existing clusters without retraining."""
+        if not len(vectors):
+            return self
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        if vectors.shape[1] != self.dim:
+            raise ValueError(
+                f"Vector dimensions differ: {vectors.shape[1]} != {self.dim}"
+            )
+        grown = VectorIndex(
+            self.path,
+            np.asarray(self.centroids),
+            np.concatenate([self.vectors, vectors]),
+            np.concatenate([self.rowids, np.asarray(rowids, dtype=np.int64)]),
+            np.concatenate([self.lists, _assign(vectors, self.centroids)]),
+            self.nprobe,
+        )
+        grown.save()
+        return VectorIndex.open(self.path, self.nprobe)
+
+    def _top(self, candidates, query, k):
+        distances = 1 - np.asarray(self.vectors[candidates] @ query)
+        k = min(k, len(candidates))
+        top = np.argpartition(distances, k - 1)[:k] if k else []
+        top = sorted(top, key=lambda i: distances[i])
+        return [(int(self.rowids[candidates[i]]), float(distances[i])) for i in top]
+
+    def search(self, query, k: int, nprobe=None) -> list:
+        """The ``k`` nearest rows to ``query`` as ``(rowid, distance)`` pairs."""
+        query = _normalize(as_vector(query))
+        probes = np.argsort(-(self.centroids @ query))[: nprobe or self.nprobe]
+        return self._top(np.flatnonzero(np.isin(self.lists, probes)), query, k)
+
+    def exact(self, query, k: int) -> list:
+        """Brute-force search, the ground truth for ``search``."""
+        return self._top(np.arange(len(self.rowids)), _normalize(as_vector(query)), k)
+
+    def metadata(self) -> dict:
+        return {
+            "path": str(self.path),
+            "nlist": self.nlist,
+            "nprobe": self.nprobe,
+            "dim": self.dim,
+            "count": len(self.rowids),
+            "max_rowid": self.max_rowid,
+        }
+
+
+def benchmark(index: VectorIndex, k=10, queries=100, nprobes=None, seed=0):
+    """Recall@k and mean latency of ``search`` for increasing ``nprobe``.
+
+    Queries are sampled from the indexed vectors themselves,
+    and recall is measured against ``exact``.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(index.rowids)
+    sample = index.vectors[np.sort(rng.choice(n, min(queries, n), replace=False))]
+    truth = [{r for r, _ in index.exact(q, k)} for q in sample]
+    nprobes = nprobes or sorted(
+        {1, *(max(1, index.nlist * p // 100) for p in (1, 5, 10, 25, 50)), index.nlist}
+    )
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [{r for r, _ in index.search(q, k, nprobe)} for q in sample]
+        elapsed = time.perf_counter() - start
+        recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth) if t])
+        results.append((nprobe, float(recall), 1000 * elapsed / len(sample)))
+    return results
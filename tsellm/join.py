@@ -0,0 +1,88 @@
+"""Exact top-k semantic join of two embedding columns.
+
+Both columns are loaded into contiguous float32 matrices and normalized,
+and the cosine similarity of every pair is computed as a matrix product,
+a block of left rows at a time. Blocks are sized so that their scores fit
+in a fraction of the memory available, so a join of two large tables
+never holds the whole ``(n_left, n_right)`` score matrix.
+"""
+
+import os
+from typing import Optional
+
+import numpy as np
+
+from .ivf import _normalize
+from .similarity import as_vector
+
+# Share of the available memory a block's scores may take.
+MEMORY_FRACTION = 0.25
+# Assumed available when the platform does not say.
+DEFAULT_MEMORY = 1 << 30
+
+
+def available_memory() -> int:
+    """Bytes of physical memory currently available."""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return DEFAULT_MEMORY
+
+
+def block_rows(n_right: int, memory: Optional[int] = None) -> int:
+    """Left rows per block, whose ``(rows, n_right)`` float32 scores fit in memory."""
+    if memory is None:
+        memory = available_memory()
+    return max(1, int(memory * MEMORY_FRACTION) // (4 * max(n_right, 1)))
+
+
+def as_matrix(vectors) -> np.ndarray:
+    """Embeddings (JSON text, float32 BLOBs or lists) as one ``(n, d)`` matrix."""
+    vectors = [as_vector(v) for v in vectors]
+    if len({len(v) for v in vectors}) > 1:
+        raise ValueError("Vector dimensions differ within a column")
+    if not vectors:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack(vectors).astype(np.float32, copy=False)
+
+
+def top_k(left: np.ndarray, right: np.ndarray, k: int, rows: Optional[int] = None):
+    """The ``k`` rows of ``right`` most similar to each row of ``left``.
+
+    Returns the positions in ``left`` and in ``right`` of each pair and their
+    cosine similarity, ordered by left position and then by similarity.
+    """
+    if k < 1:
+        raise ValueError("k must be positive")
+    if not len(left) or not len(right):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float32)
+    if left.shape[1] != right.shape[1]:
+        raise ValueError(
+            f"Vector dimensions differ: {left.shape[1]} != {right.shape[1]}"
+        )
+    left, right = _normalize(left), _normalize(right)
+    k = min(k, len(right))
+    rows = rows or block_rows(len(right))
+    lefts, rights, scores = [], [], []
+    for start in range(0, len(left), rows):
+        block = left[start : start + rows] @ right.T
+        if k < len(right):
+            best = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        else:
+            best = np.broadcast_to(np.arange(k), (len(block), k))
+        best_scores = np.take_along_axis(block, best, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        lefts.append(np.repeat(np.arange(start, start + len(block)), k))
+        rights.append(np.take_along_axis(best, order, axis=1).ravel())
+        scores.append(np.take_along_axis(best_scores, order, axis=1).ravel())
+    return np.concatenate(lefts), np.concatenate(rights), np.concatenate(scores)
+
+
+def semantic_join(
+    left_rowids, left, right_rowids, right, k: int, rows: Optional[int] = None
+):
+    """``(left_rowid, right_rowid, score)`` of the ``k`` best matches of each left row."""
+    left_rowids, right_rowids = np.asarray(left_rowids), np.asarray(right_rowids)
+    i, j, scores = top_k(left, right, k, rows)
+    return zip(left_rowids[i].tolist(), right_rowids[j].tolist(), scores.tolist())
@@ -0,0 +1,162 @@
+import gc
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+# llm is imported on first use: importing it loads every installed plugin,
+# which dominates the startup time of statements that never call a model.
+if TYPE_CHECKING:
+    import llm
+
+
+def _rss() -> int:
+    """Resident set size of this process in bytes, or 0 where it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class ModelRegistry:
+    """Process-wide cache of resolved llm model instances.
+
+    Each model is looked up through llm (and its plugins) once and kept warm.
+    Least-recently-used models are dropped once more than ``max_models``
+    are loaded, or once their estimated footprint exceeds ``max_memory`` bytes.
+    A model's footprint is the growth in resident memory observed
+    while it was being resolved and, for preloaded models, warmed up.
+    """
+
+    def __init__(self, max_models=None, max_memory=None):
+        self.max_models = max_models
+        self.max_memory = max_memory
+        self._models = OrderedDict()
+        self._footprints = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._sync_only = set()
+        self._default_embedding_model = None
+
+    def _get(self, kind, model_id, load):
+        key = (kind, model_id)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # Loading happens outside the registry lock, so one slow model
+        # does not block lookups of the others; concurrent callers of the
+        # same model wait for the first load instead of repeating it.
+        with key_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+            before = _rss()
+            model = load(model_id)
+            with self._lock:
+                self._models[key] = model
+                self._footprints[key] = max(_rss() - before, 0)
+                self._evict()
+            return model
+
+    def _evict(self):
+        def over_budget():
+            if self.max_models is not None and len(self._models) > self.max_models:
+                return True
+            return (
+                self.max_memory is not None
+                and sum(self._footprints.values()) > self.max_memory
+            )
+
+        evicted = False
+        while len(self._models) > 1 and over_budget():
+            key, _ = self._models.popitem(last=False)
+            self._footprints.pop(key, None)
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def get_model(self, model_id: str) -> "llm.Model":
+        import llm
+
+        return self._get("model", model_id, llm.get_model)
+
+    def get_async_model(self, model_id: str):
+        """The async version of ``model_id``, or None if its plugin has none."""
+        import llm
+
+        if model_id in self._sync_only:
+            return None
+        try:
+            return self._get("async", model_id, llm.get_async_model)
+        except llm.UnknownModelError:
+            # Remembered outside the LRU, so it never evicts a loaded model.
+            self._sync_only.add(model_id)
+            return None
+
+    def get_embedding_model(self, model_id: str) -> "llm.EmbeddingModel":
+        import llm
+
+        return self._get("embedding", model_id, llm.get_embedding_model)
+
+    def default_embedding_model_id(self) -> str:
+        if self._default_embedding_model is None:
+            from llm import cli as llm_cli
+
+            self._default_embedding_model = llm_cli.get_default_embedding_model()
+        return self._default_embedding_model
+
+    def default_embedding_model(self) -> "llm.EmbeddingModel":
+        return self.get_embedding_model(self.default_embedding_model_id())
+
+    def warm(self, model_id: str):
+        """Resolve ``model_id`` and make it load its weights where llm allows it.
+
+        Embedding models are warmed up with a throwaway ``embed`` call.
+        llm has no generic hook to load a chat model's weights,
+        so those are only resolved.
+        """
+        import llm
+
+        try:
+            self._get(
+                "embedding",
+                model_id,
+                lambda m: _warmed_up(llm.get_embedding_model(m)),
+            )
+        except llm.UnknownModelError:
+            self.get_model(model_id)
+
+    def preload(self, model_id: str) -> threading.Thread:
+        """Warm ``model_id`` in a background thread."""
+        thread = threading.Thread(
+            target=self.warm, args=(model_id,), name=f"tsellm-preload-{model_id}"
+        )
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._footprints.clear()
+            self._sync_only.clear()
+            self._default_embedding_model = None
+
+    def __contains__(self, model_id) -> bool:
+        return any(m == model_id for _, m in self._models)
+
+
+def _warmed_up(model):
+    try:
+        model.embed("")
+    except Exception:
+        # Warming up is best-effort; the model still resolved.
+        pass
+    return model
+
+
+registry = ModelRegistry()
@@ -0,0 +1,238 @@
+"""Streaming result writers.
+
+Results are fetched and written in batches of ``BATCH_SIZE`` rows,
+so memory use does not grow with the size of the result.
+PyArrow is only imported by the Arrow and Parquet writers.
+"""
+
+import base64
+import csv
+import io
+import itertools
+import json
+import sys
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+BATCH_SIZE = 1024
+# Rows the Arrow writers hold back while a column has only seen NULLs.
+BUFFER_ROWS = 64 * BATCH_SIZE
+
+FORMATS = ("tuple", "csv", "tsv", "jsonl", "arrow", "parquet")
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode("ascii")
+    return str(value)
+
+
+class ResultWriter(ABC):
+    """Writes the rows of one result set to ``stream``."""
+
+    binary = False
+    columnar = False
+
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = columns
+
+    @abstractmethod
+    def write_rows(self, rows):
+        pass
+
+    def write_batch(self, batch: "pa.RecordBatch"):
+        self.write_rows([tuple(r.values()) for r in batch.to_pylist()])
+
+    def close(self):
+        self.stream.flush()
+
+
+class TupleWriter(ResultWriter):
+    def write_rows(self, rows):
+        self.stream.write("".join(f"{row!r}\n" for row in rows))
+
+
+class CSVWriter(ResultWriter):
+    delimiter = ","
+
+    def __init__(self, stream, columns):
+        super().__init__(stream, columns)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(
+            self.buffer, delimiter=self.delimiter, lineterminator="\n"
+        )
+        self.write_rows([columns])
+
+    def write_rows(self, rows):
+        self.writer.writerows(
+            [
+                [_json_default(v) if isinstance(v, bytes) else v for v in row]
+                for row in rows
+            ]
+        )
+        self.stream.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+class TSVWriter(CSVWriter):
+    delimiter = "\t"
+
+
+class JSONLWriter(ResultWriter):
+    def write_rows(self, rows):
+        self.stream.write(
+            "".join(
+                json.dumps(dict(zip(self.columns, row)), default=_json_default) + "\n"
+                for row in rows
+            )
+        )
+
+
+class ArrowWriter(ResultWriter):
+    """Writes an Arrow IPC stream.
+
+    Its schema is fixed by the first batch written, but a column of SQLite
+    rows is typed by the values in it. Batches are held back while a column
+    has only seen NULLs (up to ``BUFFER_ROWS`` rows), the schemas held back
+    are unified, promoting integers to doubles where reals appear too,
+    and every batch is cast to the result.
+    """
+
+    binary = True
+    columnar = True
+
+    def __init__(self, stream, columns):
+        super().__init__(stream, columns)
+        self.writer = None
+        self.schema = None
+        self.held = []
+
+    def _open(self, schema):
+        import pyarrow as pa
+
+        return pa.ipc.new_stream(self.stream, schema)
+
+    def _cast(self, batch: "pa.RecordBatch") -> "pa.RecordBatch":
+        import pyarrow as pa
+
+        if batch.schema == self.schema:
+            return batch
+        try:
+            return batch.cast(self.schema)
+        except pa.ArrowException as e:
+            raise ValueError(
+                f"A column's type changed after the first rows were written; "
+                f"CAST it in the query: {e}"
+            ) from None
+
+    def _start(self):
+        import pyarrow as pa
+
+        try:
+            self.schema = pa.unify_schemas(
+                [batch.schema for batch in self.held], promote_options="permissive"
+            )
+        except pa.ArrowException as e:
+            raise ValueError(
+                f"A column mixes types; CAST it in the query: {e}"
+            ) from None
+        self.writer = self._open(self.schema)
+        held, self.held = self.held, []
+        for batch in held:
+            self.writer.write_batch(self._cast(batch))
+
+    def write_batch(self, batch: "pa.RecordBatch"):
+        import pyarrow as pa
+
+        if self.writer is not None:
+            self.writer.write_batch(self._cast(batch))
+            return
+        self.held.append(batch)
+        typed = {
+            field.name
+            for held in self.held
+            for field in held.schema
+            if not pa.types.is_null(field.type)
+        }
+        rows = sum(held.num_rows for held in self.held)
+        if len(typed) < batch.num_columns and rows < BUFFER_ROWS:
+            return
+        self._start()
+
+    def write_rows(self, rows):
+        import pyarrow as pa
+
+        self.write_batch(
+            pa.RecordBatch.from_pylist([dict(zip(self.columns, row)) for row in rows])
+        )
+
+    def close(self):
+        import pyarrow as pa
+
+        if self.writer is None:
+            if not self.held:
+                self.held.append(
+                    pa.RecordBatch.from_pydict({c: pa.array([]) for c in self.columns})
+                )
+            self._start()
+        self.writer.close()
+        super().close()
+
+
+class ParquetWriter(ArrowWriter):
+    def _open(self, schema):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetWriter(self.stream, schema)
+
+
+WRITERS = {
+    "tuple": TupleWriter,
+    "csv": CSVWriter,
+    "tsv": TSVWriter,
+    "jsonl": JSONLWriter,
+    "arrow": ArrowWriter,
+    "parquet": ParquetWriter,
+}
+
+
+def write_result(cursor, fmt="tuple", stream=None):
+    """Stream the result of an executed ``cursor`` in format ``fmt``.
+
+    DuckDB results are read as Arrow record batches for the columnar formats;
+    everything else is read with ``fetchmany``.
+    """
+    if cursor.description is None:
+        return
+    writer_class = WRITERS[fmt]
+    if stream is None:
+        stream = sys.stdout.buffer if writer_class.binary else sys.stdout
+    writer = writer_class(stream, [d[0] for d in cursor.description])
+    # Newer DuckDB versions deprecate fetch_record_batch for to_arrow_reader.
+    record_batches = getattr(cursor, "to_arrow_reader", None) or getattr(
+        cursor, "fetch_record_batch", None
+    )
+    if writer.columnar and record_batches is not None:
+        for batch in record_batches(BATCH_SIZE):
+            writer.write_batch(batch)
+    else:
+        while rows := cursor.fetchmany(BATCH_SIZE):
+            writer.write_rows(rows)
+    writer.close()
+
+
+def write_rows(columns, rows, fmt="tuple", stream=None):
+    """Stream ``rows``, an iterable of tuples, in format ``fmt``."""
+    writer_class = WRITERS[fmt]
+    if stream is None:
+        stream = sys.stdout.buffer if writer_class.binary else sys.stdout
+    writer = writer_class(stream, list(columns))
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, BATCH_SIZE)):
+        writer.write_rows(batch)
+    writer.close()
@@ -0,0 +1,181 @@
+"""Prefetching of UDF results for SQLite.
+
+SQLite calls Python functions one row at a time, so model calls cannot overlap.
+A prefetch first runs the statement with stub functions that only record
+their arguments, computes the distinct calls concurrently and in batches,
+then serves the real run of the statement from memory.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PROMPT_MODEL,
+    _bind,
+    _encode,
+    _embed_blob_model,
+    _embed_blob_model_default,
+    _embed_model,
+    _embed_model_default,
+    _embed_unique,
+    _json_embed_many,
+    _json_embed_model,
+    _prompt_many,
+    _prompt_model,
+    _prompt_model_default,
+)
+from .models import registry
+
+
+def _fetch_prompts(calls, cache, concurrency, stats=None, scheduler=None, stream=None):
+    """Map ``(prompt, model)`` tuples to responses."""
+    results = {}
+    for model, prompts in _group_by_model(calls).items():
+        max_in_flight = concurrency.get(model, DEFAULT_CONCURRENCY)
+        for prompt, response in zip(
+            prompts,
+            _prompt_many(
+                prompts, model, cache, max_in_flight, stats, scheduler, stream
+            ),
+        ):
+            results[(prompt, model)] = response
+    return results
+
+
+def _fetch_prompts_default(
+    calls, cache, concurrency, stats=None, scheduler=None, stream=None
+):
+    model = DEFAULT_PROMPT_MODEL
+    responses = _fetch_prompts(
+        [(p, model) for (p,) in calls], cache, concurrency, stats, scheduler, stream
+    )
+    return {(p,): responses[(p, model)] for (p,) in calls}
+
+
+def _fetch_embeddings(calls, cache, concurrency, encode=json.dumps, scheduler=None):
+    results = {}
+    for model, texts in _group_by_model(calls).items():
+        vectors = _embed_unique(registry.get_embedding_model(model), texts, scheduler)
+        for text, vector in zip(texts, vectors):
+            results[(text, model)] = encode(vector)
+    return results
+
+
+def _fetch_embeddings_default(
+    calls, cache, concurrency, encode=json.dumps, scheduler=None
+):
+    texts = [text for (text,) in calls]
+    vectors = _embed_unique(registry.default_embedding_model(), texts, scheduler)
+    return {(text,): encode(vector) for text, vector in zip(texts, vectors)}
+
+
+def _fetch_blob_embeddings(calls, cache, concurrency, scheduler=None):
+    return _fetch_embeddings(
+        calls, cache, concurrency, encode=_encode, scheduler=scheduler
+    )
+
+
+def _fetch_blob_embeddings_default(calls, cache, concurrency, scheduler=None):
+    return _fetch_embeddings_default(
+        calls, cache, concurrency, encode=_encode, scheduler=scheduler
+    )
+
+
+def _fetch_json_embeddings(calls, cache, concurrency, scheduler=None):
+    results = {}
+    for model, docs in _group_by_model(calls).items():
+        embedded = _json_embed_many(
+            [json.loads(js) for js in docs],
+            registry.get_embedding_model(model),
+            scheduler,
+        )
+        for js, doc in zip(docs, embedded):
+            results[(js, model)] = json.dumps(doc)
+    return results
+
+
+def _group_by_model(calls):
+    groups = {}
+    for value, model in calls:
+        groups.setdefault(model, []).append(value)
+    return groups
+
+
+BATCHED = {
+    _prompt_model: _fetch_prompts,
+    _prompt_model_default: _fetch_prompts_default,
+    _embed_model: _fetch_embeddings,
+    _embed_model_default: _fetch_embeddings_default,
+    _embed_blob_model: _fetch_blob_embeddings,
+    _embed_blob_model_default: _fetch_blob_embeddings_default,
+    _json_embed_model: _fetch_json_embeddings,
+}
+
+
+class Prefetch:
+    """Records UDF calls, then computes and serves their results."""
+
+    def __init__(self):
+        self.calls = {}
+        self.results = {}
+
+    def recorder(self, py_func, bound):
+        """A stub for ``py_func`` that records its arguments and returns NULL.
+
+        Functions without a batched implementation keep running ``bound``.
+        """
+        if py_func not in BATCHED:
+            return bound
+        # A dict rather than a set keeps the calls in scan order,
+        # so worker shards are contiguous ranges of rows.
+        calls = self.calls.setdefault(py_func, {})
+
+        def record(*args):
+            if None not in args:
+                calls[args] = None
+
+        return record
+
+    def prompt_calls(self) -> int:
+        """Number of distinct prompt calls recorded."""
+        return sum(
+            len(self.calls.get(py_func, ()))
+            for py_func in (_prompt_model, _prompt_model_default)
+        )
+
+    def fetch(
+        self, cache=None, concurrency=None, stats=None, scheduler=None, stream=None
+    ):
+        """Compute every recorded call, running each function's batch concurrently."""
+        concurrency = concurrency or {}
+        with ThreadPoolExecutor(max_workers=DEFAULT_CONCURRENCY) as pool:
+            futures = {
+                py_func: pool.submit(
+                    _bind(
+                        BATCHED[py_func],
+                        stats=stats,
+                        scheduler=scheduler,
+                        stream=stream,
+                    ),
+                    list(calls),
+                    cache,
+                    concurrency,
+                )
+                for py_func, calls in self.calls.items()
+                if calls
+            }
+            for py_func, future in futures.items():
+                self.results[py_func] = future.result()
+
+    def memoized(self, py_func, bound):
+        """Serve prefetched results for ``py_func``, calling ``bound`` for the rest."""
+        results = self.results.get(py_func, {})
+
+        def serve(*args):
+            try:
+                return results[args]
+            except KeyError:
+                return bound(*args)
+
+        return serve
@@ -0,0 +1,192 @@
+"""Compact embeddings: int8 and binary quantization, and fitted reducers.
+
+An int8 BLOB is a little-endian float32 scale followed by one signed byte
+per dimension, ``round(v / scale)`` with ``scale = max(|v|) / 127``,
+so it is about 4x smaller than a float32 BLOB; ``int8_dot`` compares two
+of them. A binary BLOB keeps only the sign of each dimension, one bit each
+(32x smaller), and ``hamming_distance`` counts the bits two of them differ in.
+
+A reducer projects vectors onto fewer dimensions: the principal components
+of a column (PCA, uncentered, so that dot products and cosine similarities
+are preserved as well as ``dim`` dimensions can), or a random Gaussian
+projection, which needs no fitting and roughly preserves them.
+Reducers are stored in ``__tsellm``.
+"""
+
+import json
+import time
+
+import numpy as np
+
+from .ivf import _normalize
+from .similarity import as_vector
+
+METHODS = ("pca", "random")
+
+
+def int8_codes(vectors: np.ndarray):
+    """Scales and int8 codes of the rows of an ``(n, d)`` matrix."""
+    scales = np.abs(vectors).max(axis=1, initial=0) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return scales.astype(np.float32), codes
+
+
+def int8_blobs(vectors: np.ndarray) -> np.ndarray:
+    """The int8 BLOBs of the rows of a matrix, as a ``(n, 4 + d)`` byte matrix."""
+    scales, codes = int8_codes(vectors)
+    return np.hstack(
+        [scales.astype("<f4")[:, None].view(np.uint8), codes.view(np.uint8)]
+    )
+
+
+def int8_dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Row-wise dot products of two matrices of int8 BLOBs (or one and a row)."""
+    if a.shape[1] != b.shape[1]:
+        raise ValueError(
+            f"Vector dimensions differ: {a.shape[1] - 4} != {b.shape[1] - 4}"
+        )
+    scales = a[:, :4].copy().view("<f4")[:, 0] * b[:, :4].copy().view("<f4")[:, 0]
+    codes = a[:, 4:].view(np.int8).astype(np.int32) * b[:, 4:].view(np.int8)
+    return scales.astype(np.float64) * codes.sum(axis=1)
+
+
+def binary_blobs(vectors: np.ndarray) -> np.ndarray:
+    """The sign bits of the rows of a matrix, packed into ``ceil(d / 8)`` bytes each."""
+    return np.packbits(vectors > 0, axis=1)
+
+
+# Set bits of each byte value (``np.bitwise_count`` needs NumPy 2).
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Row-wise number of differing bits of two matrices of binary BLOBs."""
+    if a.shape[1] != b.shape[1]:
+        raise ValueError(
+            f"Vector dimensions differ: {a.shape[1] * 8} != {b.shape[1] * 8}"
+        )
+    return _POPCOUNT[a ^ b].sum(axis=1, dtype=np.int64)
+
+
+def _blob(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.uint8)[None, :]
+
+
+def _quantize_int8(v) -> bytes:
+    return int8_blobs(as_vector(v)[None, :]).tobytes()
+
+
+def _quantize_binary(v) -> bytes:
+    return binary_blobs(as_vector(v)[None, :]).tobytes()
+
+
+def _int8_dot(a: bytes, b: bytes) -> float:
+    return float(int8_dot(_blob(a), _blob(b))[0])
+
+
+def _hamming_distance(a: bytes, b: bytes) -> int:
+    return int(hamming_distance(_blob(a), _blob(b))[0])
+
+
+class Reducer:
+    """Projects ``(n, d)`` vectors to ``(n, dim)``, as ``vectors @ components``."""
+
+    def __init__(self, method, components):
+        self.method = method
+        self.components = np.asarray(components, dtype=np.float32)
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def input_dim(self) -> int:
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, vectors, dim: int, method="pca", seed=0) -> "Reducer":
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if method not in METHODS:
+            raise ValueError(f"Reducer method must be one of {', '.join(METHODS)}")
+        if not len(vectors):
+            raise ValueError("Cannot fit a reducer over an empty column")
+        if not 1 <= dim <= vectors.shape[1]:
+            raise ValueError(f"Reduced dimensions must be in [1, {vectors.shape[1]}]")
+        if method == "random":
+            rng = np.random.default_rng(seed)
+            components = rng.normal(size=(vectors.shape[1], dim)) / np.sqrt(dim)
+            return cls(method, components)
+        # The top eigenvectors of the d x d second moment matrix,
+        # so no more than the n x d vectors are ever held.
+        eigenvalues, eigenvectors = np.linalg.eigh(vectors.T @ vectors)
+        return cls(method, eigenvectors[:, np.argsort(eigenvalues)[::-1][:dim]])
+
+    def apply(self, vectors: np.ndarray) -> np.ndarray:
+        if vectors.shape[1] != self.input_dim:
+            raise ValueError(
+                f"Vector dimensions differ: {vectors.shape[1]} != {self.input_dim}"
+            )
+        return vectors @ self.components
+
+    def to_config(self) -> dict:
+        return {
+            "method": self.method,
+            "components": self.components.tolist(),
+        }
+
+    @classmethod
+    def from_config(cls, config: dict) -> "Reducer":
+        return cls(config["method"], config["components"])
+
+
+def _reduce(v, reducer: Reducer):
+    """``v`` reduced by ``reducer``, in the representation it came in."""
+    reduced = reducer.apply(as_vector(v)[None, :])[0].astype("<f4")
+    if isinstance(v, bytes):
+        return reduced.tobytes()
+    return json.dumps(reduced.tolist())
+
+
+def _top(scores: np.ndarray, k: int) -> set:
+    return set(np.argpartition(scores, -k)[-k:].tolist())
+
+
+def benchmark(vectors, reducers=None, k=10, queries=100, seed=0):
+    """Recall@k, bytes per vector and ms per query of each compact representation.
+
+    Vectors are normalized first, so each representation is measured against
+    exact cosine similarity; queries are sampled from the vectors themselves.
+    """
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    n, d = vectors.shape
+    k = min(k, n)
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(n, min(queries, n), replace=False))
+    truth = [_top(vectors @ vectors[q], k) for q in sample]
+
+    int8 = int8_blobs(vectors)
+    binary = binary_blobs(vectors)
+    scorers = [
+        ("float32", 4 * d, lambda q: vectors @ vectors[q]),
+        ("int8", int8.shape[1], lambda q: int8_dot(int8, int8[q : q + 1])),
+        (
+            "binary",
+            binary.shape[1],
+            lambda q: -hamming_distance(binary, binary[q : q + 1]),
+        ),
+    ]
+    for name, reducer in sorted((reducers or {}).items()):
+        if reducer.input_dim != d:
+            continue
+        reduced = _normalize(reducer.apply(vectors))
+        scorers.append((name, 4 * reducer.dim, lambda q, r=reduced: r @ r[q]))
+
+    results = []
+    for name, size, score in scorers:
+        start = time.perf_counter()
+        found = [_top(score(q), k) for q in sample]
+        elapsed = time.perf_counter() - start
+        recall = np.mean([len(f & t) / k for f, t in zip(found, truth)])
+        results.append((name, size, float(recall), 1000 * elapsed / len(sample)))
+    return results
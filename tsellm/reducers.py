@@ -0,0 +1,56 @@
+"""Fitted dimensionality reducers of a database and the ``embed_reduce`` UDF.
+
+The reducers themselves live in ``tsellm.quantize``, which is only imported
+(along with NumPy) once a reducer is fitted or applied.
+"""
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .quantize import Reducer
+
+
+class ReducerCatalog:
+    """The reducers of one database, by name.
+
+    Each is stored in ``__tsellm`` under ``reducer:<name>`` (its method and
+    projection matrix) and read when the console loads, as DuckDB UDFs
+    cannot query the database.
+    """
+
+    PREFIX = "reducer:"
+
+    def __init__(self, config: dict):
+        self.config = {
+            key[len(self.PREFIX) :]: value
+            for key, value in config.items()
+            if key.startswith(self.PREFIX)
+        }
+        self._open = {}
+
+    def get(self, name) -> "Reducer":
+        if name not in self.config:
+            raise ValueError(f"No reducer named {name}")
+        if name not in self._open:
+            from .quantize import Reducer
+
+            self._open[name] = Reducer.from_config(self.config[name])
+        return self._open[name]
+
+    def all(self) -> dict:
+        return {name: self.get(name) for name in self.config}
+
+    def put(self, name, reducer: "Reducer") -> dict:
+        self._open[name] = reducer
+        self.config[name] = reducer.to_config()
+        return self.config[name]
+
+    def drop(self, name):
+        self.config.pop(name)
+        self._open.pop(name, None)
+
+
+def _embed_reduce(v, name: str, reducers=None):
+    from .quantize import _reduce
+
+    return _reduce(v, reducers.get(name))
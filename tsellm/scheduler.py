@@ -0,0 +1,334 @@
+"""Per-model rate limits, adaptive concurrency and retries for model calls.
+
+Every model call a console makes goes through its ``Scheduler``, which
+
+* spaces calls to stay within each model's requests- and tokens-per-minute
+  budgets (token buckets),
+* lets at most ``limit`` calls to a model run at once, halving the limit
+  when the model throttles and growing it back by one per ``limit``
+  successful calls (AIMD), up to the model's configured concurrency,
+* retries throttled and transient failures with jittered exponential backoff,
+  so a long statement does not fail on a passing 429 or timeout.
+
+Calls from threads go through ``Scheduler.call``; coroutines on the
+console's ``Engine`` go through ``Scheduler.call_async``, which shares
+the same limiters.
+"""
+
+import itertools
+import random
+import threading
+import time
+
+# Calls in flight per model, unless ``.concurrency`` says otherwise.
+DEFAULT_CONCURRENCY = 8
+
+DEFAULT_RETRIES = 5
+
+# Tokens of input an aggregate packs into one call, unless ``.limit`` says so.
+DEFAULT_CONTEXT = 4096
+
+# Upper bound, in seconds, of the delay before the first retry;
+# it doubles with each further retry, up to ``MAX_BACKOFF``.
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# Seconds between checks for a free slot, for coroutines waiting on a limiter.
+POLL_INTERVAL = 0.01
+
+# The settings ``.limit`` and ``__tsellm`` accept per model.
+LIMITS = ("rpm", "tpm", "retries", "context")
+
+
+def estimate_tokens(text) -> int:
+    """A rough token count of ``text`` (or a list of texts): four characters each."""
+    if isinstance(text, (list, tuple)):
+        return sum(estimate_tokens(t) for t in text)
+    return len(text) // 4 + 1 if isinstance(text, (str, bytes)) else 1
+
+
+def _status(exc):
+    """The HTTP status of a provider error, where the client library exposes it."""
+    for obj in (exc, getattr(exc, "response", None)):
+        for attr in ("status_code", "status", "http_status"):
+            status = getattr(obj, attr, None)
+            if isinstance(status, int):
+                return status
+    return None
+
+
+def is_throttled(exc) -> bool:
+    """Whether ``exc`` is a model telling us to slow down."""
+    if _status(exc) == 429:
+        return True
+    text = f"{type(exc).__name__} {exc}".lower()
+    return any(s in text for s in ("ratelimit", "rate limit", "too many requests"))
+
+
+def is_transient(exc) -> bool:
+    """Whether retrying the call that raised ``exc`` may succeed."""
+    if is_throttled(exc) or isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    status = _status(exc)
+    if status is not None:
+        return status in (408, 409) or status >= 500
+    name = type(exc).__name__.lower()
+    return any(s in name for s in ("timeout", "connect", "overloaded", "unavailable"))
+
+
+def _retry_after(exc):
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int, exc=None) -> float:
+    """Seconds to wait before retry ``attempt`` (from 0), with full jitter.
+
+    A ``Retry-After`` the provider sent takes precedence.
+    """
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+
+
+class TokenBucket:
+    """Refills at ``per_minute / 60`` units a second, up to a second's worth."""
+
+    def __init__(self, per_minute: float, clock=time.monotonic):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate, 1.0)
+        self.level = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def reserve(self, amount: float) -> float:
+        """Take ``amount`` units, returning the seconds to wait before using them.
+
+        The level may go negative; later reservations then wait for it to refill.
+        """
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+
+class ModelLimiter:
+    """The budgets, concurrency limit and retry policy of one model."""
+
+    def __init__(
+        self,
+        max_concurrency=DEFAULT_CONCURRENCY,
+        rpm=None,
+        tpm=None,
+        retries=None,
+        context=None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.retries = DEFAULT_RETRIES if retries is None else retries
+        self.context = context or DEFAULT_CONTEXT
+        self.in_flight = 0
+        self.throttled = 0
+        self.retried = 0
+        # Bumped on each decrease, so a burst of throttled calls
+        # that were all in flight together halves the limit only once.
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    def _take(self, requests, tokens):
+        """Take a free slot and reserve the budgets, with ``_cond`` held.
+
+        Returns the slot's epoch and the seconds to wait before using it,
+        or None if every slot is taken.
+        """
+        if self.in_flight >= max(1, min(int(self.limit), self.max_concurrency)):
+            return None
+        self.in_flight += 1
+        wait = max(
+            self.requests.reserve(requests) if self.requests else 0.0,
+            self.tokens.reserve(tokens) if self.tokens and tokens else 0.0,
+        )
+        return self._epoch, wait
+
+    def acquire(self, requests=1, tokens=0) -> int:
+        """Wait for a free slot and for the budgets; return the slot's epoch."""
+        with self._cond:
+            while (slot := self._take(requests, tokens)) is None:
+                self._cond.wait()
+        epoch, wait = slot
+        if wait:
+            time.sleep(wait)
+        return epoch
+
+    async def acquire_async(self, requests=1, tokens=0) -> int:
+        """``acquire``, waiting without blocking the event loop."""
+        import asyncio
+
+        while True:
+            with self._cond:
+                slot = self._take(requests, tokens)
+            if slot is not None:
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+        epoch, wait = slot
+        if wait:
+            await asyncio.sleep(wait)
+        return epoch
+
+    def release(self, epoch: int, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                if epoch == self._epoch:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._epoch += 1
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def consume(self, tokens: int):
+        """Charge ``tokens`` more (or, if negative, fewer) than were reserved."""
+        if self.tokens and tokens:
+            with self._cond:
+                self.tokens.reserve(tokens)
+
+
+class Scheduler:
+    """Routes each model call through the ``ModelLimiter`` of its model.
+
+    ``limits`` maps model ids to their ``LIMITS`` settings;
+    ``concurrency`` maps them to their maximum number of calls in flight.
+    Both are the console's dicts, so changes to them apply to later calls.
+    With ``workers`` (a ``tsellm.workers.WorkerPool``), batches of calls
+    are sharded across worker processes instead; otherwise, with an
+    ``engine`` (a ``tsellm.engine.Engine``), batches of prompts run on
+    its event loop.
+    """
+
+    def __init__(self, limits=None, concurrency=None, workers=None, engine=None):
+        self.limits = {} if limits is None else limits
+        self.concurrency = {} if concurrency is None else concurrency
+        self.workers = workers
+        self.engine = engine
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model: str) -> ModelLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(model)
+                if limiter is None:
+                    limiter = self._limiters[model] = ModelLimiter(
+                        self.concurrency.get(model, DEFAULT_CONCURRENCY),
+                        **self.limits.get(model, {}),
+                    )
+        limiter.max_concurrency = self.concurrency.get(model, DEFAULT_CONCURRENCY)
+        return limiter
+
+    def configure(self, model: str, **limits):
+        """Set (or, with None, unset) some of ``model``'s ``LIMITS``."""
+        settings = self.limits.setdefault(model, {})
+        for name, value in limits.items():
+            if value is None:
+                settings.pop(name, None)
+            else:
+                settings[name] = value
+        if not settings:
+            del self.limits[model]
+        with self._lock:
+            self._limiters.pop(model, None)
+
+    def call(self, model: str, func, requests=1, tokens=0):
+        """``func()``, within ``model``'s limits, retrying transient failures.
+
+        If ``func`` returns an llm response that reports its token usage,
+        the tokens budget is charged for what was used rather than ``tokens``.
+        """
+        limiter = self.limiter(model)
+        for attempt in itertools.count():
+            epoch = limiter.acquire(requests, tokens)
+            try:
+                result = func()
+            except Exception as exc:
+                delay = self._failed(limiter, epoch, attempt, exc)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                return self._succeeded(limiter, epoch, result, tokens)
+
+    async def call_async(self, model: str, func, requests=1, tokens=0):
+        """``call`` for a coroutine function ``func``."""
+        import asyncio
+
+        limiter = self.limiter(model)
+        for attempt in itertools.count():
+            epoch = await limiter.acquire_async(requests, tokens)
+            try:
+                result = await func()
+            except Exception as exc:
+                delay = self._failed(limiter, epoch, attempt, exc)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                return self._succeeded(limiter, epoch, result, tokens)
+
+    @staticmethod
+    def _failed(limiter, epoch, attempt, exc):
+        """Release the slot of a call that raised ``exc``.
+
+        Returns the seconds to wait before retrying it, or None if it is not retried.
+        """
+        limiter.release(epoch, throttled=is_throttled(exc))
+        if attempt >= limiter.retries or not is_transient(exc):
+            return None
+        limiter.retried += 1
+        return backoff(attempt, exc)
+
+    @staticmethod
+    def _succeeded(limiter, epoch, result, tokens):
+        limiter.release(epoch)
+        used = (getattr(result, "input_tokens", None) or 0) + (
+            getattr(result, "output_tokens", None) or 0
+        )
+        if used:
+            limiter.consume(used - tokens)
+        return result
+
+    def close(self):
+        """Stop the worker processes and the engine, if they were started."""
+        if self.workers is not None:
+            self.workers.close()
+        if self.engine is not None:
+            self.engine.close()
+
+    def rows(self) -> list:
+        """The settings, concurrency limit and retry counts of each model."""
+        models = sorted(set(self.limits) | set(self._limiters))
+        rows = []
+        for model in models:
+            settings = self.limits.get(model, {})
+            limiter = self._limiters.get(model)
+            rows.append(
+                (
+                    model,
+                    settings.get("rpm"),
+                    settings.get("tpm"),
+                    settings.get("retries", DEFAULT_RETRIES),
+                    settings.get("context", DEFAULT_CONTEXT),
+                    limiter and round(limiter.limit, 1),
+                    limiter.throttled if limiter else 0,
+                    limiter.retried if limiter else 0,
+                )
+            )
+        return rows
@@ -0,0 +1,281 @@
+"""``tsellm serve``: answer SQL over HTTP from a pool of warm consoles.
+
+    tsellm serve docs.db --port 8765 --pool 4
+    tsellm --server http://127.0.0.1:8765 "select embed(text, 'hazo') from docs"
+
+While it runs, the server writes its URL to ``<database>.tsellm-server``,
+and ``tsellm DATABASE SQL`` sends the query to it rather than opening the
+database itself.
+
+``POST /query`` takes ``{"sql": ..., "format": ...}`` (any ``--output``
+format, ``jsonl`` by default) and streams the rows back with chunked
+transfer encoding, a batch at a time, as the statement produces them.
+Each request borrows a console from the pool, so up to ``pool`` statements
+run at once; the consoles share one scheduler, so rate limits and the
+event loop are the server's, and models stay loaded between requests.
+An error before the first row is a 400 response with ``{"error": ...}``;
+one after it ends the response without its final chunk.
+"""
+
+import codecs
+import io
+import json
+import queue
+import sys
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from .output import FORMATS
+
+DEFAULT_PORT = 8765
+DEFAULT_POOL = 4
+
+CONTENT_TYPES = {
+    "tuple": "text/plain; charset=utf-8",
+    "csv": "text/csv; charset=utf-8",
+    "tsv": "text/tab-separated-values; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def server_file(path) -> Path:
+    """Where a server over the database at ``path`` advertises its URL."""
+    return Path(f"{path}.tsellm-server").resolve()
+
+
+class ConsolePool:
+    """``size`` consoles over one database, borrowed one request at a time.
+
+    The consoles share the first one's scheduler and prompt cache,
+    so every request sees the responses cached by the others.
+
+    An in-memory database exists only in the connection that created it,
+    so it gets a single console. So does a DuckDB database: DuckDB keeps
+    Python UDFs in the database rather than the connection, where a second
+    console could not register its own; DuckDB runs each statement on
+    all cores anyway.
+    """
+
+    def __init__(self, create_console, size=DEFAULT_POOL):
+        first = create_console()
+        if first.is_in_memory or first.db_type == "DuckDB":
+            size = 1
+        self.consoles = [first] + [create_console() for _ in range(size - 1)]
+        for console in self.consoles[1:]:
+            console.scheduler.close()
+            console.scheduler = first.scheduler
+            console.cache = first.cache
+            console.register_functions()
+        self._idle = queue.Queue()
+        for console in self.consoles:
+            self._idle.put(console)
+
+    @property
+    def scheduler(self):
+        return self.consoles[0].scheduler
+
+    @contextmanager
+    def console(self):
+        console = self._idle.get()
+        try:
+            yield console
+        finally:
+            self._idle.put(console)
+
+    def close(self):
+        self.scheduler.close()
+        for console in self.consoles:
+            console.connection.close()
+
+
+class ChunkedStream(io.RawIOBase):
+    """A response body in chunked transfer encoding, for the result writers.
+
+    The status line and headers go out with the first write, so a statement
+    that fails before producing anything can still get an error response.
+    """
+
+    def __init__(self, handler, content_type):
+        self.handler = handler
+        self.content_type = content_type
+        self.started = False
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        data = bytes(data)
+        if not data:  # an empty chunk would end the response
+            return 0
+        self.start()
+        self.handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.position += len(data)
+        return len(data)
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.handler.send_response(200)
+            self.handler.send_header("Content-Type", self.content_type)
+            self.handler.send_header("Transfer-Encoding", "chunked")
+            self.handler.end_headers()
+
+    def finish(self):
+        self.start()
+        self.handler.wfile.write(b"0\r\n\r\n")
+
+    def close(self):
+        # Writers close their stream when done; the response is finished explicitly.
+        pass
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "TsellmServer"
+
+    def send_json(self, status, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            pool = self.server.pool
+            database = str(Path(pool.consoles[0].path).resolve())
+            self.send_json(
+                200, {"status": "ok", "pool": len(pool.consoles), "database": database}
+            )
+        else:
+            self.send_json(404, {"error": f"No such endpoint: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/query":
+            self.send_json(404, {"error": f"No such endpoint: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            sql, fmt = request["sql"], request.get("format", "jsonl")
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": 'Expected a JSON body {"sql": ...}'})
+            return
+        if fmt not in FORMATS:
+            error = f"format must be one of {', '.join(FORMATS)}"
+            self.send_json(400, {"error": error})
+            return
+        stream = ChunkedStream(self, CONTENT_TYPES[fmt])
+        with self.server.pool.console() as console:
+            try:
+                console.run(sql, fmt, stream)
+            except Exception as e:
+                if stream.started:
+                    self.close_connection = True
+                    return
+                self.send_json(400, {"error": f"{type(e).__name__}: {e}"})
+                return
+        stream.finish()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class TsellmServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pool: ConsolePool, quiet=False):
+        super().__init__(address, QueryHandler)
+        self.pool = pool
+        self.quiet = quiet
+        self.advertised = None
+
+    def advertise(self):
+        """Write the URL to the database's server file, until the server closes."""
+        console = self.pool.consoles[0]
+        if not console.is_in_memory:
+            self.advertised = server_file(console.path)
+            self.advertised.write_text(self.url + "\n")
+
+    def server_close(self):
+        super().server_close()
+        # Another server may have taken over the database since.
+        if self.advertised is not None and running_url(self.advertised) == self.url:
+            self.advertised.unlink()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def running_url(path: Path):
+    """The URL written to a server file, or None."""
+    try:
+        return path.read_text().strip() or None
+    except OSError:
+        return None
+
+
+def running_server(database):
+    """The URL of a server over ``database`` that answers, or None."""
+    url = running_url(server_file(database))
+    if url is None:
+        return None
+    from urllib.request import urlopen
+
+    try:
+        with urlopen(url + "/health", timeout=1) as response:
+            health = json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+    if health.get("database") != str(Path(database).resolve()):
+        return None
+    return url
+
+
+def query(url: str, sql: str, fmt="jsonl", stream=None):
+    """Send ``sql`` to the server at ``url``, copying the result to ``stream``.
+
+    Raises ``RuntimeError`` with the server's message if the statement fails.
+    """
+    from http.client import IncompleteRead
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    binary = fmt in ("arrow", "parquet")
+    if stream is None:
+        stream = sys.stdout.buffer if binary else sys.stdout
+    request = Request(
+        url.rstrip("/") + "/query",
+        data=json.dumps({"sql": sql, "format": fmt}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urlopen(request) as response:
+            # A chunk may end within a multi-byte character.
+            decoder = None if binary else codecs.getincrementaldecoder("utf-8")()
+            while chunk := response.read1(1 << 16):
+                stream.write(chunk if decoder is None else decoder.decode(chunk))
+    except HTTPError as e:
+        raise RuntimeError(json.loads(e.read()).get("error", str(e))) from None
+    except IncompleteRead:
+        raise RuntimeError("The statement failed after its first rows") from None
+    stream.flush()
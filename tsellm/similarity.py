@@ -0,0 +1,49 @@
+"""Vector similarity kernels.
+
+Each kernel compares two ``(n, d)`` matrices row by row,
+so DuckDB can run it once over a whole chunk of rows.
+"""
+
+import json
+
+import numpy as np
+
+
+def as_vector(v) -> np.ndarray:
+    """Read a JSON-text, float32-BLOB or list embedding as a float32 vector."""
+    if isinstance(v, str):
+        return np.asarray(json.loads(v), dtype=np.float32)
+    if isinstance(v, bytes):
+        return np.frombuffer(v, dtype="<f4")
+    return np.asarray(v, dtype=np.float32)
+
+
+def dot_product(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", a, b)
+
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return dot_product(a, b) / norms
+
+
+def l2_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.linalg.norm(a - b, axis=1)
+
+
+def _scalar(kernel):
+    def compare(a, b) -> float:
+        a, b = as_vector(a), as_vector(b)
+        if a.shape != b.shape:
+            raise ValueError(f"Vector dimensions differ: {a.shape[0]} != {b.shape[0]}")
+        result = float(kernel(a[None, :], b[None, :])[0])
+        return None if np.isnan(result) else result
+
+    compare.__name__ = f"_{kernel.__name__}"
+    return compare
+
+
+_cosine_similarity = _scalar(cosine_similarity)
+_dot_product = _scalar(dot_product)
+_l2_distance = _scalar(l2_distance)
@@ -0,0 +1,76 @@
+"""Where the startup time of a tsellm invocation goes.
+
+``tsellm --startup-profile`` reports, for each phase of a run,
+its wall-clock time and the top-level packages first imported during it,
+so an eager import of DuckDB, PyArrow or the llm plugins is easy to spot.
+"""
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+def process_age():
+    """Seconds since this process started, or None where that cannot be read."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces; fields resume after its ")".
+            started = int(f.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started / os.sysconf(
+            "SC_CLK_TCK"
+        )
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _packages(modules) -> list:
+    """Third-party top-level packages of ``modules``, then a count of stdlib ones."""
+    packages = {name.split(".")[0] for name in modules}
+    stdlib = packages & sys.stdlib_module_names
+    named = sorted(p for p in packages - stdlib if not p.startswith("_"))
+    return named + [f"{len(stdlib)} stdlib"] if stdlib else named
+
+
+class StartupProfile:
+    """Wall-clock time and newly imported packages of each startup phase.
+
+    ``started`` is the ``time.perf_counter()`` reading at which the first phase,
+    ``name``, began; the phases recorded with ``phase`` follow it.
+    """
+
+    def __init__(self, name="import tsellm", started=None, modules=()):
+        self.phases = []
+        self._mark = time.perf_counter()
+        self._modules = set(sys.modules)
+        age = process_age()
+        if age is not None and started is not None:
+            self.phases.append(("interpreter", age - (self._mark - started), []))
+        if started is not None:
+            self.phases.append(
+                (name, self._mark - started, _packages(self._modules - set(modules)))
+            )
+
+    @contextmanager
+    def phase(self, name):
+        self._mark = time.perf_counter()
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            modules = set(sys.modules)
+            self.phases.append(
+                (name, now - self._mark, _packages(modules - self._modules))
+            )
+            self._mark, self._modules = now, modules
+
+    def report(self, stream=None):
+        stream = stream or sys.stderr
+        print(f"{'phase':<20}{'ms':>10}  imported", file=stream)
+        for name, seconds, packages in self.phases:
+            shown = ", ".join(packages[:8])
+            if len(packages) > 8:
+                shown += f" (+{len(packages) - 8} more)"
+            print(f"{name:<20}{1000 * seconds:>10.1f}  {shown}", file=stream)
+        total = sum(seconds for _, seconds, _ in self.phases)
+        print(f"{'total':<20}{1000 * total:>10.1f}", file=stream)
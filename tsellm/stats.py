@@ -0,0 +1,230 @@
+"""Live counters of the UDF calls made by a console.
+
+Every UDF a console registers is wrapped to count its calls, rows, errors,
+latency and input/output sizes, keyed by ``(function, model)``;
+prompt functions also report the token usage llm records for each response.
+The counters are shown by ``.stats`` and queryable through ``tsellm_stats()``.
+"""
+
+import inspect
+import json
+import threading
+import time
+from bisect import bisect_left
+
+from .core import (
+    DEFAULT_PROMPT_MODEL,
+    _embed_blob_model_default,
+    _embed_model_default,
+    _prompt_model_default,
+)
+from .models import registry
+
+# Upper bounds, in milliseconds, of the latency histogram buckets;
+# the last bucket counts everything slower.
+LATENCY_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+# How the one-argument UDFs resolve the model they call.
+DEFAULT_MODELS = {
+    _prompt_model_default: lambda: DEFAULT_PROMPT_MODEL,
+    _embed_model_default: registry.default_embedding_model_id,
+    _embed_blob_model_default: registry.default_embedding_model_id,
+}
+
+FIELDS = (
+    "calls",
+    "rows",
+    "errors",
+    "seconds",
+    "input_size",
+    "output_size",
+    "input_tokens",
+    "output_tokens",
+)
+
+
+# The columns of ``.stats`` and of the ``tsellm_stats`` view,
+# which also has the latency ``histogram``.
+COLUMNS = ("function", "model", *FIELDS, "p50_ms", "p99_ms")
+
+SQLITE_STATS_VIEW = (
+    "CREATE TEMP VIEW IF NOT EXISTS tsellm_stats AS SELECT "
+    + ", ".join(f"json_extract(value, '$.{c}') AS {c}" for c in COLUMNS)
+    + ", json_extract(value, '$.histogram') AS histogram"
+    + " FROM json_each(tsellm_stats())"
+)
+
+
+def _size(value) -> int:
+    """Characters of text, bytes of BLOBs and Arrow arrays; 0 for anything else."""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return getattr(value, "nbytes", 0)
+
+
+def _model_of(value):
+    """The model id of a scalar call, or the single model of an Arrow chunk."""
+    if value is None or isinstance(value, str):
+        return value
+    models = [m for m in value.unique().to_pylist() if m is not None]
+    return models[0] if len(models) == 1 else "(mixed)"
+
+
+class Counters:
+    __slots__ = FIELDS + ("histogram",)
+
+    def __init__(self):
+        for name in FIELDS:
+            setattr(self, name, 0)
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def clear(self):
+        self.__init__()
+
+    def percentile(self, q):
+        """Upper bound, in ms, of the bucket holding the ``q``-th quantile call.
+
+        None if that call was slower than the last bound, or there were no calls.
+        """
+        target = q * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), self.histogram):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return None
+
+    def as_dict(self) -> dict:
+        return {
+            **{name: getattr(self, name) for name in FIELDS},
+            "histogram": list(self.histogram),
+        }
+
+
+class UDFStats:
+    """Counters of one console's UDF calls, keyed by ``(function, model)``.
+
+    Functions that do not call a model are keyed by model ``None``.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def _counters(self, function, model) -> Counters:
+        key = (function, model)
+        counters = self.counters.get(key)
+        if counters is None:
+            counters = self.counters.setdefault(key, Counters())
+        return counters
+
+    def usage(self, function, model, response):
+        """Add the token usage llm recorded for ``response``, where it did."""
+        input_tokens = getattr(response, "input_tokens", None)
+        output_tokens = getattr(response, "output_tokens", None)
+        if input_tokens is None and output_tokens is None:
+            return
+        with self._lock:
+            c = self._counters(function, model)
+            c.input_tokens += input_tokens or 0
+            c.output_tokens += output_tokens or 0
+
+    def wrap(self, function, py_func, bound, vectorized=False):
+        """``bound``, counting each call under ``function`` and the called model.
+
+        The input size counted is that of the first argument, the one the
+        function transforms; ``vectorized`` functions take Arrow arrays,
+        and each call counts as ``len(args[0])`` rows.
+        """
+        function = function.removeprefix("__tsellm_")
+        parameters = list(inspect.signature(py_func).parameters)
+        model_index = next(
+            (i for i, p in enumerate(parameters) if p in ("model", "models")), None
+        )
+        default_model = DEFAULT_MODELS.get(py_func, lambda: None)
+        # Per-model counters, looked up once rather than on every call.
+        counters = {}
+        lock = self._lock
+        perf_counter = time.perf_counter
+
+        def measured(*args):
+            if model_index is None:
+                model = default_model()
+            else:
+                model = _model_of(args[model_index])
+            start = perf_counter()
+            try:
+                result = bound(*args)
+            except Exception:
+                seconds = perf_counter() - start
+                input_size = output_size = 0
+                error = 1
+                raise
+            else:
+                seconds = perf_counter() - start
+                input_size = _size(args[0]) if args else 0
+                output_size = _size(result)
+                error = 0
+                return result
+            finally:
+                c = counters.get(model)
+                if c is None:
+                    c = counters[model] = self._counters(function, model)
+                bucket = bisect_left(LATENCY_BUCKETS, 1000 * seconds)
+                with lock:
+                    c.calls += 1
+                    c.rows += len(args[0]) if vectorized else 1
+                    c.errors += error
+                    c.seconds += seconds
+                    c.input_size += input_size
+                    c.output_size += output_size
+                    c.histogram[bucket] += 1
+
+        # DuckDB counts a UDF's parameters from its signature.
+        measured.__signature__ = inspect.signature(bound)
+        return measured
+
+    def rows(self) -> list:
+        """One dict per ``(function, model)``, for ``.stats`` and ``tsellm_stats()``."""
+        with self._lock:
+            items = sorted(
+                self.counters.items(), key=lambda kv: (kv[0][0], kv[0][1] or "")
+            )
+            return [
+                {
+                    "function": function,
+                    "model": model,
+                    **c.as_dict(),
+                    "p50_ms": c.percentile(0.5),
+                    "p99_ms": c.percentile(0.99),
+                }
+                for (function, model), c in items
+                if c.calls or c.input_tokens or c.output_tokens
+            ]
+
+    def snapshot(self) -> list:
+        """The counters in the form stored in ``__tsellm`` under ``"stats"``."""
+        return [
+            {k: v for k, v in row.items() if k not in ("p50_ms", "p99_ms")}
+            for row in self.rows()
+        ]
+
+    def merge(self, snapshot):
+        """Add the counters of a ``snapshot`` to these."""
+        with self._lock:
+            for row in snapshot or []:
+                c = self._counters(row["function"], row["model"])
+                for name in FIELDS:
+                    setattr(c, name, getattr(c, name) + row.get(name, 0))
+                histogram = row.get("histogram", [])[: len(c.histogram)]
+                for i, count in enumerate(histogram):
+                    c.histogram[i] += count
+
+    def reset(self):
+        # Zeroed in place: wrapped functions hold on to their counters.
+        with self._lock:
+            for c in self.counters.values():
+                c.clear()
+
+    def to_json(self) -> str:
+        return json.dumps(self.rows())
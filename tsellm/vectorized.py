@@ -0,0 +1,392 @@
+"""Arrow-vectorized UDFs for DuckDB.
+
+DuckDB hands these functions a whole chunk of rows at a time as Arrow arrays,
+so each chunk costs one batched model call instead of one call per row.
+"""
+
+import json
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from duckdb.sqltypes import BIGINT, DOUBLE, VARCHAR
+
+from .chunking import _chunk_list  # noqa: F401 - registered as is, like _knn
+from .core import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PROMPT_MODEL,
+    _embed_chunks_many,
+    _embed_mean,
+    _embed_unique,
+    _json_embed_many,
+    _prompt_many,
+    _prompt_reduce,
+)
+from .index import _knn  # noqa: F401 - registered as is: knn is not vectorized
+from .models import registry
+from .quantize import binary_blobs, hamming_distance, int8_blobs, int8_dot
+from .similarity import cosine_similarity, dot_product, l2_distance
+from .stats import COLUMNS, FIELDS
+
+STATS_RESULT = duckdb.list_type(
+    duckdb.struct_type(
+        {
+            "function": VARCHAR,
+            "model": VARCHAR,
+            **{field: BIGINT for field in FIELDS},
+            "seconds": DOUBLE,
+            "p50_ms": DOUBLE,
+            "p99_ms": DOUBLE,
+            "histogram": duckdb.list_type(BIGINT),
+        }
+    )
+)
+
+
+def _by_model(values, models):
+    """Group the row positions of non-null ``values`` by their model id."""
+    groups = {}
+    for i, (value, model) in enumerate(zip(values, models)):
+        if value is not None and model is not None:
+            groups.setdefault(model, []).append(i)
+    return groups
+
+
+def _prompt_model_arrow(
+    prompts: pa.Array,
+    models: pa.Array,
+    cache=None,
+    concurrency=None,
+    stats=None,
+    scheduler=None,
+    stream=None,
+) -> pa.Array:
+    prompts, models = prompts.to_pylist(), models.to_pylist()
+    responses = [None] * len(prompts)
+    groups = _by_model(prompts, models)
+    if stream is not None:
+        stream = stream.claim() if len(groups) == 1 else None
+    for model, rows in groups.items():
+        max_in_flight = (concurrency or {}).get(model, DEFAULT_CONCURRENCY)
+        for i, response in zip(
+            rows,
+            _prompt_many(
+                [prompts[i] for i in rows],
+                model,
+                cache,
+                max_in_flight,
+                stats,
+                scheduler,
+                stream,
+            ),
+        ):
+            responses[i] = response
+    return pa.array(responses, type=pa.string())
+
+
+def _prompt_agg_arrow(
+    texts: pa.Array,
+    instructions: pa.Array,
+    models: pa.Array,
+    cache=None,
+    concurrency=None,
+    stats=None,
+    scheduler=None,
+) -> pa.Array:
+    """``prompt_agg``: reduce each group's ``list()`` of texts to one response."""
+    texts, instructions = texts.to_pylist(), instructions.to_pylist()
+    models = models.to_pylist()
+    responses = [None] * len(texts)
+    for model, rows in _by_model(texts, models).items():
+        max_in_flight = (concurrency or {}).get(model, DEFAULT_CONCURRENCY)
+        for i, response in zip(
+            rows,
+            _prompt_reduce(
+                [(instructions[i], texts[i]) for i in rows],
+                model,
+                cache,
+                max_in_flight,
+                stats,
+                scheduler,
+            ),
+        ):
+            responses[i] = response
+    return pa.array(responses, type=pa.string())
+
+
+def _embed_mean_arrow(texts: pa.Array, models: pa.Array, scheduler=None) -> pa.Array:
+    """``embed_mean``: the mean embedding of each group's ``list()`` of texts."""
+    texts = texts.to_pylist()
+    models = [m or registry.default_embedding_model_id() for m in models.to_pylist()]
+    means = [None] * len(texts)
+    for model, rows in _by_model(texts, models).items():
+        embedded = _embed_mean(
+            [texts[i] for i in rows], registry.get_embedding_model(model), scheduler
+        )
+        for i, mean in zip(rows, embedded):
+            means[i] = mean
+    return pa.array(means, type=pa.list_(pa.float32()))
+
+
+def _embed_model_arrow(texts: pa.Array, models: pa.Array, scheduler=None) -> pa.Array:
+    texts, models = texts.to_pylist(), models.to_pylist()
+    vectors = [None] * len(texts)
+    for model, rows in _by_model(texts, models).items():
+        embedded = _embed_unique(
+            registry.get_embedding_model(model), [texts[i] for i in rows], scheduler
+        )
+        for i, vector in zip(rows, embedded):
+            vectors[i] = vector
+    return pa.array(vectors, type=pa.list_(pa.float32()))
+
+
+def _embed_chunks_arrow(
+    texts: pa.Array, models: pa.Array, poolings: pa.Array, scheduler=None
+) -> pa.Array:
+    texts, models = texts.to_pylist(), models.to_pylist()
+    poolings = poolings.to_pylist()
+    vectors = [None] * len(texts)
+    for model, rows in _by_model(texts, models).items():
+        embedded = _embed_chunks_many(
+            [texts[i] for i in rows],
+            registry.get_embedding_model(model),
+            [poolings[i] for i in rows],
+            scheduler,
+        )
+        for i, vector in zip(rows, embedded):
+            vectors[i] = vector
+    return pa.array(vectors, type=pa.list_(pa.float32()))
+
+
+def _json_embed_model_arrow(
+    docs: pa.Array, models: pa.Array, scheduler=None
+) -> pa.Array:
+    docs = [None if d is None else json.loads(d) for d in docs.to_pylist()]
+    models = models.to_pylist()
+    results = [None] * len(docs)
+    for model, rows in _by_model(docs, models).items():
+        embedded = _json_embed_many(
+            [docs[i] for i in rows], registry.get_embedding_model(model), scheduler
+        )
+        for i, doc in zip(rows, embedded):
+            results[i] = json.dumps(doc)
+    return pa.array(results, type=pa.string())
+
+
+def _embedding_to_json_arrow(vectors: pa.Array) -> pa.Array:
+    return pa.array(
+        [None if v is None else json.dumps(v) for v in vectors.to_pylist()],
+        type=pa.string(),
+    )
+
+
+def _json_to_embedding_arrow(docs: pa.Array) -> pa.Array:
+    return pa.array(
+        [None if d is None else json.loads(d) for d in docs.to_pylist()],
+        type=pa.list_(pa.float32()),
+    )
+
+
+def _matrix(vectors: pa.Array) -> np.ndarray:
+    """A FLOAT[] array without nulls as a contiguous ``(n, d)`` float32 matrix."""
+    if isinstance(vectors, pa.ChunkedArray):
+        vectors = pa.concat_arrays(vectors.chunks)
+    dims = pc.list_value_length(vectors).to_numpy(zero_copy_only=False)
+    if len(dims) and (dims != dims[0]).any():
+        raise ValueError("Vector dimensions differ within a column")
+    values = vectors.flatten().to_numpy(zero_copy_only=False)
+    return values.astype(np.float32, copy=False).reshape(len(vectors), -1)
+
+
+def _blob_matrix(blobs: pa.Array) -> np.ndarray:
+    """A BLOB array without nulls as a ``(n, width)`` byte matrix, without copying."""
+    if isinstance(blobs, pa.ChunkedArray):
+        blobs = pa.concat_arrays(blobs.chunks)
+    widths = pc.binary_length(blobs).to_numpy(zero_copy_only=False)
+    if len(widths) and (widths != widths[0]).any():
+        raise ValueError("Vector dimensions differ within a column")
+    offset_type = np.int64 if pa.types.is_large_binary(blobs.type) else np.int32
+    _, offsets, data = blobs.buffers()
+    offsets = np.frombuffer(offsets, offset_type)[
+        blobs.offset : blobs.offset + len(blobs) + 1
+    ]
+    if data is None:
+        return np.empty((len(blobs), 0), dtype=np.uint8)
+    data = np.frombuffer(data, np.uint8)[offsets[0] : offsets[-1]]
+    return data.reshape(len(blobs), -1)
+
+
+def _blob_array(matrix: np.ndarray) -> pa.Array:
+    """The rows of a byte matrix as a BLOB array."""
+    n, width = matrix.shape
+    fixed = pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(width), n, [None, pa.py_buffer(np.ascontiguousarray(matrix))]
+    )
+    return fixed.cast(pa.binary())
+
+
+def _quantize_int8_arrow(vectors: pa.Array) -> pa.Array:
+    return _blob_array(int8_blobs(_matrix(vectors)))
+
+
+def _quantize_binary_arrow(vectors: pa.Array) -> pa.Array:
+    return _blob_array(binary_blobs(_matrix(vectors)))
+
+
+def _int8_dot_arrow(a: pa.Array, b: pa.Array) -> pa.Array:
+    return pa.array(int8_dot(_blob_matrix(a), _blob_matrix(b)), type=pa.float64())
+
+
+def _hamming_distance_arrow(a: pa.Array, b: pa.Array) -> pa.Array:
+    return pa.array(hamming_distance(_blob_matrix(a), _blob_matrix(b)), type=pa.int64())
+
+
+def _embed_reduce_arrow(vectors: pa.Array, names: pa.Array, reducers=None) -> pa.Array:
+    if isinstance(vectors, pa.ChunkedArray):
+        vectors = pa.concat_arrays(vectors.chunks)
+    groups = {}
+    for i, name in enumerate(names.to_pylist()):
+        groups.setdefault(name, []).append(i)
+    reduced = [None] * len(vectors)
+    for name, rows in groups.items():
+        matrix = _matrix(vectors.take(pa.array(rows, pa.int64())))
+        for i, vector in zip(rows, reducers.get(name).apply(matrix).tolist()):
+            reduced[i] = vector
+    return pa.array(reduced, type=pa.list_(pa.float32()))
+
+
+def _similarity_arrow(kernel):
+    def compare(a: pa.Array, b: pa.Array) -> pa.Array:
+        valid = pc.and_(a.is_valid(), b.is_valid())
+        mask = valid.to_numpy(zero_copy_only=False)
+        result = np.full(len(mask), np.nan)
+        if mask.any():
+            left, right = _matrix(a.filter(valid)), _matrix(b.filter(valid))
+            if left.shape != right.shape:
+                raise ValueError(
+                    f"Vector dimensions differ: {left.shape[1]} != {right.shape[1]}"
+                )
+            result[mask] = kernel(left, right)
+        return pa.array(result, mask=np.isnan(result))
+
+    compare.__name__ = f"_{kernel.__name__}_arrow"
+    return compare
+
+
+JOIN_RESULT = pa.list_(
+    pa.struct(
+        [
+            ("left_rowid", pa.int64()),
+            ("right_rowid", pa.int64()),
+            ("score", pa.float64()),
+        ]
+    )
+)
+
+
+def _semantic_join_arrow(
+    left_rowids: pa.Array,
+    left: pa.Array,
+    right_rowids: pa.Array,
+    right: pa.Array,
+    k: pa.Array,
+) -> pa.Array:
+    """``semantic_join``: each row holds two whole columns, collected by the macro."""
+    from .join import top_k
+
+    pairs, offsets = [], [0]
+    for i in range(len(left)):
+        li, ri, scores = top_k(
+            _matrix(left[i].values), _matrix(right[i].values), k[i].as_py()
+        )
+        pairs.append(
+            pa.StructArray.from_arrays(
+                [
+                    left_rowids[i].values.take(li),
+                    right_rowids[i].values.take(ri),
+                    pa.array(scores, pa.float64()),
+                ],
+                fields=list(JOIN_RESULT.value_type),
+            )
+        )
+        offsets.append(offsets[-1] + len(scores))
+    values = pa.concat_arrays(pairs) if pairs else pa.array([], JOIN_RESULT.value_type)
+    return pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), values)
+
+
+_cosine_similarity_arrow = _similarity_arrow(cosine_similarity)
+_dot_product_arrow = _similarity_arrow(dot_product)
+_l2_distance_arrow = _similarity_arrow(l2_distance)
+
+DUCKDB_STATS_VIEW = (
+    "CREATE OR REPLACE TEMP VIEW tsellm_stats AS SELECT "
+    + ", ".join(f"s.{c}" for c in COLUMNS)
+    + ", s.histogram FROM (SELECT unnest(tsellm_stats()) AS s)"
+)
+
+# DuckDB cannot overload Python UDFs by argument type or arity, so these
+# macros cast JSON text and fixed-size arrays to FLOAT[], or fill in
+# optional arguments, before calling the UDF.
+# Nor can it register Python aggregates: the aggregate macros collect
+# each group with list() and reduce it with a vectorized UDF.
+# Nor table functions: semantic_join is a table macro that collects each
+# column with list() and unnests the pairs the UDF returns.
+MACROS = (
+    [
+        (
+            func_name,
+            f"(a, b) AS __tsellm_{func_name}(a::FLOAT[], b::FLOAT[])",
+        )
+        for func_name in ("cosine_similarity", "dot_product", "l2_distance")
+    ]
+    + [
+        (func_name, f"(v) AS __tsellm_{func_name}(v::FLOAT[])")
+        for func_name in ("quantize_int8", "quantize_binary")
+    ]
+    + [
+        ("embed_reduce", "(v, name) AS __tsellm_embed_reduce(v::FLOAT[], name)"),
+        (
+            "knn",
+            "(q, k) AS __tsellm_knn(q::FLOAT[], k, NULL), "
+            "(q, k, name) AS __tsellm_knn(q::FLOAT[], k, name)",
+        ),
+        (
+            "prompt_agg",
+            "(t, instruction, model) AS "
+            "__tsellm_prompt_agg(list(t), any_value(instruction), any_value(model)), "
+            "(t, instruction) AS __tsellm_prompt_agg("
+            f"list(t), any_value(instruction), '{DEFAULT_PROMPT_MODEL}')",
+        ),
+        (
+            "embed_mean",
+            "(t, model) AS __tsellm_embed_mean(list(t), any_value(model)), "
+            "(t) AS __tsellm_embed_mean(list(t), NULL::VARCHAR)",
+        ),
+        (
+            "chunk",
+            "(t, size) AS __tsellm_chunk(t, size, 0), "
+            "(t, size, overlap) AS __tsellm_chunk(t, size, overlap)",
+        ),
+        (
+            "embed_chunks",
+            "(t, model) AS __tsellm_embed_chunks(t, model, 'mean'), "
+            "(t, model, pooling) AS __tsellm_embed_chunks(t, model, pooling)",
+        ),
+        (
+            "__tsellm_vectors",
+            "(t, c) AS TABLE SELECT list(rowid ORDER BY rowid) AS rowids, "
+            "list(v ORDER BY rowid) AS vectors FROM query("
+            "'SELECT rowid, \"' || replace(c, '\"', '\"\"') || '\"::FLOAT[] AS v "
+            "FROM \"' || replace(t, '\"', '\"\"') || '\"') WHERE v IS NOT NULL",
+        ),
+        (
+            "semantic_join",
+            "(lt, lc, rt, rc, k := 10) AS TABLE "
+            "SELECT p.left_rowid, p.right_rowid, p.score FROM ("
+            "SELECT unnest(__tsellm_semantic_join("
+            "l.rowids, l.vectors, r.rowids, r.vectors, k)) AS p "
+            "FROM __tsellm_vectors(lt, lc) l, __tsellm_vectors(rt, rc) r)",
+        ),
+    ]
+)
@@ -0,0 +1,114 @@
+"""Process pools that shard model calls across CPU cores.
+
+Local models (gpt4all, sentence-transformers) are CPU-bound and hold the GIL,
+so threads cannot run them in parallel. With ``--workers N``, each batch of
+distinct inputs a UDF collects (a DuckDB chunk, or the calls of a SQLite
+prefetch) is split into N contiguous shards, one per worker process.
+Each worker loads a model once, keeps it for the rest of the session,
+and results come back in input order.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# The scheduler of a worker process, set by ``_init``.
+_scheduler = None
+
+
+class _Usage:
+    """Sums the token usage of a worker's responses, in place of ``UDFStats``."""
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def usage(self, function, model, response):
+        self.input_tokens += getattr(response, "input_tokens", None) or 0
+        self.output_tokens += getattr(response, "output_tokens", None) or 0
+
+
+def _init(limits):
+    global _scheduler
+    from .scheduler import Scheduler
+
+    _scheduler = Scheduler(limits)
+
+
+def _prompt_shard(model: str, prompts: list):
+    from .core import _prompt_model
+
+    usage = _Usage()
+    texts = [
+        _prompt_model(prompt, model, stats=usage, scheduler=_scheduler)
+        for prompt in prompts
+    ]
+    return texts, usage
+
+
+def _embed_shard(model: str, texts: list) -> list:
+    from .core import _embed_unique
+    from .models import registry
+
+    return _embed_unique(registry.get_embedding_model(model), texts, _scheduler)
+
+
+class WorkerPool:
+    """``workers`` processes that model calls are sharded across.
+
+    Each worker applies the console's ``limits``, with the requests- and
+    tokens-per-minute budgets divided between the workers.
+    """
+
+    def __init__(self, workers: int, limits=None):
+        self.workers = workers
+        self.limits = {
+            model: {
+                name: max(1, value // workers) if name in ("rpm", "tpm") else value
+                for name, value in settings.items()
+            }
+            for model, settings in (limits or {}).items()
+        }
+        self._executor = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Started on first use, with spawn: forking a process that has
+        # DuckDB or model threads running can deadlock the children.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init,
+                initargs=(self.limits,),
+            )
+        return self._executor
+
+    def _shards(self, items: list) -> list:
+        size = -(-len(items) // self.workers)
+        return [items[i : i + size] for i in range(0, len(items), size)]
+
+    def prompt(self, model: str, prompts: list, stats=None) -> list:
+        """The responses of ``model`` to ``prompts``, in order."""
+        futures = [
+            self._pool().submit(_prompt_shard, model, shard)
+            for shard in self._shards(prompts)
+        ]
+        responses = []
+        for future in futures:
+            texts, usage = future.result()
+            responses.extend(texts)
+            if stats is not None:
+                stats.usage("prompt", model, usage)
+        return responses
+
+    def embed(self, model: str, texts: list) -> list:
+        """The embeddings of ``texts`` by ``model``, in order."""
+        futures = [
+            self._pool().submit(_embed_shard, model, shard)
+            for shard in self._shards(texts)
+        ]
+        return [vector for future in futures for vector in future.result()]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None